@@ -1,15 +1,60 @@
+import argparse
+import array
 import asyncio
+import base64
+import bisect
+import codecs
+import io
+import itertools
 import os
 import re
 import discord
 import json
+import math
+import random
 import aiofiles
+import aiohttp
+import contextlib
+import csv
+import contextvars
+import cProfile
+import functools
+import gzip
+import hashlib
+import pstats
+import shutil
+import socket
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+import uuid
+import zlib
 from rich import print
 from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
 from dotenv import load_dotenv
+from discord import app_commands
 from discord.ext import commands
 
+try: #Optional, faster JSON encoding/decoding
+    import orjson
+except ImportError:
+    orjson = None
+try: #Optional, binary storage format
+    import msgpack
+except ImportError:
+    msgpack = None
+try: #Optional, the stock market ticks every price in one vectorized step with it
+    import numpy
+except ImportError:
+    numpy = None
+try: #Optional, snapshots are gzipped without it
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.path.join(BASE_DIR, "data")
@@ -17,63 +62,1482 @@ SETTINGS_FILE = os.path.join(DATA_DIR, "settings.json")
 USERS_FILE = os.path.join(DATA_DIR, "users.json")
 SHOP_FILE = os.path.join(DATA_DIR, "shop.json")
 PREDICTIONS_FILE = os.path.join(DATA_DIR, "predictions.json")
+STOCKS_FILE = os.path.join(DATA_DIR, "stocks.json")
+ECONOMY_FILE = os.path.join(DATA_DIR, "economy.json")
 
 load_dotenv()
 
 TOKEN = os.getenv("DISCORD_TOKEN")
 
-FILEPATHS = [SETTINGS_FILE, USERS_FILE, SHOP_FILE, PREDICTIONS_FILE]
-LIST_OF_COMMANDS = ["!bet", "!shop", "!wallet", "!buy", "!sell", "!predictions", "!auction_item", "!auctions", "!bid", "!inventory", "!my_bets", "!reward", "!create_auction", "!create_prediction", "!close_prediction", "!resolve_prediction", "!create_shop_item", "!delete_shop_item", "!edit_shop_item", "!reset_user_inventory", "!reset_user", "!purge_deprecated_users", "!set_default_channel", "!toggle_command"]
+STORAGE_FORMATS = ["json", "pretty", "msgpack"] #json is compact, pretty is the old indented layout
+STORAGE_FORMAT = os.getenv("STORAGE_FORMAT", "json").lower()
+MSGPACK_MARKER = b"\x00CBMSGPACK1\n" #Starts every msgpack data file, JSON files always start with "{"
+if STORAGE_FORMAT not in STORAGE_FORMATS:
+    print(f"[red]Unknown STORAGE_FORMAT {STORAGE_FORMAT}, using json.")
+    STORAGE_FORMAT = "json"
+elif STORAGE_FORMAT == "msgpack" and not msgpack:
+    print("[yellow]STORAGE_FORMAT is msgpack but msgpack is not installed, data will be written as json.")
+
+FILEPATHS = [SETTINGS_FILE, USERS_FILE, SHOP_FILE, PREDICTIONS_FILE, STOCKS_FILE, ECONOMY_FILE]
+SNAPSHOT_INTERVAL_MINUTES = float(os.getenv("SNAPSHOT_INTERVAL_MINUTES", "60")) #0 disables scheduled snapshots
+SNAPSHOT_KEEP = int(os.getenv("SNAPSHOT_KEEP", "24")) #Generations kept, the oldest are deleted
+SNAPSHOT_FORMAT = "commerce-snapshot"
+class StateLock(asyncio.Lock):
+    """asyncio.Lock that publishes the writes made while it was held to fast reads, all together, as it's released."""
+    def release(self):
+        publish_read_state()
+        super().release()
+
+STATE_LOCK = StateLock() #Held while a transaction commits, by background jobs while they change the data files and while a snapshot reads them
+
+def parse_shard_ids(text, shard_count): #"0,2" or "0-3", empty means every shard
+    shard_ids = set()
+    for part in text.replace(" ", "").split(","):
+        if "-" in part:
+            first, last = part.split("-", 1)
+            shard_ids.update(range(int(first), int(last) + 1))
+        elif part:
+            shard_ids.add(int(part))
+    return sorted(shard_ids) or list(range(shard_count))
+
+STORAGE_BACKENDS = ["files", "sqlite"] #files keeps one JSON file per data file, sqlite one row per (file, server) shared by every shard process
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "files").lower()
+STORAGE_DB = os.getenv("STORAGE_DB", os.path.join(DATA_DIR, "commerce.db"))
+STORE = None #SqliteStore, opened on first use
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0")) #0 runs unsharded
+SHARD_IDS = parse_shard_ids(os.getenv("SHARD_IDS", ""), SHARD_COUNT) #Shards this process connects and owns the servers of
+SHARD_OWNER = os.getenv("SHARD_OWNER") or (f"shards {",".join(map(str, SHARD_IDS))} of {SHARD_COUNT}" if SHARD_COUNT else "unsharded")
+LEASE_OWNER = f"{SHARD_OWNER} @ {socket.gethostname()} pid {os.getpid()} {uuid.uuid4().hex[:8]}" #Unique per process, so two processes given the same shards can't both hold a server
+GUILD_LEASE_SECONDS = 60 #A server whose owner hasn't checked in for this long can be claimed by another process
+MIGRATE_READ_BYTES = 1024 * 1024 #python bot.py migrate reads the data files this much at a time
+MIGRATE_CHUNK_BYTES = 32 * 1024 * 1024 #and commits to the store after this much, --chunk-mb
+MIGRATE_PROGRESS_SECONDS = 2
+MIGRATE_MAX_PROBLEMS = 20 #Problems listed per file
+SHARD_FOLDER = "" if SHARD_OWNER == "unsharded" else re.sub(r"[^A-Za-z0-9]+", "-", SHARD_OWNER).strip("-") #Subfolder for what each shard process keeps to itself
+SNAPSHOT_DIR = os.path.normpath(os.path.join(DATA_DIR, "snapshots", SHARD_FOLDER)) #Per process, so one shard never prunes or restores another's snapshots
+LEDGER_DIR = os.path.normpath(os.path.join(DATA_DIR, "ledger", SHARD_FOLDER)) #One ledger per process, servers never share one
+LEDGER_SEGMENT_BYTES = int(os.getenv("LEDGER_SEGMENT_MB", "64")) * 1024 * 1024 #A new segment file is started once the current one would grow past this
+LEDGER_RECORD = struct.Struct("<dQQqqHxxIq") #time, server_id, user_id, amount, balance after, kind, reference, previous entry of the same user (-1 for none)
+LEDGER_KINDS = { #Position is the kind code written to disk, only ever append to this
+    "open": "Starting balance",
+    "reward": "Reward",
+    "buy": "Bought item",
+    "sell": "Sold item",
+    "bet": "Bet on prediction",
+    "payout": "Won prediction",
+    "auction_won": "Won auction",
+    "auction_sold": "Sold at auction",
+    "stock_buy": "Bought stock",
+    "stock_sell": "Sold stock",
+    "stock_payout": "Stock delisted",
+    "import": "Imported balance",
+    "refund": "Bet refunded",
+    "close": "Wallet removed",
+    "auction_sink": "Won server auction",
+}
+LEDGER_KIND_CODES = {kind: code for code, kind in enumerate(LEDGER_KINDS)}
+LEDGER_KIND_NAMES = list(LEDGER_KINDS)
+LEDGER_PAGE_SIZE = 10
+LEDGER_MAX_PAGE = 100 #!history follows one pointer per entry, deeper pages aren't offered
+LEDGER_FLUSH_SECONDS = 1
+LEDGER_INDEX_SECONDS = 300 #How often the per-user index is checkpointed, entries after it are rescanned on startup
+LEDGER = None #Ledger, opened on first use
+ARCHIVE_DIR = os.path.join(DATA_DIR, "archive") #One folder per server, only the process owning the server writes to it
+ARCHIVE_SEGMENT_BYTES = int(os.getenv("ARCHIVE_SEGMENT_KB", "1024")) * 1024 #Uncompressed records per segment file, the most one lookup decompresses
+ARCHIVE_FRAME = struct.Struct("<I") #Length of the zlib compressed block of JSON lines that follows
+ARCHIVE_KINDS = ["prediction", "auction"]
+ARCHIVE_PAGE_SIZE = 10
+ARCHIVE_INDEX_SECONDS = 300 #How often full segments are recompressed and given their .ids file, segments without one are rescanned on open
+ARCHIVE_KEY = re.compile(rb'\{"kind":("[^"]*"),"id":("(?:[^"\\]|\\.)*")') #Every record line starts with its kind and id
+ARCHIVES = {} #{server_id: Archive}, opened on first use
+ARCHIVES_OPENING = {} #{server_id: asyncio.Task} of archives being opened in a thread
+if STORAGE_BACKEND not in STORAGE_BACKENDS:
+    print(f"[red]Unknown STORAGE_BACKEND {STORAGE_BACKEND}, using files.")
+    STORAGE_BACKEND = "files"
+LIST_OF_COMMANDS = ["!bet", "!shop", "!wallet", "!buy", "!sell", "!predictions", "!auction_item", "!auctions", "!bid", "!inventory", "!my_bets", "!leaderboard", "!reward", "!create_auction", "!create_prediction", "!close_prediction", "!resolve_prediction", "!create_shop_item", "!delete_shop_item", "!edit_shop_item", "!reset_user_inventory", "!reset_user", "!purge_deprecated_users", "!set_default_channel", "!toggle_command", "!stats", "!profile", "!stocks", "!buy_stock", "!sell_stock", "!create_stock", "!delete_stock", "!history", "!economy", "!export", "!import", "!prediction_history", "!auction_history"]
 USER_COMMANDS = []
 MODERATOR_COMMANDS = []
 DEBUG = False
 
-COMMAND_QUEUE = []
-
+COMMAND_QUEUE = [] #(message, enqueued_at), a command stays queued until it has finished
+COMMAND_WORKERS = max(1, int(os.getenv("COMMAND_WORKERS", "1"))) #Commands run at once, each in its own transaction. A user's own commands still run one at a time, in order
+RUNNING_COMMANDS = set() #id() of the queued messages a worker has started
+COMMAND_WAKEUP = asyncio.Event() #Set when a command is queued or finishes, idle workers wait on it
+BOOTSTRAPPED_SERVERS = set() #Servers whose default data is known to exist, checked before every message
+AUCTION_TIMERS = {} #{(server_id, auction_id): asyncio.Task}, one timer per live auction
+STARTED = False #on_ready fires again on every reconnect, startup only runs once per process
+PROCESS_STARTED_AT = time.perf_counter()
+
+DEFAULT_USER_COMMANDS = {
+    "!bet": True,
+    "!shop": True,
+    "!wallet": True,
+    "!buy": True,
+    "!sell": True,
+    "!predictions": True,
+    "!auction_item": True,
+    "!auctions": True,
+    "!bid": True,
+    "!inventory": True,
+    "!my_bets": True,
+    "!leaderboard": True,
+    "!stocks": True,
+    "!buy_stock": True,
+    "!sell_stock": True,
+    "!history": True,
+    "!prediction_history": True,
+    "!auction_history": True
+}
+DEFAULT_PRIVILEGED_COMMANDS = {
+    "!reward": True,
+    "!create_auction": True,
+    "!create_prediction": True,
+    "!close_prediction": True,
+    "!resolve_prediction": True,
+    "!create_shop_item": True,
+    "!delete_shop_item": True,
+    "!edit_shop_item": True,
+    "!reset_user_inventory": True,
+    "!reset_user": True,
+    "!purge_deprecated_users": True,
+    "!set_default_channel": True,
+    "!toggle_command": True,
+    "!stats": True,
+    "!profile": True,
+    "!create_stock": True,
+    "!delete_stock": True,
+    "!economy": True,
+    "!export": True,
+    "!import": True
+}
+
+REWARD_RECIPIENT_PATTERN = re.compile(r"<@!?(\d+)>|<@&(\d+)>|\(([^)]+)\)|(@?everyone\b)|(\d+)\b")
+
+BATCH_MAX_COMMANDS = 20
+CURRENT_TRANSACTION = contextvars.ContextVar("CURRENT_TRANSACTION", default = None)
+VERSIONED_RECORDS = { #Per data file, the sections of a server whose entries are records with their own "version", checked one by one when commits overlap
+    "users.json": [()],
+    "shop.json": [("Items",), ("Auctions",)],
+    "predictions.json": [("Predictions",)],
+}
+TRANSACTION_RETRIES = int(os.getenv("TRANSACTION_RETRIES", "2")) #Times a command is run again after another commit changed the same records first, before it runs holding STATE_LOCK
+TRANSACTION_BACKOFF_SECONDS = 0.001 #The first retry waits up to this long, doubling with every further conflict up to 16 times as long
+MISSING = object() #A record or section that isn't there
+CURRENT_COMMAND = contextvars.ContextVar("CURRENT_COMMAND", default = "background") #Label for metrics recorded outside of a command
+
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "500")) #Commands slower than this get their trace logged
+TRACE_LOG_FILE = os.path.join(DATA_DIR, "slow_commands.log")
+PROFILE_DIR = os.path.join(DATA_DIR, "profiles")
+CURRENT_SPAN = contextvars.ContextVar("CURRENT_SPAN", default = None)
+PROFILER = {"profiler": None, "remaining": 0, "profiled": 0, "channel_id": None} #Set by !profile
+PROFILE_LOCK = asyncio.Lock() #While !profile is on, queued commands take turns, cProfile can only be enabled once at a time
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0")) #0 disables the Prometheus endpoint
+METRICS_SERVER = None
+LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+TIMER_LAG_BUCKETS = [0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30, 60, 300]
+
+READ_COMMANDS = ["!shop", "!wallet", "!predictions", "!auctions", "!inventory", "!my_bets", "!leaderboard", "!stocks", "!history", "!prediction_history", "!auction_history", "!help", "!commands"] #Everything else is a mutation or a moderator command
+FAST_READS = os.getenv("FAST_READS", "on").lower() not in ("off", "false", "0", "no") #off sends every command through the command queue
+FAST_READ_COMMANDS = ["!wallet", "!inventory", "!my_bets", "!predictions", "!auctions", "!prediction_history", "!auction_history"] #Answered from READ_STATE without waiting in the command queue
+FAST_READ_FILES = [SETTINGS_FILE, USERS_FILE, PREDICTIONS_FILE, SHOP_FILE] #What those commands load
+READ_STATE = {} #{path: encoded or decoded data} of every data file as of the last time STATE_LOCK was released, replaced as a whole and never changed in place
+READ_STATE_PENDING = {} #{path: encoded data} written while STATE_LOCK is held, published when it's released
+READ_DECODED = {} #{path: (encoded, decoded)} so fast reads and transactions decode each published file once
+CURRENT_READ_VIEW = contextvars.ContextVar("CURRENT_READ_VIEW", default = None)
+RATE_LIMITS = { #{command_class: {scope: (burst, per_minute)}}, per_minute 0 turns the limit off. Overridden by RATE_LIMIT_<CLASS>=user_burst:per_minute,guild_burst:per_minute
+    "read": {"user": (5, 12), "guild": (60, 300)},
+    "write": {"user": (10, 30), "guild": (120, 600)},
+    "moderator": {"user": (10, 30), "guild": (0, 0)},
+}
+for command_class in RATE_LIMITS:
+    override = os.getenv(f"RATE_LIMIT_{command_class.upper()}")
+    if override:
+        for scope, limit in zip(("user", "guild"), override.split(",")):
+            burst, per_minute = limit.split(":")
+            RATE_LIMITS[command_class][scope] = (int(burst), float(per_minute))
+RATE_LIMIT_NOTICE_SECONDS = 30 #At most one "slow down" reply per user in this window
+RATE_BUCKETS = {} #{(scope, id, command_class): TokenBucket}
+RATE_BUCKET_LIMIT = 50_000 #Full buckets are dropped once there are more than this
+THROTTLE_NOTICES = {} #{(server_id, user_id): time of the last "slow down" reply}
+
+DEPARTURE_GRACE_HOURS = float(os.getenv("DEPARTURE_GRACE_HOURS", "24")) #Users who left are purged this long after leaving, unless they come back
+MEMBERSHIP_SWEEP_SECONDS = 300
+PENDING_DEPARTURES = {} #{server_id: {user_id: departed_at ISO string, or None if they rejoined}}, applied to users.json by the sweep
+DEPARTED_USERS = {} #{server_id: {user_id: departed_at}} of users marked in users.json, so the sweep knows when there's work without loading it
+PURGE_JOB_DIR = os.path.join(DATA_DIR, "purge_jobs") #One file per running !purge_deprecated_users job, so it can resume after a restart
+PURGE_CHUNK_SIZE = 1000 #Members fetched per REST call
+PURGE_PROGRESS_SECONDS = 10 #How often the progress message is edited
+PURGE_JOBS = {} #{server_id: asyncio.Task}
+
+WALLET_SKETCHES = {} #{server_id: WalletSketch}, built and dropped together with LEADERBOARDS
+WALLET_SKETCH_STEPS = 4 #Buckets per doubling, so a bucket spans about 19% of its value
+WALLET_SKETCH_BUCKETS = 256 #Bucket 0 holds empty wallets, the rest cover $1 up to 2^63
+ECONOMY_FLOWS = {} #{server_id: {kind: [count, money in, money out]}} since the last flush to economy.json
+ECONOMY_TRANSFER_KINDS = ["bet", "payout", "refund", "auction_won", "auction_sold"] #Money moving between users or through a prediction's pool, every other kind creates or removes money
+ECONOMY_POOL_KINDS = { #Money a prediction's pool gains or loses without a wallet changing
+    "bonus_pool": "Prediction bonus pools",
+    "unclaimed_pool": "Bets nobody won",
+}
+ECONOMY_FLUSH_SECONDS = 300
+ECONOMY_ROLLUP_HOURS = int(os.getenv("ECONOMY_ROLLUP_HOURS", "720")) #Hourly rollups kept per server, 30 days by default
+ECONOMY_MAX_HOURS = 24 * 7 #Longest window !economy reports on
+
+EXPORT_TABLES = { #!export table -> columns, also the columns !import accepts
+    "users": ["user_id", "display_name", "user_name", "wallet", "total_currency_bet", "total_currency_won", "total_currency_lost", "profit", "bets_won", "bets_lost"],
+    "inventory": ["user_id", "item_id", "name", "quantity", "value"],
+    "shop": ["item_id", "name", "price", "quantity", "refresh_time", "active"],
+    "predictions": ["prediction_id", "title", "open", "option_id", "option", "user_id", "name", "amount"], #One row per bet
+}
+EXPORT_FORMATS = ["csv", "jsonl"]
+EXPORT_ATTACHMENT_BYTES = 8 * 1024 * 1024 #Exports bigger than this are gzipped, Discord's smallest upload limit
+EXPORT_CHUNK_BYTES = 1024 * 1024
+EXPORT_YIELD_ROWS = 10_000 #Exports and imports give the event loop a turn this often
+IMPORT_MAX_BYTES = 256 * 1000 * 1000
+IMPORT_MAX_ERRORS = 10 #Problems listed when an import is refused
+PREPARED_IMPORT = contextvars.ContextVar("PREPARED_IMPORT", default = None) #What prepare_import read for the !import being run
+
+NAME_UPDATES = {} #{server_id: {user_id: (display_name, user_name)}}, written to users.json in one batch by the name flush
+NAME_FLUSH_SECONDS = 60
+
+STOCK_TICK_SECONDS = float(os.getenv("STOCK_TICK_SECONDS", "1")) #How often every price moves
+STOCK_SAVE_SECONDS = 60 #How often current prices are written to stocks.json
+STOCK_HISTORY_SECONDS = 300 #One chart point per ticker this often
+STOCK_HISTORY_LENGTH = 288 #Chart points kept per ticker, 24 hours at 5 minutes
+STOCK_SYMBOL_PATTERN = re.compile(r"^[A-Z]{1,6}$")
+STOCK_DEFAULT_VOLATILITY = 5.0 #Percent per hour
+STOCK_DEFAULT_REVERSION = 0.1 #Per hour, how strongly prices are pulled back to their mean
+SPARKLINE_BLOCKS = "▁▂▃▄▅▆▇█"
+STOCKS_PAGE_SIZE = 25
+MARKET_TICK_BUCKETS = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5]
+
+LEADERBOARD_STATS = {"wallet": "wallet", "profit": "profit", "wins": "bets_won"} #!leaderboard argument -> users.json field
+LEADERBOARD_PAGE_SIZE = 10
+SORTED_BLOCK_SIZE = 1000 #Keys per block of a SortedKeys, a block is split in two once it holds twice as many
+LEADERBOARDS = {} #{server_id: {board_name: RankIndex}}
+AUCTION_INDEXES = {} #{server_id: AuctionIndex} of live auctions, built from shop.json the first time a server's is needed
+AUCTION_SORTS = {"ending": "Ending soonest", "price": "Lowest price", "bids": "Most bids"} #!auctions orderings, the first is the default
+AUCTION_PAGE_SIZE = 10
+AUCTION_SORT_SHARE = 16 #Filtered auctions are sorted on their own when they're at most 1/16 of the server's, otherwise the sort order is walked
+OPEN_BETS = {} #{server_id: {user_id: {prediction_id, ...}}} of every bet on a prediction not yet resolved, built from predictions.json the first time a server's is needed
+
+
+TEXT_COMMANDS = os.getenv("TEXT_COMMANDS", "on").lower() not in ("off", "false", "0", "no") #off leaves only slash commands, and the message content intent isn't needed
+SLASH_COMMANDS_HASH_FILE = os.path.join(DATA_DIR, "slash_commands.sha256") #Slash commands are only synced with Discord when their definitions change
+AUTOCOMPLETE = {} #{server_id: {"predictions": {id: (title, options, open)}, "items": {id: name}, "auctions": {id: label}}}, refreshed whenever shop.json or predictions.json is written
+AUTOCOMPLETE_LIMIT = 25 #Most choices Discord accepts
 
 intents = discord.Intents.default()
 intents.guilds = True
-intents.messages = True
-intents.message_content = True
+intents.messages = TEXT_COMMANDS
+intents.message_content = TEXT_COMMANDS
 intents.members = True
-bot = commands.Bot(command_prefix = "!", intents = intents)
+if SHARD_COUNT:
+    bot = commands.AutoShardedBot(command_prefix = "!", intents = intents, shard_count = SHARD_COUNT, shard_ids = SHARD_IDS)
+else:
+    bot = commands.Bot(command_prefix = "!", intents = intents)
 
-async def add_server_to_jsons(server_id):
-    settings = await async_load_json(SETTINGS_FILE)
+class TransactionConflict(Exception):
+    pass
+
+class StateTransaction:
+    """
+    In-memory view of the data files for one command, or every command in a batch.
+    Each file is read from the last committed state once, saves only replace the in-memory copy, and commit() writes
+    every changed file once. Replies meant for channel_id are collected so a batch can answer with one message,
+    everything else sent waits in the outbox until the commit.
+    Commits are optimistic. Every user, item, auction and prediction carries a version, and a commit that finds a record
+    it changed was committed by someone else since it was read raises TransactionConflict instead of overwriting it.
+    Changes to different records of the same file are merged.
+    """
+    def __init__(self, channel_id = None, locked = False):
+        self.channel_id = channel_id
+        self.locked = locked #The caller holds STATE_LOCK, so nothing else commits in between
+        self.files = {} #{path: data}
+        self.read = {} #{path: (committed content, data as read)} for the commit to compare against
+        self.dirty = set()
+        self.replies = []
+        self.failures = 0 #Replies sent with send_error, a batch line that adds one failed
+        self.embeds = []
+        self.attachments = [] #(path, file_name, content) of temporary files to send once the batch commits
+        self.outbox = [] #(send function, args) for everything sent elsewhere, sent after the commit
+        self.after_commit = [] #Callbacks that must not run if the batch is rolled back, e.g auction timers
+        self.permissions = {} #{user_id: bool}, one permission lookup per batch
+        self.closed = False
+
+    def committed(self):
+        return {**READ_STATE, **READ_STATE_PENDING} if self.locked else READ_STATE
+
+    async def load(self, path):
+        if path not in self.files:
+            if path not in FILEPATHS:
+                self.files[path] = await read_json_file(path)
+                return copy_data(self.files[path])
+            await seed_read_state([path], self.locked)
+            content = self.committed()[path]
+            self.read[path] = (content, decode_published(path, content))
+            self.files[path] = self.read[path][1] #Shared with fast reads, never changed in place
+            return decode_data(content) if isinstance(content, bytes) else copy_data(content)
+        return copy_data(self.files[path]) #Copy, so unsaved changes never leak into the next command
+
+    def save(self, path, data):
+        self.files[path] = copy_data(data) #Same key normalization as a round trip through the file
+        self.dirty.add(path)
+
+    async def commit(self):
+        self.closed = True
+        if self.dirty:
+            if self.locked:
+                await self.write()
+            else:
+                async with STATE_LOCK:
+                    await self.write()
+        for callback in self.after_commit:
+            callback()
+
+    async def write(self): #Call holding STATE_LOCK, every file is checked before any is written
+        committed = self.committed()
+        writes = {}
+        for path in self.dirty:
+            if path not in self.read: #Not a data file
+                writes[path] = self.files[path]
+                continue
+            content, base = self.read[path]
+            sections = VERSIONED_RECORDS.get(os.path.basename(path), [])
+            changes = diff_records(base, self.files[path], sections)
+            if committed[path] is content: #Nothing else committed this file since it was read
+                data = self.files[path]
+            else:
+                data = decode_published(path, committed[path])
+                for keys in changes:
+                    current, original = lookup_record(data, keys), lookup_record(base, keys)
+                    if (record_version(current) != record_version(original)) if is_record(keys, sections) else current != original:
+                        raise TransactionConflict(f"Another command changed {os.path.basename(path)} {"/".join(keys)} first.")
+                data, copied = dict(data), set() #The published data is shared, only the dicts above each change are copied
+            for keys, value in changes.items():
+                if is_record(keys, sections) and isinstance(value, dict):
+                    value["version"] = (record_version(lookup_record(base, keys)) or 0) + 1
+                if data is not self.files[path]:
+                    store_record(data, keys, value, copied)
+            writes[path] = data
+        await asyncio.gather(*(write_json_file(path, data) for path, data in writes.items()))
+        for path, data in writes.items():
+            if path in READ_STATE_PENDING: #Published when STATE_LOCK is released, the next command needn't decode it again
+                READ_DECODED[path] = (READ_STATE_PENDING[path], data)
+
+    async def send_outbox(self):
+        for send, args in self.outbox:
+            await send(*args)
+        self.outbox.clear()
+
+    def rollback(self):
+        self.closed = True
+        self.after_commit.clear()
+        for path, file_name, content in self.attachments + [args[:3] for send, args in self.outbox if send is send_file]:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+        self.attachments.clear()
+        self.outbox.clear()
+
+def diff_records(base, data, sections):
+    """
+    {keys: new value, or MISSING if removed} for every part of data that differs from base. keys is a path from the
+    server id: versioned records are compared one by one, anything else by its top level entry in the server.
+    """
+    changes = {}
+    def walk(keys, level, old, new):
+        for key in old.keys() | new.keys():
+            old_value, new_value = old.get(key, MISSING), new.get(key, MISSING)
+            if old_value == new_value:
+                continue
+            inner = level + (key,)
+            if level not in sections and isinstance(old_value, dict) and isinstance(new_value, dict) and any(section[:len(inner)] == inner for section in sections):
+                walk(keys + (key,), inner, old_value, new_value)
+            else:
+                changes[keys + (key,)] = new_value
+    for server_id in base.keys() | data.keys():
+        old, new = base.get(server_id, MISSING), data.get(server_id, MISSING)
+        if old == new:
+            continue
+        if sections and isinstance(old, dict) and isinstance(new, dict):
+            walk((server_id,), (), old, new)
+        else:
+            changes[(server_id,)] = new
+    return changes
+
+def lookup_record(data, keys):
+    for key in keys:
+        if not isinstance(data, dict) or key not in data:
+            return MISSING
+        data = data[key]
+    return data
+
+def store_record(data, keys, value, copied): #data itself is a copy, the dicts below it are copied the first time they're changed
+    for key in keys[:-1]:
+        child = data.get(key)
+        if child is None or id(child) not in copied:
+            child = dict(child or {})
+            data[key] = child
+            copied.add(id(child))
+        data = child
+    if value is MISSING:
+        data.pop(keys[-1], None)
+    else:
+        data[keys[-1]] = value
+
+def is_record(keys, sections):
+    return len(keys) > 1 and keys[1:-1] in sections
+
+def record_version(record):
+    return record.get("version", 0) if isinstance(record, dict) else None
+
+async def run_transaction(run, channel_id = None, server_id = None):
+    """
+    Runs run() in a StateTransaction and commits it. If another commit changed the same records first, whatever run()
+    did is rolled back and it runs again on the newer data. After TRANSACTION_RETRIES conflicts it runs once more
+    holding STATE_LOCK, which nothing can commit past. Sends held in the outbox go out after the commit.
+    Returns the transaction, which run() may have rolled back itself.
+    """
+    for attempt in range(TRANSACTION_RETRIES + 1):
+        locked = attempt == TRANSACTION_RETRIES
+        transaction = StateTransaction(channel_id, locked)
+        token = CURRENT_TRANSACTION.set(transaction)
+        try:
+            async with STATE_LOCK if locked else contextlib.nullcontext():
+                await run()
+                if not transaction.closed:
+                    await transaction.commit()
+        except TransactionConflict:
+            transaction.rollback()
+            METRICS.inc("commerce_transaction_conflicts_total", command = CURRENT_COMMAND.get())
+            drop_server_caches(server_id)
+            await asyncio.sleep(random.uniform(0, TRANSACTION_BACKOFF_SECONDS * 2 ** min(attempt, 4)))
+            continue
+        except BaseException:
+            transaction.rollback()
+            drop_server_caches(server_id)
+            raise
+        finally:
+            CURRENT_TRANSACTION.reset(token)
+        await transaction.send_outbox()
+        return transaction
+
+@contextlib.asynccontextmanager
+async def locked_transaction():
+    """For background jobs holding STATE_LOCK: their saves are committed together on exit, with record versions. Nothing else can commit meanwhile, so they never conflict"""
+    transaction = StateTransaction(locked = True)
+    token = CURRENT_TRANSACTION.set(transaction)
+    try:
+        yield transaction
+        await transaction.commit()
+    except BaseException:
+        transaction.rollback()
+        raise
+    finally:
+        CURRENT_TRANSACTION.reset(token)
+    await transaction.send_outbox()
+
+def drop_server_caches(server_id): #After a rollback, rebuilt from users.json on next use
+    if server_id is not None:
+        LEADERBOARDS.pop(str(server_id), None)
+        WALLET_SKETCHES.pop(str(server_id), None)
+
+class GuildOwnershipError(Exception):
+    pass
+
+class SqliteStore:
+    """
+    Keeps every data file as one row per (file, server) in a SQLite database in WAL mode, so several shard processes can share it.
+    Each process only reads and writes the servers on its shards, and only rows that changed are written.
+    Servers are leased to one owner in guild_owners. Writing a server another live owner holds raises GuildOwnershipError.
+    """
+    def __init__(self, path, owner):
+        self.path = path
+        self.owner = owner
+        self.hashes = {} #{(file, server_id): digest} of what was last read or written, unchanged servers are skipped on save
+        self.lock = threading.Lock() #One connection, used from worker threads one at a time
+        os.makedirs(os.path.dirname(path) or ".", exist_ok = True)
+        self.connection = sqlite3.connect(path, timeout = 30, isolation_level = None, check_same_thread = False)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS state (file TEXT NOT NULL, server_id TEXT NOT NULL, data BLOB NOT NULL, PRIMARY KEY (file, server_id));
+            CREATE TABLE IF NOT EXISTS guild_owners (server_id TEXT PRIMARY KEY, owner TEXT NOT NULL, heartbeat REAL NOT NULL);
+        """)
+
+    @staticmethod
+    def digest(content):
+        return hashlib.blake2b(content, digest_size = 16).digest()
+
+    @staticmethod
+    def owned_rows(): #SQL condition and parameters matching the rows of this process's servers
+        if not SHARD_COUNT:
+            return "1", []
+        return f"((CAST(server_id AS INTEGER) >> 22) % ?) IN ({",".join("?" * len(SHARD_IDS))})", [SHARD_COUNT, *SHARD_IDS]
+
+    def load(self, file_name):
+        """Returns ({server_id: data}, bytes_read) for the servers this process owns"""
+        condition, params = self.owned_rows()
+        with self.lock:
+            rows = self.connection.execute(f"SELECT server_id, data FROM state WHERE file = ? AND {condition}", [file_name, *params]).fetchall()
+        data = {}
+        for server_id, content in rows:
+            self.hashes[(file_name, server_id)] = self.digest(content)
+            data[server_id] = decode_data(content)
+        return data, sum(len(content) for _, content in rows)
+
+    def save(self, file_name, data, storage_format = None):
+        """Writes every owned server in data whose content changed, in one transaction. Returns bytes written"""
+        changed = []
+        for server_id, server_data in data.items():
+            server_id = str(server_id)
+            if not owns_server(server_id):
+                continue
+            content = encode_data(server_data, storage_format)
+            digest = self.digest(content)
+            if self.hashes.get((file_name, server_id)) != digest:
+                changed.append((file_name, server_id, content, digest))
+        if not changed:
+            return 0
+        now = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                for server_id in {row[1] for row in changed}:
+                    self.take_lease(server_id, now)
+                self.connection.executemany(
+                    "INSERT INTO state (file, server_id, data) VALUES (?, ?, ?) ON CONFLICT (file, server_id) DO UPDATE SET data = excluded.data",
+                    [row[:3] for row in changed]
+                )
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+        for file_name, server_id, content, digest in changed:
+            self.hashes[(file_name, server_id)] = digest
+        return sum(len(row[2]) for row in changed)
+
+    def take_lease(self, server_id, now): #Call inside a write transaction
+        row = self.connection.execute("SELECT owner, heartbeat FROM guild_owners WHERE server_id = ?", (server_id,)).fetchone()
+        if row and row[0] != self.owner and now - row[1] < GUILD_LEASE_SECONDS:
+            raise GuildOwnershipError(f"Server {server_id} is owned by {row[0]}")
+        if not row or row[0] != self.owner:
+            self.connection.execute("INSERT OR REPLACE INTO guild_owners (server_id, owner, heartbeat) VALUES (?, ?, ?)", (server_id, self.owner, now))
+            for key in [key for key in self.hashes if key[1] == server_id]: #Another owner may have written it since
+                del self.hashes[key]
+
+    def claim(self, server_ids):
+        """Leases server_ids to this process. Returns {server_id: current_owner} for the ones another live process holds"""
+        refused = {}
+        now = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                for server_id in server_ids:
+                    try:
+                        self.take_lease(str(server_id), now)
+                    except GuildOwnershipError:
+                        refused[str(server_id)] = self.connection.execute("SELECT owner FROM guild_owners WHERE server_id = ?", (str(server_id),)).fetchone()[0]
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+        return refused
+
+    def heartbeat(self):
+        with self.lock:
+            self.connection.execute("UPDATE guild_owners SET heartbeat = ? WHERE owner = ?", (time.time(), self.owner))
+
+    def release(self): #Gives up every lease on a clean shutdown, so a restarted process doesn't wait for them to expire
+        with self.lock:
+            self.connection.execute("DELETE FROM guild_owners WHERE owner = ?", (self.owner,))
+
+    def replace_all(self, files):
+        """
+        Replaces every row of this process's servers with files, (file_name, {server_id: data}) pairs that can be streamed,
+        in one transaction. Used by restore and import. Other shards' servers are left alone, snapshots never hold them.
+        """
+        condition, params = self.owned_rows()
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.execute(f"DELETE FROM state WHERE {condition}", params)
+                for file_name, data in files:
+                    self.connection.executemany(
+                        "INSERT INTO state (file, server_id, data) VALUES (?, ?, ?)",
+                        ((file_name, str(server_id), encode_data(server_data)) for server_id, server_data in data.items() if owns_server(server_id))
+                    )
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.hashes.clear()
+
+class Span:
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.start = time.perf_counter()
+        self.end = None
+        self.children = []
+
+    @property
+    def duration_ms(self):
+        return ((self.end or time.perf_counter()) - self.start) * 1000
+
+    def to_record(self, trace_start = None):
+        trace_start = self.start if trace_start is None else trace_start
+        record = {"name": self.name, "start_ms": round((self.start - trace_start) * 1000, 3), "duration_ms": round(self.duration_ms, 3)}
+        if self.attributes:
+            record["attributes"] = self.attributes
+        if self.children:
+            record["children"] = [child.to_record(trace_start) for child in self.children]
+        return record
+
+@contextlib.contextmanager
+def trace_span(name, root = False, **attributes):
+    """
+    Times a block as a child of the current span. Outside of a trace this does nothing unless root is True,
+    which starts a new trace (one per command dispatch or auction timer).
+    """
+    parent = CURRENT_SPAN.get()
+    if parent is None and not root:
+        yield None
+        return
+    span = Span(name, attributes)
+    if parent is not None and not root:
+        parent.children.append(span)
+    token = CURRENT_SPAN.set(span)
+    try:
+        yield span
+    finally:
+        span.end = time.perf_counter()
+        CURRENT_SPAN.reset(token)
+
+def traced(name): #Decorator version of trace_span for whole coroutines
+    def decorator(function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            with trace_span(name):
+                return await function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets #Upper bounds, the +Inf bucket is implied
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, fraction): #Upper bound of the bucket the quantile falls in
+        if not self.count:
+            return 0.0
+        target = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return self.buckets[index] if index < len(self.buckets) else float("inf")
+        return float("inf")
+
+class MetricsRegistry:
+    """Counters, gauges and histograms with labels, rendered in the Prometheus text format."""
+    def __init__(self):
+        self.descriptions = {} #{name: (type, help)}
+        self.counters = {} #{(name, labels): value}
+        self.histograms = {} #{(name, labels): Histogram}
+        self.gauges = {} #{name: callback returning a number}
+
+    def describe(self, name, metric_type, description):
+        self.descriptions[name] = (metric_type, description)
+
+    def inc(self, name, amount = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, buckets = LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        if key not in self.histograms:
+            self.histograms[key] = Histogram(buckets)
+        self.histograms[key].observe(value)
+
+    def gauge(self, name, callback):
+        self.gauges[name] = callback
+
+    def total(self, name, **filters): #Sum of a counter over every label set matching filters
+        return sum(value for (key, labels), value in self.counters.items() if key == name and all(dict(labels).get(k) == v for k, v in filters.items()))
+
+    def series(self, name): #[(labels_dict, value or Histogram)]
+        source = self.histograms if self.descriptions.get(name, ("counter",))[0] == "histogram" else self.counters
+        return [(dict(labels), value) for (key, labels), value in source.items() if key == name]
+
+    def render(self):
+        lines = []
+        for name, (metric_type, description) in self.descriptions.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            if metric_type == "gauge" and name in self.gauges:
+                lines.append(f"{name} {self.gauges[name]()}")
+            elif metric_type == "histogram":
+                for labels, histogram in self.series(name):
+                    cumulative = 0
+                    for bound, count in zip(self.format_bounds(histogram.buckets), histogram.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{self.format_labels({**labels, "le": bound})} {cumulative}")
+                    lines.append(f"{name}_sum{self.format_labels(labels)} {histogram.sum}")
+                    lines.append(f"{name}_count{self.format_labels(labels)} {histogram.count}")
+            else:
+                for labels, value in self.series(name):
+                    lines.append(f"{name}{self.format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def format_bounds(buckets):
+        return [str(bound) for bound in buckets] + ["+Inf"]
+
+    @staticmethod
+    def format_labels(labels):
+        if not labels:
+            return ""
+        escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for value in labels.values())
+        return "{" + ",".join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + "}"
+
+METRICS = MetricsRegistry()
+METRICS.describe("commerce_commands_total", "counter", "Commands processed from the command queue.")
+METRICS.describe("commerce_command_errors_total", "counter", "Commands that raised an exception.")
+METRICS.describe("commerce_command_duration_seconds", "histogram", "Time spent handling a command once it leaves the queue.")
+METRICS.describe("commerce_command_queue_wait_seconds", "histogram", "Time a command waited in the command queue.")
+METRICS.describe("commerce_command_queue_depth", "gauge", "Commands waiting in the command queue.")
+METRICS.describe("commerce_transaction_conflicts_total", "counter", "Commits refused because another commit changed the same records first, each one is retried.")
+METRICS.describe("commerce_fast_reads_total", "counter", "Read-only commands answered from the published state instead of the command queue.")
+METRICS.describe("commerce_fast_read_duration_seconds", "histogram", "Time taken to answer a read-only command from the published state.")
+METRICS.describe("commerce_json_loads_total", "counter", "Data files read from disk.")
+METRICS.describe("commerce_json_load_bytes_total", "counter", "Bytes of data files read from disk.")
+METRICS.describe("commerce_json_saves_total", "counter", "Data files written to disk.")
+METRICS.describe("commerce_json_save_bytes_total", "counter", "Bytes of data files written to disk.")
+METRICS.describe("commerce_rest_calls_total", "counter", "Discord REST calls made by lookups (fetch_member, fetch_channel, ...).")
+METRICS.describe("commerce_auction_timer_lag_seconds", "histogram", "How late auctions were resolved compared to their end time.")
+METRICS.describe("commerce_commands_throttled_total", "counter", "Commands dropped by the rate limiter before they were queued.")
+METRICS.describe("commerce_market_tick_seconds", "histogram", "Time taken to move every stock price once.")
+METRICS.describe("commerce_market_tickers", "gauge", "Tickers the stock market engine is moving.")
+METRICS.gauge("commerce_command_queue_depth", lambda: len(COMMAND_QUEUE))
+
+class TokenBucket:
+    __slots__ = ("capacity", "rate", "tokens", "updated")
+
+    def __init__(self, capacity, per_minute, now):
+        self.capacity = capacity
+        self.rate = per_minute / 60
+        self.tokens = float(capacity)
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def is_full(self, now):
+        return self.refill(now) >= self.capacity
+
+class SortedKeys:
+    """
+    A sorted list of unique keys kept as blocks of up to 2 * SORTED_BLOCK_SIZE keys, with the last key of every block.
+    Adding or removing a key bisects to its block and only shifts that block, instead of every key after it in one long list.
+    Positions need the number of keys before each block, recounted the first time one is asked for after a change.
+    """
+    def __init__(self, keys = ()):
+        keys = sorted(keys)
+        self.blocks = [keys[i:i + SORTED_BLOCK_SIZE] for i in range(0, len(keys), SORTED_BLOCK_SIZE)]
+        self.maxes = [block[-1] for block in self.blocks]
+        self.length = len(keys)
+        self.offsets = None #Keys before each block, None when a change made it stale
+
+    def __len__(self):
+        return self.length
+
+    def add(self, key):
+        self.offsets = None
+        self.length += 1
+        if not self.blocks:
+            self.blocks.append([key])
+            self.maxes.append(key)
+            return
+        i = min(bisect.bisect_left(self.maxes, key), len(self.blocks) - 1)
+        block = self.blocks[i]
+        bisect.insort(block, key)
+        self.maxes[i] = block[-1]
+        if len(block) > 2 * SORTED_BLOCK_SIZE:
+            self.blocks[i:i + 1] = [block[:SORTED_BLOCK_SIZE], block[SORTED_BLOCK_SIZE:]]
+            self.maxes[i:i + 1] = [block[SORTED_BLOCK_SIZE - 1], block[-1]]
+
+    def remove(self, key): #The key has to be there
+        i = bisect.bisect_left(self.maxes, key)
+        block = self.blocks[i]
+        del block[bisect.bisect_left(block, key)]
+        self.offsets = None
+        self.length -= 1
+        if block:
+            self.maxes[i] = block[-1]
+        else:
+            del self.blocks[i]
+            del self.maxes[i]
+
+    def index(self, key): #Position the key has or would have
+        i = bisect.bisect_left(self.maxes, key)
+        if i == len(self.blocks):
+            return self.length
+        if self.offsets is None:
+            self.offsets = [0, *itertools.accumulate(len(block) for block in self.blocks)]
+        return self.offsets[i] + bisect.bisect_left(self.blocks[i], key)
+
+    def slice(self, start, stop):
+        if self.offsets is None:
+            self.offsets = [0, *itertools.accumulate(len(block) for block in self.blocks)]
+        keys = []
+        i = max(0, bisect.bisect_right(self.offsets, start) - 1)
+        while i < len(self.blocks) and self.offsets[i] < stop:
+            keys.extend(self.blocks[i][max(0, start - self.offsets[i]):stop - self.offsets[i]])
+            i += 1
+        return keys
+
+class RankIndex:
+    """
+    Keeps one stat for every user of a server ordered from highest to lowest.
+    Rank and top-k lookups are bisections over the ordered keys instead of a sort of the whole server.
+    """
+    def __init__(self, scores = None):
+        self.scores = dict(scores or {}) #{user_id: score}
+        self.order = SortedKeys((-score, user_id) for user_id, score in self.scores.items())
+
+    def __len__(self):
+        return len(self.order)
+
+    def update(self, user_id, score):
+        old_score = self.scores.get(user_id)
+        if old_score == score:
+            return
+        if old_score is not None:
+            self.order.remove((-old_score, user_id))
+        self.scores[user_id] = score
+        self.order.add((-score, user_id))
+
+    def remove(self, user_id):
+        old_score = self.scores.pop(user_id, None)
+        if old_score is not None:
+            self.order.remove((-old_score, user_id))
+
+    def rank(self, user_id): #1 based, None if the user isn't ranked
+        score = self.scores.get(user_id)
+        if score is None:
+            return None
+        return self.order.index((-score, user_id)) + 1
+
+    def top(self, count, start = 0):
+        return [(user_id, -negative_score) for negative_score, user_id in self.order.slice(start, start + count)]
+
+class WalletSketch:
+    """
+    Money supply and an approximate wallet distribution for one server, updated in O(1) on every wallet change.
+    Wallets are counted in log spaced buckets (WALLET_SKETCH_STEPS per doubling) with the sum of each bucket kept, so
+    percentiles and the Gini coefficient come from a pass over the buckets instead of over every user.
+    """
+    def __init__(self, wallets = None):
+        self.wallets = {} #{user_id: wallet}
+        self.supply = 0
+        self.counts = [0] * WALLET_SKETCH_BUCKETS
+        self.sums = [0] * WALLET_SKETCH_BUCKETS
+        for user_id, wallet in (wallets or {}).items():
+            self.update(user_id, wallet)
+
+    def __len__(self):
+        return len(self.wallets)
+
+    @staticmethod
+    def bucket(wallet):
+        if wallet <= 0:
+            return 0
+        return min(WALLET_SKETCH_BUCKETS - 1, 1 + int(math.log2(wallet) * WALLET_SKETCH_STEPS))
+
+    def update(self, user_id, wallet):
+        old_wallet = self.wallets.get(user_id)
+        if old_wallet == wallet:
+            return
+        if old_wallet is not None:
+            self.discard(old_wallet)
+        self.wallets[user_id] = wallet
+        bucket = self.bucket(wallet)
+        self.counts[bucket] += 1
+        self.sums[bucket] += wallet
+        self.supply += wallet
+
+    def remove(self, user_id):
+        old_wallet = self.wallets.pop(user_id, None)
+        if old_wallet is not None:
+            self.discard(old_wallet)
+
+    def discard(self, wallet):
+        bucket = self.bucket(wallet)
+        self.counts[bucket] -= 1
+        self.sums[bucket] -= wallet
+        self.supply -= wallet
+
+    def percentile(self, fraction): #Mean of the bucket the percentile falls in
+        target = fraction * len(self.wallets)
+        seen = 0
+        for count, total in zip(self.counts, self.sums):
+            seen += count
+            if count and seen >= target:
+                return total / count
+        return 0
+
+    def gini(self): #Every wallet in a bucket is treated as the bucket's mean
+        if self.supply <= 0 or not self.wallets:
+            return 0.0
+        area = 0.0
+        share_before = 0.0
+        for count, total in zip(self.counts, self.sums):
+            if count:
+                share = share_before + total / self.supply
+                area += count / len(self.wallets) * (share_before + share)
+                share_before = share
+        return max(0.0, 1 - area)
+
+class AuctionIndex:
+    """
+    The live auctions of one server in every order !auctions lists them by, with the auctions of each seller and item name.
+    A page of one ordering is a slice of a sorted list, and a price range is found by bisection, so a listing doesn't
+    go through every auction.
+    """
+    def __init__(self, auctions = None):
+        self.entries = {} #{auction_id: (end, price, bids, item name lowercased, seller id)}
+        self.orders = {"ending": [], "price": [], "bids": []} #Sorted keys ending in the auction id
+        self.items = {} #{item name lowercased: {auction_id}}
+        self.sellers = {} #{seller id, "" for the server: {auction_id}}
+        for auction_id, auction in (auctions or {}).items(): #Sorted once at the end rather than inserted one by one
+            entry = self.entries[auction_id] = self.entry(auction)
+            for order, key in self.keys(auction_id, entry).items():
+                self.orders[order].append(key)
+            self.items.setdefault(entry[3], set()).add(auction_id)
+            self.sellers.setdefault(entry[4], set()).add(auction_id)
+        for keys in self.orders.values():
+            keys.sort()
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def entry(auction):
+        return (auction["auction_end"], auction["current_bid"], auction["number_of_bids"], auction["item"].lower(), auction["user_id"] or "")
+
+    @staticmethod
+    def keys(auction_id, entry):
+        end, price, bids, item, seller = entry
+        return {"ending": (end, auction_id), "price": (price, end, auction_id), "bids": (-bids, end, auction_id)}
+
+    def update(self, auction_id, entry):
+        old_entry = self.entries.get(auction_id)
+        if old_entry == entry:
+            return
+        if old_entry is not None:
+            self.remove(auction_id)
+        self.entries[auction_id] = entry
+        for order, key in self.keys(auction_id, entry).items():
+            bisect.insort(self.orders[order], key)
+        self.items.setdefault(entry[3], set()).add(auction_id)
+        self.sellers.setdefault(entry[4], set()).add(auction_id)
+
+    def remove(self, auction_id):
+        entry = self.entries.pop(auction_id, None)
+        if entry is None:
+            return
+        for order, key in self.keys(auction_id, entry).items():
+            del self.orders[order][bisect.bisect_left(self.orders[order], key)]
+        for groups, group in ((self.items, entry[3]), (self.sellers, entry[4])):
+            groups[group].discard(auction_id)
+            if not groups[group]:
+                del groups[group]
+
+    def query(self, sort = "ending", item = None, seller = None, low = None, high = None):
+        """
+        Ids of the auctions matching every filter given, in sort order, yielded lazily so a page stops as soon as it's full.
+        Item and seller filters only look at their own auctions, a price range is bisected out of the price order. When
+        the filters still match a large share of the auctions, sorting them all would cost as much as a scan, so the sort
+        order is walked instead, skipping the auctions that don't match, and stops with the page.
+        """
+        def in_range(auction_id):
+            price = self.entries[auction_id][1]
+            return (low is None or price >= low) and (high is None or price <= high)
+        candidates = None
+        if item is not None:
+            candidates = set().union(*(auction_ids for name, auction_ids in self.items.items() if item in name))
+        if seller is not None:
+            auction_ids = self.sellers.get(seller, set())
+            candidates = auction_ids if candidates is None else candidates & auction_ids
+        prices = self.orders["price"]
+        if candidates is None and (low is not None or high is not None) and sort != "price":
+            first = bisect.bisect_left(prices, (low,)) if low is not None else 0
+            last = bisect.bisect_left(prices, (high + 1,)) if high is not None else len(prices)
+            candidates = {key[-1] for key in prices[first:last]}
+        if candidates is not None and len(candidates) * AUCTION_SORT_SHARE <= len(self.entries):
+            keys = sorted(self.keys(auction_id, self.entries[auction_id])[sort] for auction_id in candidates if in_range(auction_id))
+            return (key[-1] for key in keys)
+        first = bisect.bisect_left(prices, (low,)) if sort == "price" and low is not None else 0
+        ordered = (key[-1] for key in itertools.islice(self.orders[sort], first, None))
+        if sort == "price" and high is not None:
+            ordered = itertools.takewhile(in_range, ordered)
+        if candidates is None and sort != "price":
+            return ordered
+        return (auction_id for auction_id in ordered if (candidates is None or auction_id in candidates) and in_range(auction_id))
+
+class StockMarket:
+    """
+    Current price and chart history of every ticker in every server, all moved together once per tick.
+    Each ticker is one slot in flat arrays (numpy when installed, array.array otherwise). Its log price follows a
+    mean-reverting random walk: x += reversion * (log(mean) - x) * dt + volatility * sqrt(dt) * N(0, 1), with dt in hours.
+    History is a ring buffer of STOCK_HISTORY_LENGTH float32 points per slot, written for every slot at once.
+    """
+    def __init__(self, capacity = 64, seed = None):
+        self.slots = {} #{(server_id, symbol): slot}
+        self.free = []
+        self.size = 0 #Slots handed out, including freed ones
+        self.capacity = 0
+        self.history_head = 0 #Next history column to write
+        self.history_count = 0
+        self.ticks = 0
+        self.rng = numpy.random.default_rng(seed) if numpy else random.Random(seed)
+        self.log_price = self.log_mean = self.volatility = self.reversion = self.history = None
+        self.grow(capacity)
+
+    def grow(self, capacity):
+        if numpy:
+            def resized(values, fill):
+                grown = numpy.full(capacity, fill, dtype = numpy.float64)
+                if values is not None:
+                    grown[:len(values)] = values
+                return grown
+            history = numpy.zeros((capacity, STOCK_HISTORY_LENGTH), dtype = numpy.float32)
+            if self.history is not None:
+                history[:self.capacity] = self.history
+        else:
+            def resized(values, fill):
+                grown = array.array("d", values if values is not None else [])
+                grown.extend([fill] * (capacity - len(grown)))
+                return grown
+            history = array.array("f", self.history if self.history is not None else [])
+            history.extend([0.0] * ((capacity - self.capacity) * STOCK_HISTORY_LENGTH))
+        self.log_price = resized(self.log_price, 0.0)
+        self.log_mean = resized(self.log_mean, 0.0)
+        self.volatility = resized(self.volatility, 0.0)
+        self.reversion = resized(self.reversion, 0.0)
+        self.history = history
+        self.capacity = capacity
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, key):
+        return key in self.slots
+
+    def add(self, server_id, symbol, price, mean_price = None, volatility = STOCK_DEFAULT_VOLATILITY, reversion = STOCK_DEFAULT_REVERSION):
+        key = (str(server_id), symbol)
+        slot = self.slots.get(key)
+        if slot is None:
+            if self.free:
+                slot = self.free.pop()
+            else:
+                if self.size == self.capacity:
+                    self.grow(self.capacity * 2)
+                slot = self.size
+                self.size += 1
+            self.slots[key] = slot
+            self.fill_history(slot, price)
+        self.log_price[slot] = math.log(max(price, 1))
+        self.log_mean[slot] = math.log(max(mean_price or price, 1))
+        self.volatility[slot] = volatility / 100
+        self.reversion[slot] = reversion
+        return slot
+
+    def remove(self, server_id, symbol):
+        slot = self.slots.pop((str(server_id), symbol), None)
+        if slot is not None:
+            self.volatility[slot] = 0.0 #Freed slots keep ticking, they just never move
+            self.reversion[slot] = 0.0
+            self.free.append(slot)
+
+    def price(self, server_id, symbol):
+        slot = self.slots.get((str(server_id), symbol))
+        return None if slot is None else math.exp(self.log_price[slot])
+
+    def tick(self, seconds = STOCK_TICK_SECONDS):
+        dt = seconds / 3600
+        count = self.size
+        if numpy:
+            log_price = self.log_price[:count]
+            log_price += self.reversion[:count] * (self.log_mean[:count] - log_price) * dt + self.volatility[:count] * math.sqrt(dt) * self.rng.standard_normal(count)
+            numpy.maximum(log_price, 0.0, out = log_price) #Prices never go below $1
+        else:
+            root_dt = math.sqrt(dt)
+            gauss = self.rng.gauss
+            log_price, log_mean, volatility, reversion = self.log_price, self.log_mean, self.volatility, self.reversion
+            for slot in range(count):
+                value = log_price[slot] + reversion[slot] * (log_mean[slot] - log_price[slot]) * dt + volatility[slot] * root_dt * gauss(0.0, 1.0)
+                log_price[slot] = value if value > 0.0 else 0.0
+        self.ticks += 1
+
+    def record_history(self): #Appends the current price of every slot to its chart
+        column = self.history_head
+        if numpy:
+            self.history[:self.size, column] = numpy.exp(self.log_price[:self.size])
+        else:
+            for slot in range(self.size):
+                self.history[slot * STOCK_HISTORY_LENGTH + column] = math.exp(self.log_price[slot])
+        self.history_head = (column + 1) % STOCK_HISTORY_LENGTH
+        self.history_count = min(self.history_count + 1, STOCK_HISTORY_LENGTH)
+
+    def fill_history(self, slot, price): #New tickers start with a flat chart
+        if numpy:
+            self.history[slot, :] = price
+        else:
+            start = slot * STOCK_HISTORY_LENGTH
+            self.history[start:start + STOCK_HISTORY_LENGTH] = array.array("f", [price] * STOCK_HISTORY_LENGTH)
+
+    def set_history(self, server_id, symbol, values): #Saved chart, oldest to newest, newer points line up with every other ticker's
+        slot = self.slots.get((str(server_id), symbol))
+        if slot is None or not values:
+            return
+        values = list(values[-STOCK_HISTORY_LENGTH:])
+        ordered = [values[0]] * (STOCK_HISTORY_LENGTH - len(values)) + values
+        row = [0.0] * STOCK_HISTORY_LENGTH
+        for offset, value in enumerate(ordered):
+            row[(self.history_head + offset) % STOCK_HISTORY_LENGTH] = value
+        if numpy:
+            self.history[slot, :] = row
+        else:
+            start = slot * STOCK_HISTORY_LENGTH
+            self.history[start:start + STOCK_HISTORY_LENGTH] = array.array("f", row)
+        self.history_count = max(self.history_count, len(values))
+
+    def history_of(self, server_id, symbol): #Oldest to newest
+        slot = self.slots.get((str(server_id), symbol))
+        if slot is None or not self.history_count:
+            return []
+        if numpy:
+            row = self.history[slot].tolist()
+        else:
+            row = self.history[slot * STOCK_HISTORY_LENGTH:(slot + 1) * STOCK_HISTORY_LENGTH].tolist()
+        ordered = row[self.history_head:] + row[:self.history_head]
+        return [round(value, 2) for value in ordered[-self.history_count:]]
+
+class Ledger:
+    """
+    Append-only record of every wallet change, as fixed size LEDGER_RECORD entries in numbered segment files.
+    Every entry points back at the same user's previous one, so a user's history is read newest first by following
+    the chain from heads[(server_id, user_id)], one seek per entry however long the ledger grows.
+    Pointers are segment << 40 | offset. heads is checkpointed to index.json, and only the entries written after the
+    checkpoint are scanned when the ledger is opened.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.heads = {} #{(server_id, user_id): pointer to their newest entry}
+        self.segment = 0
+        self.size = 0 #Bytes in the active segment
+        self.count = 0
+        self.file = None
+        self.readers = {} #{segment: file opened for reading}
+        self.dirty = False
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, f"ledger-{segment:06d}.bin")
+
+    def index_path(self):
+        return os.path.join(self.directory, "index.json")
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok = True)
+        segments = sorted(int(name[7:13]) for name in os.listdir(self.directory) if re.fullmatch(r"ledger-\d{6}\.bin", name))
+        start_segment, start_offset = 0, 0
+        try:
+            with open(self.index_path(), encoding = "utf-8") as f:
+                index = json.load(f)
+            self.heads = {tuple(map(int, key.split(":"))): pointer for key, pointer in index["heads"].items()}
+            self.count = index["count"]
+            start_segment, start_offset = index["segment"], index["size"]
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError) as e:
+            print(f"[yellow]Ledger index unreadable ({e!r}), rebuilding it from the segments")
+            self.heads, self.count = {}, 0
+        for segment in segments:
+            if segment >= start_segment:
+                self.scan(segment, start_offset if segment == start_segment else 0)
+        self.segment = segments[-1] if segments else 0
+        path = self.segment_path(self.segment)
+        self.size = os.path.getsize(path) if os.path.exists(path) else 0
+        self.size -= self.size % LEDGER_RECORD.size
+        self.file = open(path, "ab")
+        self.file.truncate(self.size) #Drops an entry torn by a crash mid write
+        return self
+
+    def scan(self, segment, offset): #Brings heads up to date with the entries from offset on
+        size = LEDGER_RECORD.size
+        with open(self.segment_path(segment), "rb") as f:
+            f.seek(offset)
+            while True:
+                chunk = f.read(size * 8192)
+                chunk = chunk[:len(chunk) - len(chunk) % size]
+                if not chunk:
+                    return
+                for index, entry in enumerate(LEDGER_RECORD.iter_unpack(chunk)):
+                    self.heads[(entry[1], entry[2])] = segment << 40 | (offset + index * size)
+                offset += len(chunk)
+                self.count += len(chunk) // size
+
+    def append(self, server_id, user_id, amount, balance, kind, reference = None):
+        if self.size + LEDGER_RECORD.size > LEDGER_SEGMENT_BYTES:
+            self.roll()
+        key = (int(server_id), int(user_id))
+        self.file.write(LEDGER_RECORD.pack(time.time(), key[0], key[1], amount, balance, LEDGER_KIND_CODES[kind], int(reference or 0), self.heads.get(key, -1)))
+        self.heads[key] = self.segment << 40 | self.size
+        self.size += LEDGER_RECORD.size
+        self.count += 1
+        self.dirty = True
+
+    def roll(self):
+        self.file.close()
+        self.segment += 1
+        self.size = 0
+        self.file = open(self.segment_path(self.segment), "ab")
+        if DEBUG:
+            print(f"[green]Ledger rolled over to segment {self.segment}")
+
+    def flush(self):
+        if self.dirty:
+            self.file.flush()
+            self.dirty = False
+
+    def read(self, pointer):
+        segment, offset = pointer >> 40, pointer & (1 << 40) - 1
+        reader = self.readers.get(segment)
+        if reader is None:
+            reader = self.readers[segment] = open(self.segment_path(segment), "rb")
+        reader.seek(offset)
+        return LEDGER_RECORD.unpack(reader.read(LEDGER_RECORD.size))
+
+    def history(self, server_id, user_id, count, skip = 0): #Newest first, [(time, amount, balance, kind, reference)]
+        self.flush()
+        pointer = self.heads.get((int(server_id), int(user_id)), -1)
+        entries = []
+        while pointer >= 0 and len(entries) < count:
+            when, _, _, amount, balance, kind, reference, pointer = self.read(pointer)
+            if skip:
+                skip -= 1
+                continue
+            entries.append((when, amount, balance, LEDGER_KIND_NAMES[kind], reference))
+        return entries
+
+    def checkpoint(self): #Taken on the event loop, written with write_index in a thread
+        self.flush()
+        return {"segment": self.segment, "size": self.size, "count": self.count, "heads": {f"{server_id}:{user_id}": pointer for (server_id, user_id), pointer in self.heads.items()}}
+
+    def write_index(self, index):
+        temporary_path = self.index_path() + ".tmp"
+        with open(temporary_path, "w", encoding = "utf-8") as f:
+            json.dump(index, f, separators = (",", ":"))
+        os.replace(temporary_path, self.index_path())
+
+class Archive:
+    """
+    Resolved predictions and ended auctions of one server, moved out of the hot data files so those stay the size of
+    what's live. Records are JSON lines in numbered segment files, appended as ARCHIVE_FRAME length prefixed zlib blocks
+    and never changed. Once a segment is full it's recompressed as one block, which packs it several times smaller, and
+    the ids of its records are written next to it in a .ids file that never changes either.
+    ids maps every record to its segment and counts holds each segment's records of each kind, so a lookup or a page of
+    the newest records only decompresses the segments holding them. Opening reads the .ids files, only the active segment
+    and full ones that haven't been recompressed yet are rescanned.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.ids = {kind: {} for kind in ARCHIVE_KINDS} #{kind: {record id: segment}}
+        self.counts = [] #[{kind: records}] per segment
+        self.full = [] #Segments waiting to be recompressed
+        self.segment = 0
+        self.size = 0 #Bytes in the active segment
+        self.raw = 0 #Uncompressed bytes in the active segment
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, f"segment-{segment:06d}.bin")
+
+    def ids_path(self, segment):
+        return os.path.join(self.directory, f"segment-{segment:06d}.ids")
+
+    def open(self): #Run in a thread
+        os.makedirs(self.directory, exist_ok = True)
+        names = set(os.listdir(self.directory))
+        segments = sorted(int(name[8:14]) for name in names if re.fullmatch(r"segment-\d{6}\.bin", name))
+        self.segment = segments[-1] if segments else 0
+        self.counts = [{kind: 0 for kind in ARCHIVE_KINDS} for _ in range(self.segment + 1)]
+        for segment in segments:
+            if segment != self.segment and os.path.basename(self.ids_path(segment)) in names:
+                try:
+                    self.load_ids(segment)
+                    continue
+                except (ValueError, KeyError, TypeError) as e:
+                    print(f"[yellow]Archive index {self.ids_path(segment)} unreadable ({e!r}), rebuilding it from the segment")
+            raw, blocks = self.scan(segment, segment == self.segment)
+            if segment == self.segment: #A full one gets rolled over on the next append
+                self.raw = raw
+            else:
+                self.full.append(segment)
+        path = self.segment_path(self.segment)
+        self.size = os.path.getsize(path) if os.path.exists(path) else 0
+        return self
+
+    @staticmethod
+    def blocks(f, size = None): #Yields (offset after the block, JSON lines) up to size bytes, stopping at a block torn by a crash
+        offset = 0
+        while size is None or offset < size:
+            header = f.read(ARCHIVE_FRAME.size)
+            if len(header) < ARCHIVE_FRAME.size:
+                return
+            block = f.read(ARCHIVE_FRAME.unpack(header)[0])
+            try:
+                lines = zlib.decompress(block)
+            except zlib.error:
+                return
+            offset += ARCHIVE_FRAME.size + len(block)
+            yield offset, lines
+
+    @staticmethod
+    def key(line): #(kind, record id) of a record line, without parsing the whole record
+        match = ARCHIVE_KEY.match(line)
+        return json.loads(match.group(1)), json.loads(match.group(2))
+
+    def load_ids(self, segment):
+        with open(self.ids_path(segment), encoding = "utf-8") as f:
+            ids = json.load(f)
+        for kind in ARCHIVE_KINDS:
+            self.ids[kind].update(dict.fromkeys(ids[kind], segment))
+            self.counts[segment][kind] = len(ids[kind])
+
+    def scan(self, segment, last): #Counts and maps a segment's records again from scratch, returns (uncompressed bytes, blocks)
+        counts = self.counts[segment] = {kind: 0 for kind in ARCHIVE_KINDS}
+        raw = blocks = end = 0
+        with open(self.segment_path(segment), "r+b" if last else "rb") as f:
+            for end, lines in self.blocks(f):
+                for line in lines.splitlines():
+                    kind, record_id = self.key(line)
+                    self.ids[kind][record_id] = segment
+                    counts[kind] += 1
+                raw += len(lines)
+                blocks += 1
+            if last and end < os.path.getsize(self.segment_path(segment)):
+                print(f"[yellow]Archive segment {self.segment_path(segment)} ended in a torn block, dropped it")
+                f.truncate(end)
+        return raw, blocks
+
+    def append(self, kind, record_id, record):
+        record = {"kind": kind, "id": str(record_id), "archived_at": time.time(), **record}
+        line = json.dumps(record, separators = (",", ":")).encode("utf-8") + b"\n"
+        if self.raw and self.raw + len(line) > ARCHIVE_SEGMENT_BYTES:
+            self.roll()
+        block = zlib.compress(line)
+        with open(self.segment_path(self.segment), "ab") as f: #Opened per record, servers with an archive would otherwise hold a file each
+            f.write(ARCHIVE_FRAME.pack(len(block)) + block)
+        self.size += ARCHIVE_FRAME.size + len(block)
+        self.raw += len(line)
+        self.ids[kind][record["id"]] = self.segment
+        self.counts[self.segment][kind] += 1
+
+    def roll(self):
+        self.full.append(self.segment)
+        self.segment += 1
+        self.size = self.raw = 0
+        self.counts.append({kind: 0 for kind in ARCHIVE_KINDS})
+        if DEBUG:
+            print(f"[green]Archive {self.directory} rolled over to segment {self.segment}")
+
+    def compact(self, segment): #Rewrites a full segment as one block and writes its .ids file, run in a thread
+        with open(self.segment_path(segment), "rb") as f:
+            lines = b"".join(lines for _, lines in self.blocks(f))
+        ids = {kind: [] for kind in ARCHIVE_KINDS}
+        for line in lines.splitlines():
+            kind, record_id = self.key(line)
+            ids[kind].append(record_id)
+        block = zlib.compress(lines)
+        temporary_path = self.segment_path(segment) + ".tmp"
+        with open(temporary_path, "wb") as f:
+            f.write(ARCHIVE_FRAME.pack(len(block)) + block)
+        os.replace(temporary_path, self.segment_path(segment))
+        temporary_path = self.ids_path(segment) + ".tmp" #Written last, a segment without one is rescanned and recompressed
+        with open(temporary_path, "w", encoding = "utf-8") as f:
+            json.dump(ids, f, separators = (",", ":"))
+        os.replace(temporary_path, self.ids_path(segment))
+
+    def read(self, segment, prefix = b""): #The JSON lines of a segment starting with prefix, oldest first, run in a thread
+        size = self.size if segment == self.segment else None #Stops before anything appended while it reads
+        try:
+            with open(self.segment_path(segment), "rb") as f:
+                return [line for _, lines in self.blocks(f, size) for line in lines.splitlines() if line.startswith(prefix)]
+        except FileNotFoundError:
+            return []
+
+    @staticmethod
+    def prefix(kind, record_id = None): #Every line starts with its kind and id, so lines are picked out without parsing them
+        return f'{{"kind":{json.dumps(kind)},'.encode("utf-8") + (f'"id":{json.dumps(str(record_id))},'.encode("utf-8") if record_id is not None else b"")
+
+    def total(self, kind):
+        return sum(counts[kind] for counts in self.counts)
+
+    async def find(self, kind, record_id):
+        segment = self.ids[kind].get(str(record_id))
+        if segment is None:
+            return None
+        lines = await asyncio.to_thread(self.read, segment, self.prefix(kind, record_id))
+        return json.loads(lines[-1]) if lines else None
+
+    async def newest(self, kind, count, skip = 0): #Newest first, whole segments before the page are skipped by their counts
+        found = []
+        for segment in range(self.segment, -1, -1):
+            if len(found) >= count:
+                break
+            if skip >= self.counts[segment][kind]:
+                skip -= self.counts[segment][kind]
+                continue
+            lines = (await asyncio.to_thread(self.read, segment, self.prefix(kind)))[::-1]
+            found += [json.loads(line) for line in lines[skip:skip + count - len(found)]]
+            skip = 0
+        return found
+
+MARKET = StockMarket()
+METRICS.gauge("commerce_market_tickers", lambda: len(MARKET))
+
+def apply_server_defaults(server_id, settings, users, shop, predictions):
+    """
+    Adds the default data for server_id to the loaded data files, and backfills commands added since the server joined.
+    Returns the set of file paths that changed.
+    """
+    changed = set()
     if server_id not in settings:
         settings[server_id] = {
             "Default Commerce Channel ID": None,
-            "User Commands":{
-                "!bet": True,
-                "!shop": True,
-                "!wallet": True,
-                "!buy": True,
-                "!sell": True,
-                "!predictions": True,
-                "!auction_item": True,
-                "!auctions": True,
-                "!bid": True,
-                "!inventory": True,
-                "!my_bets": True
-            },
-            "Privileged Commands":{
-                "!reward": True,
-                "!create_auction": True,
-                "!create_prediction": True,
-                "!close_prediction": True,
-                "!resolve_prediction": True,
-                "!create_shop_item": True,
-                "!delete_shop_item": True,
-                "!edit_shop_item": True,
-                "!reset_user_inventory": True,
-                "!reset_user": True,
-                "!purge_deprecated_users": True,
-                "!set_default_channel": True
+            "User Commands": dict(DEFAULT_USER_COMMANDS),
+            "Privileged Commands": dict(DEFAULT_PRIVILEGED_COMMANDS)
             }
-            }
-    await async_save_json(SETTINGS_FILE, settings)
-    
-    shop = await async_load_json(SHOP_FILE)
+        changed.add(SETTINGS_FILE)
+    else: #Servers created before a command existed get it enabled by default
+        for section, defaults in (("User Commands", DEFAULT_USER_COMMANDS), ("Privileged Commands", DEFAULT_PRIVILEGED_COMMANDS)):
+            for command, enabled in defaults.items():
+                if command not in settings[server_id][section]:
+                    settings[server_id][section][command] = enabled
+                    changed.add(SETTINGS_FILE)
+
     if server_id not in shop:
         shop[server_id] = {
             "Next Shop ID": 1,
@@ -81,14 +1545,12 @@ async def add_server_to_jsons(server_id):
             "Items":{},
             "Auctions":{}
         }
-    await async_save_json(SHOP_FILE, shop)
-    
-    users = await async_load_json(USERS_FILE)
+        changed.add(SHOP_FILE)
+
     if server_id not in users:
         users[server_id] = {}
-    await async_save_json(USERS_FILE, users)
-    
-    predictions = await async_load_json(PREDICTIONS_FILE)
+        changed.add(USERS_FILE)
+
     if server_id not in predictions:
         predictions[server_id] = {
             "Predictions": {},
@@ -96,33 +1558,121 @@ async def add_server_to_jsons(server_id):
                 "next_bet_number": 1
             }
         }
-    await async_save_json(PREDICTIONS_FILE, predictions)
+        changed.add(PREDICTIONS_FILE)
+    return changed
+
+async def add_server_to_jsons(server_id):
+    settings, users, shop, predictions = await asyncio.gather(
+        async_load_json(SETTINGS_FILE), async_load_json(USERS_FILE), async_load_json(SHOP_FILE), async_load_json(PREDICTIONS_FILE)
+    )
+    state = {SETTINGS_FILE: settings, USERS_FILE: users, SHOP_FILE: shop, PREDICTIONS_FILE: predictions}
+    changed = apply_server_defaults(server_id, settings, users, shop, predictions)
+    await asyncio.gather(*(async_save_json(path, state[path]) for path in changed))
+    BOOTSTRAPPED_SERVERS.add(server_id)
 
-async def add_user_to_json(server_id, user_id):
+async def add_user_to_json(server_id, user_id, member = None): #Names come from member when given, otherwise they are looked up
     users = await async_load_json(USERS_FILE)
-    name = await get_display_name(server_id, user_id)
-    user_name = await get_user_name(server_id, user_id)
+    if member is not None:
+        name, user_name = member.display_name, member.name
+    else:
+        name = await get_display_name(server_id, user_id)
+        user_name = await get_user_name(server_id, user_id)
     if user_id not in users[server_id]:
         if DEBUG:
             print("[yellow]User_id not in users[server_id]")
-        users[server_id][user_id] = {
-            "display_name": name,
-            "user_name": user_name,
-            "inventory": {},
-            "total_currency_bet": 0,
-            "total_currency_won": 0,
-            "total_currency_lost": 0,
-            "profit": 0,
-            "bets_won": 0,
-            "bets_lost": 0,
-            "wallet": 500
-        }
+        users[server_id][user_id] = new_user_record(name, user_name)
+        record_ledger_entry(server_id, user_id, users[server_id][user_id]["wallet"], users[server_id][user_id]["wallet"], "open")
         await async_save_json(USERS_FILE, users)
+        sync_user_rankings(server_id, user_id, users[server_id][user_id])
+
+def new_user_record(display_name, user_name):
+    return {
+        "display_name": display_name,
+        "user_name": user_name,
+        "inventory": {},
+        "total_currency_bet": 0,
+        "total_currency_won": 0,
+        "total_currency_lost": 0,
+        "profit": 0,
+        "bets_won": 0,
+        "bets_lost": 0,
+        "wallet": 500
+    }
 
-async def update_display_name(server_id, user_id, name):
-    users = await async_load_json(USERS_FILE)
-    users[server_id][user_id]["display_name"] = name
-    await async_save_json(USERS_FILE, users)
+def queue_name_update(server_id, user_id, display_name, user_name):
+    NAME_UPDATES.setdefault(str(server_id), {})[str(user_id)] = (display_name, user_name)
+
+async def flush_name_updates():
+    """Writes every buffered name change to users.json with one load and save. Users who aren't in users.json are skipped."""
+    if not NAME_UPDATES:
+        return 0
+    updates = dict(NAME_UPDATES)
+    NAME_UPDATES.clear()
+    changed = 0
+    async with STATE_LOCK, locked_transaction():
+        users = await async_load_json(USERS_FILE)
+        for server_id, server_updates in updates.items():
+            server_users = users.get(server_id, {})
+            for user_id, (display_name, user_name) in server_updates.items():
+                user = server_users.get(user_id)
+                if user and (user["display_name"] != display_name or user.get("user_name") != user_name):
+                    user["display_name"] = display_name
+                    user["user_name"] = user_name
+                    changed += 1
+        if changed:
+            await async_save_json(USERS_FILE, users)
+    if DEBUG:
+        print(f"[green]Name flush: {changed} names updated")
+    return changed
+
+async def name_flush_loop():
+    while True:
+        await asyncio.sleep(NAME_FLUSH_SECONDS)
+        try:
+            await flush_name_updates()
+        except Exception as e:
+            print(f"[red]Name flush failed: {e!r}")
+
+def build_open_bets(server_id, server_predictions):
+    index = {}
+    for prediction_id, prediction in server_predictions.items():
+        for user_id in prediction.get("user_bets", {}):
+            index.setdefault(user_id, set()).add(prediction_id)
+    OPEN_BETS[server_id] = index
+    return index
+
+def user_open_bets(server_id, user_id, server_predictions = None):
+    """Ids of the predictions the user has bet on. May include bets since removed, so check each against the data."""
+    index = OPEN_BETS.get(server_id)
+    if index is None:
+        if PREDICTIONS_FILE in READ_STATE: #Built from what's committed, the changes made since are applied by sync_open_bets
+            server_predictions = decode_published(PREDICTIONS_FILE, READ_STATE[PREDICTIONS_FILE]).get(server_id, {}).get("Predictions", {})
+        index = build_open_bets(server_id, server_predictions or {})
+    return index.get(user_id, set())
+
+def sync_open_bets(server_id, prediction_id, user_ids, placed = False): #Call when bets are placed or removed, the index changes once the data is committed
+    def commit():
+        index = OPEN_BETS.get(server_id)
+        if index is None: #Built from predictions.json the first time it's needed
+            return
+        for user_id in user_ids:
+            if placed:
+                index.setdefault(user_id, set()).add(prediction_id)
+            elif user_id in index:
+                index[user_id].discard(prediction_id)
+                if not index[user_id]:
+                    del index[user_id]
+    run_after_commit(commit)
+
+def cancel_user_bets(server_id, user_id, server_predictions): #Removes the user's bets from every unresolved prediction. Returns {prediction_id: amount}
+    cancelled = {}
+    for prediction_id in list(user_open_bets(server_id, user_id, server_predictions)):
+        bet = server_predictions.get(prediction_id, {}).get("user_bets", {}).pop(user_id, None)
+        if bet:
+            server_predictions[prediction_id]["total_bets"] -= bet["amount"]
+            cancelled[prediction_id] = bet["amount"]
+        sync_open_bets(server_id, prediction_id, [user_id])
+    return cancelled
 
 async def add_prediction_to_json(title, options, server_id): #Dictionary of options
     current_prediction = {
@@ -138,9 +1688,11 @@ async def add_prediction_to_json(title, options, server_id): #Dictionary of opti
     predictions[server_id]["Data"]["next_bet_number"] += 1
     await async_save_json(PREDICTIONS_FILE, predictions)
 
+@traced("add_user_bet")
 async def add_user_bet(server_id, user_id, prediction_number, option_number, amount, channel_id = None): #Add prediction to commerce.json
     predictions, users = await asyncio.gather(async_load_json(PREDICTIONS_FILE), async_load_json(USERS_FILE))
-    user = await get_user(server_id, user_id)
+    guild = bot.get_guild(int(server_id))
+    user = (guild and guild.get_member(int(user_id))) or await get_user(server_id, user_id) #From the cache when possible, a REST call keeps the prediction open to conflicting bets for longer
     user_name = user.display_name
     user = users[server_id][user_id]
     prediction = predictions[server_id]["Predictions"][prediction_number]
@@ -154,40 +1706,39 @@ async def add_user_bet(server_id, user_id, prediction_number, option_number, amo
             if user_bets[user_id]["option"] == option_number:
                 user_bets[user_id]["amount"] += amount
             elif channel_id:
-                await send_message("You can't bet for an option you are already betting against.", channel_id)
+                await send_error("You can't bet for an option you are already betting against.", channel_id)
                 return
         else:
             user_bets[user_id] = new_bet
         predictions[server_id]["Predictions"][prediction_number]["total_bets"] += amount
     else:
-        await send_message("Betting for this prediction is currently closed.", channel_id)
+        await send_error("Betting for this prediction is currently closed.", channel_id)
         return
-    user["wallet"] -= amount
+    adjust_wallet(server_id, user_id, user, -amount, "bet", prediction_number)
     users[server_id][user_id]["total_currency_bet"] += amount
     await send_message("Bet successfully made.", channel_id)
     await asyncio.gather(async_save_json(PREDICTIONS_FILE, predictions), async_save_json(USERS_FILE, users))
+    sync_user_rankings(server_id, user_id, user)
+    sync_open_bets(server_id, prediction_number, [user_id], placed = True)
 
 async def remove_prediction_data(server_id, title = None, prediction_number = None): #Delete prediction from commerce.json #Will only receive either title or bet_number, never both
     predictions = await async_load_json(PREDICTIONS_FILE)
     if prediction_number:
-        if prediction_number in predictions[server_id]["Predictions"]:
-            del predictions[server_id]["Predictions"][str(prediction_number)]
+        if str(prediction_number) in predictions[server_id]["Predictions"]:
+            prediction_number = str(prediction_number)
         else:
             if DEBUG:
                 print("[red]Invalid prediction_number provided.")
             return
     elif title:
-        found_bet = False
-        for bet in predictions[server_id]["Predictions"]:
-            if bet["title"] == title:
-                del bet
-                found_bet = True
-                break
-        if not found_bet:
+        prediction_number = next((key for key, prediction in predictions[server_id]["Predictions"].items() if prediction["title"] == title), None)
+        if prediction_number is None:
             if DEBUG:
                 print("[red]Invalid prediction_title provided.")
             return
+    removed = predictions[server_id]["Predictions"].pop(prediction_number)
     await async_save_json(PREDICTIONS_FILE, predictions)
+    sync_open_bets(server_id, prediction_number, list(removed["user_bets"]))
 
 async def create_prediction(message = None, title = None, options = None, server_id = None): #!create_prediction (<name>) <number_of_options> (<option_1>) (<option_2>) (<option_3>)... #Options is list, used internally instead of command.
     if message:
@@ -196,13 +1747,13 @@ async def create_prediction(message = None, title = None, options = None, server
         pattern = r"!create_prediction\s+\(([^)]+)\)\s+(\d+)((?:\s+\([^)]+\))+)"
         match = re.match(pattern, message.content)
         if not match:
-            await send_message("Invalid parameters. [SYNTAX] !create_prediction (<title>) <number_of_options> (<option_1>) (<option_2>) (<option_3>)...", channel_id)
+            await send_error("Invalid parameters. [SYNTAX] !create_prediction (<title>) <number_of_options> (<option_1>) (<option_2>) (<option_3>)...", channel_id)
             return
         title = match.group(1).strip()
         predictions = await async_load_json(PREDICTIONS_FILE)
         for id, prediction in predictions[server_id]["Predictions"].items():
             if prediction["title"].lower() == title.lower():
-                await send_message(f"Invalid Parameters. A prediction with the title {title} already exists, please try again.", channel_id)
+                await send_error(f"Invalid Parameters. A prediction with the title {title} already exists, please try again.", channel_id)
                 return
         num_options = int(match.group(2))
         options_str = match.group(3)
@@ -211,7 +1762,7 @@ async def create_prediction(message = None, title = None, options = None, server
         if len(options_list) != num_options:
             if DEBUG:
                 print(f"[red]Invalid number of parameters. User stated {num_options} options, but provided {len(options_list)}")
-            await send_message(f"Invalid Parameters. User stated {num_options} options, but provided {len(options_list)}!", channel_id)
+            await send_error(f"Invalid Parameters. User stated {num_options} options, but provided {len(options_list)}!", channel_id)
             return
         options = {i + 1: option for i, option in enumerate(options_list)}
 
@@ -229,11 +1780,11 @@ async def close_prediction(message = None, bet_number = None, server_id = None,
     server_id = str(message.guild.id)
     channel_id = message.channel.id
     if not bet:
-        await send_message("Invalid parameters. [SYNTAX] !close_prediction <title_of_prediction OR prediction_id>", channel_id)
+        await send_error("Invalid parameters. [SYNTAX] !close_prediction <title_of_prediction OR prediction_id>", channel_id)
     if not bet.isdigit():
         bet_number = await get_prediction_number(bet, server_id)
         if not bet_number:
-            await send_message(f"Prediction **{bet}** not found!", channel_id)
+            await send_error(f"Prediction **{bet}** not found!", channel_id)
             return
     else:
         bet_number = bet
@@ -275,6 +1826,7 @@ async def parse_resolve_command(message):
     arg2 = option_number if option_number else option_name.strip()
     return (arg1, arg2)
     
+@traced("resolve_prediction")
 async def resolve_prediction(message = None, bet_number = None, winning_option = None, server_id = None, channel_id = None): #!resolve_prediction <number(optional)>or(<name_optional>) (<winning_option_name_or_number>)
     predictions = await async_load_json(PREDICTIONS_FILE)
     if message:
@@ -282,7 +1834,7 @@ async def resolve_prediction(message = None, bet_number = None, winning_option =
         channel_id = message.channel.id
         server_id = str(message.guild.id)
         if not args:
-            await send_message("Invalid syntax. [SYNTAX] !resolve_prediction <number or (name)> <number or (option_name)>", channel_id)
+            await send_error("Invalid syntax. [SYNTAX] !resolve_prediction <number or (name)> <number or (option_name)>", channel_id)
             return
         if args[0].isdigit():
             bet_number = args[0]
@@ -296,12 +1848,14 @@ async def resolve_prediction(message = None, bet_number = None, winning_option =
                 if option.lower() == winning_option.lower():
                     winning_option = k
     if bet_number not in predictions[server_id]["Predictions"] or not all([bet_number, winning_option, server_id, channel_id]) or winning_option not in predictions[server_id]["Predictions"][bet_number]["options"]:
-        await send_message("Prediction invalid.", channel_id)
+        await send_error("Prediction invalid.", channel_id)
         return
     embed = await payout(bet_number, winning_option, server_id)
     predictions = await async_load_json(PREDICTIONS_FILE)
-    del predictions[server_id]["Predictions"][bet_number]
+    resolved = predictions[server_id]["Predictions"].pop(bet_number)
     await async_save_json(PREDICTIONS_FILE, predictions)
+    sync_open_bets(server_id, bet_number, list(resolved["user_bets"]))
+    await archive_record(server_id, "prediction", bet_number, {**resolved, "winning_option": winning_option})
     await send_embed_message(embed, channel_id)
 
 async def parse_bet_command(message):
@@ -316,7 +1870,7 @@ async def parse_bet_command(message):
     pattern = r"!bet\s+(?:(\d+)|\(([^)]+)\))\s+(\d+)\s+(?:(\d+)|\(([^)]+)\))"
     match = re.match(pattern, content)
     if not match:
-        await send_message("Invalid syntax. [SYNTAX] !bet <bet_number or (bet_name)> <amount_int> <option_number or (option_name)>", message.channel.id)
+        await send_error("Invalid syntax. [SYNTAX] !bet <bet_number or (bet_name)> <amount_int> <option_number or (option_name)>", message.channel.id)
         return None
 
     bet_number = match.group(1)
@@ -343,7 +1897,7 @@ async def handle_bet(message): #!bet <bet_number(optional)>or(<bet_name(optional
     user = users[server_id][user_id]
     if amount:
         if user["wallet"] < amount:
-            await send_message("You do not have enough money in your wallet.", channel_id)
+            await send_error("You do not have enough money in your wallet.", channel_id)
             return
     if not bet_number.isdigit():
         matched_key = None
@@ -352,12 +1906,12 @@ async def handle_bet(message): #!bet <bet_number(optional)>or(<bet_name(optional
                 matched_key = key
                 break
         if matched_key is None:
-            await send_message("No prediction found with that title.", channel_id)
+            await send_error("No prediction found with that title.", channel_id)
             return
         bet_number = matched_key
     prediction = predictions[server_id]["Predictions"][bet_number]
     if not prediction:
-        await send_message("Prediction not found.", channel_id)
+        await send_error("Prediction not found.", channel_id)
         return 
     if not option_number.isdigit():
         matched_option = None
@@ -366,12 +1920,13 @@ async def handle_bet(message): #!bet <bet_number(optional)>or(<bet_name(optional
                 matched_option = key
                 break
         if matched_option is None:
-            await send_message("Option not found in prediction.", channel_id)
+            await send_error("Option not found in prediction.", channel_id)
             return
         option_number = matched_option
 
     await add_user_bet(server_id, user_id, bet_number, option_number, amount, channel_id)
 
+@traced("payout")
 async def payout(bet_number, winning_option, server_id):
     predictions, users = await asyncio.gather(
         async_load_json(PREDICTIONS_FILE), async_load_json(USERS_FILE)
@@ -393,6 +1948,7 @@ async def payout(bet_number, winning_option, server_id):
 
     # No one bet on the winning option
     if total_bet_on_winner == 0:
+        count_pool_flow(server_id, "unclaimed_pool", -total_amount_bet)
         embed = discord.Embed(
             title=f"🏆 {prediction['title'].title()} Results",
             description=f"**Winner:** {prediction['options'][winning_option]}\n\n😔 No one bet on the winning option.",
@@ -412,6 +1968,8 @@ async def payout(bet_number, winning_option, server_id):
             )
 
     # Process winners
+    count_pool_flow(server_id, "bonus_pool", bonus_pool) #Paid out together with the bets
+    prediction["payouts"] = {} #{user_id: winnings}, kept in the archive
     for user_id, user in user_bets.items():
         if user["option"] != winning_option:
             continue
@@ -421,7 +1979,8 @@ async def payout(bet_number, winning_option, server_id):
         winnings = user_amount + round(share * (total_pool - total_bet_on_winner))
         user_name = user["name"]
 
-        users_stats[user_id]["wallet"] += winnings
+        adjust_wallet(server_id, user_id, users_stats[user_id], winnings, "payout", bet_number)
+        prediction["payouts"][user_id] = winnings
         users_stats[user_id]["bets_won"] += 1
         users_stats[user_id]["total_currency_won"] += winnings
         users_stats[user_id]["profit"] = (
@@ -450,6 +2009,8 @@ async def payout(bet_number, winning_option, server_id):
         async_save_json(PREDICTIONS_FILE, predictions),
         async_save_json(USERS_FILE, users)
     )
+    for user_id in user_bets:
+        sync_user_rankings(server_id, user_id, users_stats[user_id])
     return embed
 
 
@@ -500,39 +2061,369 @@ async def get_predictions(message):
     else:
         await send_batch_embeds(embeds, channel_id)
 
-async def reward_user(message):
-    args = message.content.strip("!reward").strip().split()
+def parse_reward_recipients(text):
+    """
+    Parses the recipients of a !reward command: user mentions, user ids, role mentions, (display names) and "everyone".
+    Returns None when the text isn't a recipient list, so it can be treated as a single plain user name.
+    """
+    recipients = {"user_ids": [], "role_ids": [], "names": [], "everyone": False}
+    position = 0
+    for match in REWARD_RECIPIENT_PATTERN.finditer(text):
+        if text[position:match.start()].strip():
+            return None
+        position = match.end()
+        user_mention, role_mention, name, everyone, user_id = match.groups()
+        if user_mention or user_id:
+            recipients["user_ids"].append(user_mention or user_id)
+        elif role_mention:
+            recipients["role_ids"].append(role_mention)
+        elif name:
+            recipients["names"].append(name.strip())
+        elif everyone:
+            recipients["everyone"] = True
+    if text[position:].strip() or position == 0:
+        return None
+    return recipients
+
+def resolve_reward_recipients(message, server_users, recipients):
+    """
+    Resolves every recipient in one pass over the cached guild data, no member crawl per name.
+    Returns ({user_id: member or None}, [unresolved recipients])
+    """
+    guild = message.guild
+    resolved = {}
+    unresolved = []
+    names_lookup = None
+    for user_id in recipients["user_ids"]:
+        if user_id in server_users:
+            resolved[user_id] = guild.get_member(int(user_id))
+            continue
+        member = guild.get_member(int(user_id))
+        if member:
+            resolved[user_id] = member
+        else:
+            recipients["names"].append(user_id) #Numeric user names are still allowed
+    for role_id in recipients["role_ids"]:
+        role = guild.get_role(int(role_id))
+        if not role:
+            unresolved.append(f"<@&{role_id}>")
+            continue
+        for member in role.members:
+            if not member.bot:
+                resolved[str(member.id)] = member
+    if recipients["everyone"]:
+        for user_id in server_users:
+            resolved.setdefault(user_id, None)
+    for name in recipients["names"]:
+        if names_lookup is None: #Built once per command from the member cache and users.json
+            names_lookup = {}
+            for member in guild.members:
+                names_lookup[member.name.lower()] = (str(member.id), member)
+                names_lookup[member.display_name.lower()] = (str(member.id), member)
+            for user_id, user_data in server_users.items():
+                names_lookup.setdefault(user_data["user_name"].lower(), (user_id, None))
+                names_lookup.setdefault(user_data["display_name"].lower(), (user_id, None))
+        if name.lower() in names_lookup:
+            user_id, member = names_lookup[name.lower()]
+            resolved.setdefault(user_id, member)
+        else:
+            unresolved.append(name)
+    return resolved, unresolved
+
+async def reward_user(message): #!reward <amount> <@user, user_id, @role, (display_name) or everyone> [...]
+    args = message.content[len("!reward"):].strip().split()
     server_id = str(message.guild.id)
+    channel_id = message.channel.id
     if not args or len(args) < 2:
-        await send_message("Invalid Syntax. [SYNTAX] !reward <amount> <user_name or user_id or user_display_name>", message.channel.id)
+        await send_error("Invalid Syntax. [SYNTAX] !reward <amount> <@user, user_id, @role, (display_name) or everyone> [...]", channel_id)
         return
     try:
         amount = int(args[0])
     except Exception as e:
-        await send_message("Invalid Syntax. [SYNTAX] !reward <amount> <user_name or user_id or user_display_name>", message.channel.id)
+        await send_error("Invalid Syntax. [SYNTAX] !reward <amount> <@user, user_id, @role, (display_name) or everyone> [...]", channel_id)
         return
-    user_name = " ".join(args[1:]).strip()
+    targets = " ".join(args[1:]).strip()
+    recipients = parse_reward_recipients(targets)
+    if recipients is None: #Plain user name, possibly with spaces
+        recipients = {"user_ids": [], "role_ids": [], "names": [targets], "everyone": False}
 
     users = await async_load_json(USERS_FILE)
-    if user_name.isdigit():
-        if user_name in users[server_id]:
-            users[server_id][user_name]["wallet"] += amount
-            await async_save_json(USERS_FILE, users)
-            await send_message(f"{amount} successfully added to {users[server_id][str(user_name)]["display_name"]}'s wallet.", message.channel.id)
+    server_users = users[server_id]
+    resolved, unresolved = resolve_reward_recipients(message, server_users, recipients)
+    if not resolved and len(recipients["names"]) == 1 and not recipients["user_ids"] and not recipients["role_ids"]:
+        user_id = await get_user_id_from_username(server_id, recipients["names"][0]) #Last resort for names the member cache doesn't have
+        if user_id:
+            resolved[str(user_id)] = None
+            unresolved = []
+
+    rewarded = []
+    for user_id, member in resolved.items():
+        if user_id not in server_users:
+            if not member:
+                unresolved.append(user_id)
+                continue
+            server_users[user_id] = new_user_record(member.display_name, member.name)
+            record_ledger_entry(server_id, user_id, server_users[user_id]["wallet"], server_users[user_id]["wallet"], "open")
+        adjust_wallet(server_id, user_id, server_users[user_id], amount, "reward")
+        rewarded.append(user_id)
+
+    if not rewarded:
+        if len(unresolved) == 1 and not recipients["role_ids"] and not recipients["everyone"]:
+            await send_error("Could not find user. Have the user send !wallet command to generate a wallet.", channel_id)
+        else:
+            await send_error("Could not find any users to reward.", channel_id)
+        return
+
+    await async_save_json(USERS_FILE, users)
+    for user_id in rewarded:
+        sync_user_rankings(server_id, user_id, server_users[user_id])
+
+    if len(rewarded) == 1:
+        result = f"{amount} successfully added to {server_users[rewarded[0]]["display_name"]}'s wallet."
+    else:
+        result = f"{amount} successfully added to {len(rewarded):,} wallets (`${amount * len(rewarded):,}` total)."
+    if unresolved:
+        shown = ", ".join(str(name) for name in unresolved[:10])
+        result += f"\nCould not find: {shown}{f" and {len(unresolved) - 10} more" if len(unresolved) > 10 else ""}."
+    await send_message(result, channel_id)
+
+def current_stock_price(server_id, symbol, ticker): #Engine price in dollars, rounded to cents, or the last saved one for a ticker the engine hasn't picked up yet
+    price = MARKET.price(server_id, symbol)
+    return round(price, 2) if price is not None else ticker["price"]
+
+def encode_price_history(values): #float32, base64, 288 points are about 1.5KB
+    return base64.b64encode(array.array("f", values).tobytes()).decode("ascii")
+
+def decode_price_history(text):
+    values = array.array("f")
+    values.frombytes(base64.b64decode(text))
+    return values.tolist()
+
+def sparkline(values):
+    low, high = min(values), max(values)
+    if high - low < 1e-9:
+        return SPARKLINE_BLOCKS[0] * len(values)
+    scale = (len(SPARKLINE_BLOCKS) - 1) / (high - low)
+    return "".join(SPARKLINE_BLOCKS[int((value - low) * scale)] for value in values)
+
+def add_ticker_to_market(server_id, symbol, ticker):
+    MARKET.add(server_id, symbol, ticker["price"], ticker.get("mean_price"), ticker.get("volatility", STOCK_DEFAULT_VOLATILITY), ticker.get("reversion", STOCK_DEFAULT_REVERSION))
+    if ticker.get("history"):
+        MARKET.set_history(server_id, symbol, decode_price_history(ticker["history"]))
+
+def load_market(stocks): #Called on startup with stocks.json
+    for server_id, server_stocks in stocks.items():
+        for symbol, ticker in server_stocks.get("Tickers", {}).items():
+            add_ticker_to_market(server_id, symbol, ticker)
+    if DEBUG:
+        print(f"[green]Stock market loaded with {len(MARKET):,} tickers ({'numpy' if numpy else 'array'} engine)")
+
+async def save_market_prices(with_history = False):
+    """Writes the engine's current prices, and charts when with_history is set, to stocks.json with one load and save."""
+    if not len(MARKET):
+        return 0
+    saved = 0
+    async with STATE_LOCK:
+        stocks = await async_load_json(STOCKS_FILE)
+        for server_id, server_stocks in stocks.items():
+            for symbol, ticker in server_stocks.get("Tickers", {}).items():
+                price = MARKET.price(server_id, symbol)
+                if price is None:
+                    continue
+                ticker["price"] = round(price, 2)
+                if with_history:
+                    ticker["history"] = encode_price_history(MARKET.history_of(server_id, symbol))
+                saved += 1
+        if saved:
+            await async_save_json(STOCKS_FILE, stocks)
+    if DEBUG:
+        print(f"[green]Market save: {saved} prices written")
+    return saved
+
+async def market_loop():
+    """Moves every price every STOCK_TICK_SECONDS, adds a chart point every STOCK_HISTORY_SECONDS and saves prices every STOCK_SAVE_SECONDS."""
+    last_tick = last_history = last_save = time.monotonic()
+    history_changed = False
+    while True:
+        await asyncio.sleep(STOCK_TICK_SECONDS)
+        now = time.monotonic()
+        started = time.perf_counter()
+        MARKET.tick(now - last_tick) #A late tick covers the time it missed
+        METRICS.observe("commerce_market_tick_seconds", time.perf_counter() - started, MARKET_TICK_BUCKETS)
+        last_tick = now
+        if now - last_history >= STOCK_HISTORY_SECONDS:
+            MARKET.record_history()
+            last_history = now
+            history_changed = True
+        if now - last_save >= STOCK_SAVE_SECONDS:
+            last_save = now
+            try:
+                await save_market_prices(history_changed)
+                history_changed = False
+            except Exception as e:
+                print(f"[red]Market save failed: {e!r}")
+
+async def handle_stocks(message): #!stocks <OPTIONAL_symbol>
+    server_id = str(message.guild.id)
+    user_id = str(message.author.id)
+    channel_id = message.channel.id
+    args = message.content.split()
+    stocks, users = await asyncio.gather(async_load_json(STOCKS_FILE), async_load_json(USERS_FILE))
+    tickers = stocks.get(server_id, {}).get("Tickers", {})
+    holdings = users.get(server_id, {}).get(user_id, {}).get("stocks", {})
+    if not tickers:
+        await send_message("There are no stocks on the market yet.", channel_id)
+        return
+
+    if len(args) > 1:
+        symbol = args[1].upper()
+        ticker = tickers.get(symbol)
+        if not ticker:
+            await send_error(f"{symbol} was not found.", channel_id)
             return
-    user_id = await get_user_id_from_username(server_id, user_name)
-    if not user_id:
-        await send_message("Could not find a user by that name.", message.channel.id)
+        price = current_stock_price(server_id, symbol, ticker)
+        history = MARKET.history_of(server_id, symbol) + [price]
+        minutes = MARKET.history_count * STOCK_HISTORY_SECONDS // 60
+        window = f"{minutes // 60}h{f" {minutes % 60}m" if minutes % 60 else ""}" if minutes >= 60 else f"{minutes}m"
+        embed = discord.Embed(
+            title=f"📈 {symbol} — {ticker['name']}",
+            description=f"`{sparkline(history)}`\nNow `${price:,.2f}`, low `${min(history):,.2f}`, high `${max(history):,.2f}` over the last {window}",
+            color=discord.Color.green() if price >= history[0] else discord.Color.red()
+        )
+        holding = holdings.get(symbol)
+        if holding:
+            embed.set_footer(text=f"You own {holding['shares']:,} shares worth ${holding['shares'] * price:,.2f} (paid ${holding['cost']:,})")
+        await send_embed_message(embed, channel_id)
         return
-    if str(user_id) not in users[server_id]:
-        await send_message("Could not find user. Have the user send !wallet command to generate a wallet.", message.channel.id)
+
+    lines = []
+    for symbol, ticker in sorted(tickers.items()):
+        price = current_stock_price(server_id, symbol, ticker)
+        history = MARKET.history_of(server_id, symbol)
+        change = (price / history[0] - 1) * 100 if history and history[0] else 0.0
+        owned = holdings.get(symbol, {}).get("shares", 0)
+        lines.append(f"**{symbol}** {ticker['name']} — `${price:,.2f}` ({change:+.1f}%){f", you own {owned:,}" if owned else ""}")
+    embed = discord.Embed(
+        title="📈 Stock Market",
+        description="\n".join(lines[:STOCKS_PAGE_SIZE]) + (f"\n...and {len(lines) - STOCKS_PAGE_SIZE} more, use !stocks <symbol>" if len(lines) > STOCKS_PAGE_SIZE else ""),
+        color=discord.Color.green()
+    )
+    if holdings:
+        worth = sum(holding["shares"] * current_stock_price(server_id, symbol, tickers[symbol]) for symbol, holding in holdings.items() if symbol in tickers)
+        embed.set_footer(text=f"Your portfolio is worth ${worth:,.2f}")
+    await send_embed_message(embed, channel_id)
+
+async def handle_buy_stock(message): #!buy_stock <symbol> <shares>
+    match = re.match(r"^!buy_stock\s+([A-Za-z]+)\s+(\d+)$", message.content.strip())
+    if not match or int(match.group(2)) < 1:
+        await send_error("Invalid syntax. [SYNTAX] !buy_stock <symbol> <number_of_shares>", message.channel.id)
         return
-    users[server_id][str(user_id)]["wallet"] += amount
+    await purchase_stock(message, match.group(1).upper(), int(match.group(2)), str(message.author.id), str(message.guild.id))
+
+async def purchase_stock(message = None, stock_name = None, quantity = None, user_id = None, server_id = None):
+    channel_id = message.channel.id
+    stocks, users = await asyncio.gather(async_load_json(STOCKS_FILE), async_load_json(USERS_FILE))
+    ticker = stocks.get(server_id, {}).get("Tickers", {}).get(stock_name)
+    if not ticker:
+        await send_error(f"{stock_name} was not found.", channel_id)
+        return
+    user = users[server_id][user_id]
+    cost = math.ceil(current_stock_price(server_id, stock_name, ticker) * quantity)
+    if cost > user["wallet"]:
+        await send_error(f"You do not have enough in your wallet to buy {quantity:,} {stock_name} for `${cost:,}`.", channel_id)
+        return
+    adjust_wallet(server_id, user_id, user, -cost, "stock_buy")
+    holding = user.setdefault("stocks", {}).setdefault(stock_name, {"shares": 0, "cost": 0})
+    holding["shares"] += quantity
+    holding["cost"] += cost
     await async_save_json(USERS_FILE, users)
-    await send_message(f"{amount} successfully added to {users[server_id][str(user_id)]["display_name"]}'s wallet.", message.channel.id)
+    sync_user_rankings(server_id, user_id, user)
+    await send_message(f"Bought {quantity:,} {stock_name} for `${cost:,}` (`${cost / quantity:,.2f}` each).", channel_id)
 
-async def purchase_stock(message = None, stock_name = None, quanitity = None, user_id = None, server_id = None):
-    return
+async def handle_sell_stock(message): #!sell_stock <symbol> <shares or all>
+    channel_id = message.channel.id
+    server_id = str(message.guild.id)
+    user_id = str(message.author.id)
+    match = re.match(r"^!sell_stock\s+([A-Za-z]+)\s+(\d+|all)$", message.content.strip(), re.IGNORECASE)
+    if not match or match.group(2) == "0":
+        await send_error("Invalid syntax. [SYNTAX] !sell_stock <symbol> <number_of_shares or all>", channel_id)
+        return
+    symbol = match.group(1).upper()
+    stocks, users = await asyncio.gather(async_load_json(STOCKS_FILE), async_load_json(USERS_FILE))
+    ticker = stocks.get(server_id, {}).get("Tickers", {}).get(symbol)
+    user = users[server_id][user_id]
+    holding = user.get("stocks", {}).get(symbol)
+    if not ticker or not holding:
+        await send_error(f"You do not have any {symbol} shares.", channel_id)
+        return
+    quantity = holding["shares"] if match.group(2).lower() == "all" else int(match.group(2))
+    if quantity > holding["shares"]:
+        await send_error(f"You do not have {quantity:,} {symbol} shares.", channel_id)
+        return
+    worth = int(current_stock_price(server_id, symbol, ticker) * quantity)
+    adjust_wallet(server_id, user_id, user, worth, "stock_sell")
+    if quantity == holding["shares"]:
+        del user["stocks"][symbol]
+    else:
+        holding["cost"] -= round(holding["cost"] * quantity / holding["shares"])
+        holding["shares"] -= quantity
+    await async_save_json(USERS_FILE, users)
+    sync_user_rankings(server_id, user_id, user)
+    await send_message(f"Sold {quantity:,} {symbol} for `${worth:,}`.", channel_id)
+
+async def handle_create_stock(message): #!create_stock <symbol> (<name>) <price> <OPTIONAL_volatility_percent_per_hour>
+    channel_id = message.channel.id
+    server_id = str(message.guild.id)
+    match = re.match(r"^!create_stock\s+(\S+)\s+\(([^)]+)\)\s+(\d+)(?:\s+(\d+(?:\.\d+)?))?$", message.content.strip())
+    if not match or not STOCK_SYMBOL_PATTERN.match(match.group(1).upper()) or int(match.group(3)) < 1:
+        await send_error("Invalid syntax. [SYNTAX] !create_stock <SYMBOL> (<name>) <price> <OPTIONAL_volatility_percent_per_hour>", channel_id)
+        return
+    symbol = match.group(1).upper()
+    price = int(match.group(3))
+    volatility = float(match.group(4)) if match.group(4) else STOCK_DEFAULT_VOLATILITY
+    stocks = await async_load_json(STOCKS_FILE)
+    tickers = stocks.setdefault(server_id, {"Tickers": {}})["Tickers"]
+    if symbol in tickers:
+        await send_error(f"{symbol} already exists on the market.", channel_id)
+        return
+    ticker = tickers[symbol] = {
+        "name": match.group(2),
+        "price": price,
+        "mean_price": price,
+        "volatility": volatility,
+        "reversion": STOCK_DEFAULT_REVERSION,
+        "created": datetime.now(timezone.utc).isoformat()
+    }
+    await async_save_json(STOCKS_FILE, stocks)
+    run_after_commit(lambda: add_ticker_to_market(server_id, symbol, ticker))
+    await send_message(f"{symbol} ({match.group(2)}) is now on the market at `${price:,}`.", channel_id)
+
+async def handle_delete_stock(message): #!delete_stock <symbol>, holders are paid out at the current price
+    channel_id = message.channel.id
+    server_id = str(message.guild.id)
+    args = message.content.split()
+    if len(args) != 2:
+        await send_error("Invalid syntax. [SYNTAX] !delete_stock <SYMBOL>", channel_id)
+        return
+    symbol = args[1].upper()
+    stocks, users = await asyncio.gather(async_load_json(STOCKS_FILE), async_load_json(USERS_FILE))
+    tickers = stocks.get(server_id, {}).get("Tickers", {})
+    if symbol not in tickers:
+        await send_error(f"{symbol} was not found.", channel_id)
+        return
+    price = current_stock_price(server_id, symbol, tickers.pop(symbol))
+    paid = holders = 0
+    for user_id, user in users.get(server_id, {}).items():
+        holding = user.get("stocks", {}).pop(symbol, None)
+        if holding:
+            worth = int(price * holding["shares"])
+            adjust_wallet(server_id, user_id, user, worth, "stock_payout")
+            paid += worth
+            holders += 1
+            sync_user_rankings(server_id, user_id, user)
+    await asyncio.gather(async_save_json(STOCKS_FILE, stocks), async_save_json(USERS_FILE, users))
+    run_after_commit(lambda: MARKET.remove(server_id, symbol))
+    await send_message(f"{symbol} was removed from the market. `${paid:,}` was paid out to {holders:,} holder{"s" if holders != 1 else ""} at `${price:,.2f}` a share.", channel_id)
 
 async def set_enabled_commands(message):
     global USER_COMMANDS
@@ -551,7 +2442,7 @@ async def set_enabled_commands(message):
     return
 
 async def handle_help(message):
-    await message.channel.send(f"{USER_COMMANDS, MODERATOR_COMMANDS if await validate_user_permission(message.guild.id, message.author.id) else USER_COMMANDS}")
+    await send_message(f"{USER_COMMANDS, MODERATOR_COMMANDS if await validate_user_permission(message.guild.id, message.author.id) else USER_COMMANDS}", message.channel.id)
 
 async def handle_wallet(message):
     server_id = str(message.guild.id)
@@ -569,6 +2460,9 @@ async def ensure_file_exists(filepath):
             print(f"[yellow]JSON not found. {filepath} was created")
 
 async def populate_data_folder():
+    if STORAGE_BACKEND == "sqlite":
+        get_store()
+        return
     for file in FILEPATHS:
         await ensure_file_exists(file)
         if DEBUG:
@@ -576,33 +2470,1031 @@ async def populate_data_folder():
 
 # Load/Save helpers
 async def async_load_json(path):
-    await ensure_file_exists(path)
-    async with aiofiles.open(path, "r", encoding="utf-8") as f:
-        content = await f.read()
-        if not content.strip():
-            return {}
-        return json.loads(content)
+    view = CURRENT_READ_VIEW.get()
+    if view:
+        return view.load(path)
+    transaction = CURRENT_TRANSACTION.get()
+    if transaction and not transaction.closed:
+        return await transaction.load(path)
+    return await read_json_file(path)
 
 async def async_save_json(path, data):
-    async with aiofiles.open(path, "w", encoding="utf-8") as f:
-        await f.write(json.dumps(data, indent=4))
+    if CURRENT_READ_VIEW.get():
+        raise RuntimeError(f"{CURRENT_COMMAND.get()} tried to save {os.path.basename(path)} during a fast read")
+    transaction = CURRENT_TRANSACTION.get()
+    if transaction and not transaction.closed:
+        transaction.save(path, data)
+        return
+    await write_json_file(path, data)
+
+async def read_json_file(path):
+    file_name = os.path.basename(path)
+    with trace_span("storage.load", file = file_name) as span:
+        if STORAGE_BACKEND == "sqlite":
+            data, size = await asyncio.to_thread(get_store().load, file_name)
+        else:
+            await ensure_file_exists(path)
+            async with aiofiles.open(path, "rb") as f:
+                content = await f.read()
+            data, size = decode_data(content), len(content)
+        METRICS.inc("commerce_json_loads_total", command = CURRENT_COMMAND.get(), file = file_name)
+        METRICS.inc("commerce_json_load_bytes_total", size, command = CURRENT_COMMAND.get(), file = file_name)
+        if span:
+            span.attributes["bytes"] = size
+        return data
+
+async def write_json_file(path, data, storage_format = None):
+    file_name = os.path.basename(path)
+    with trace_span("storage.save", file = file_name) as span:
+        if STORAGE_BACKEND == "sqlite":
+            size = await asyncio.to_thread(get_store().save, file_name, data, storage_format)
+            content = None
+        else:
+            content = encode_data(data, storage_format)
+            async with aiofiles.open(path, "wb") as f:
+                await f.write(content)
+            size = len(content)
+        if path in FILEPATHS:
+            stage_read_state(path, content if content is not None else encode_json(data))
+        METRICS.inc("commerce_json_saves_total", command = CURRENT_COMMAND.get(), file = file_name)
+        METRICS.inc("commerce_json_save_bytes_total", size, command = CURRENT_COMMAND.get(), file = file_name)
+        if span:
+            span.attributes["bytes"] = size
+    index_autocomplete(path, data)
+
+# Fast reads
+def stage_read_state(path, content): #Called with every write, the content is kept as written so later changes to the data can't leak in
+    READ_STATE_PENDING[path] = content
+    if not STATE_LOCK.locked(): #Nothing else is part of the same change
+        publish_read_state()
+
+def publish_read_state():
+    global READ_STATE
+    if READ_STATE_PENDING:
+        READ_STATE = {**READ_STATE, **READ_STATE_PENDING}
+        READ_STATE_PENDING.clear()
+
+async def seed_read_state(paths, locked = False): #Files nothing has written since startup are read once, while no command is half done
+    if all(path in READ_STATE for path in paths):
+        return
+    if not locked:
+        async with STATE_LOCK:
+            await seed_read_state(paths, True)
+        return
+    for path in paths:
+        if path not in READ_STATE and path not in READ_STATE_PENDING:
+            READ_STATE_PENDING[path] = await read_json_file(path)
+
+def decode_published(path, content): #Decoded once per published version and shared, so it must not be changed
+    if not isinstance(content, bytes):
+        return content
+    cached = READ_DECODED.get(path)
+    if cached and cached[0] is content:
+        return cached[1]
+    data = decode_data(content)
+    if READ_STATE.get(path) is content or READ_STATE_PENDING.get(path) is content: #Older versions decode for themselves
+        READ_DECODED[path] = (content, data)
+    return data
+
+class ReadView:
+    """
+    The data files as they were the last time STATE_LOCK was released, so never halfway through a command.
+    Loads return objects shared with every other fast read, which must not be changed.
+    """
+    def __init__(self):
+        self.state = READ_STATE
+
+    def load(self, path):
+        return decode_published(path, self.state[path])
+
+async def try_fast_read(message):
+    """
+    Answers a read-only command from the published state instead of queueing it. Returns False when the command
+    has to go through the queue: it isn't a fast read, it would create the user or server, or the same user still
+    has a command queued (so they always see the result of their own last command).
+    """
+    args = message.content.split()
+    command = args[0].lower() if args else ""
+    if not FAST_READS or command not in FAST_READ_COMMANDS or parse_batch(message.content):
+        return False
+    server_id, user_id = str(message.guild.id), str(message.author.id)
+    if any(str(queued.guild.id) == server_id and str(queued.author.id) == user_id for queued, _ in COMMAND_QUEUE):
+        return False
+    await seed_read_state(FAST_READ_FILES)
+    view = ReadView()
+    if not all(server_id in view.load(path) for path in FAST_READ_FILES) or user_id not in view.load(USERS_FILE)[server_id]:
+        return False
+
+    started_at = time.perf_counter()
+    token = CURRENT_READ_VIEW.set(view)
+    command_token = CURRENT_COMMAND.set(command)
+    span = None
+    try:
+        with trace_span(command, root = True, server_id = server_id, user_id = user_id, content = message.content[:200], fast_read = True) as span:
+            await check_for_command(message)
+    except Exception:
+        METRICS.inc("commerce_command_errors_total", command = command)
+        raise
+    finally:
+        CURRENT_READ_VIEW.reset(token)
+        CURRENT_COMMAND.reset(command_token)
+        METRICS.inc("commerce_fast_reads_total", command = command)
+        METRICS.observe("commerce_fast_read_duration_seconds", time.perf_counter() - started_at, command = command)
+        if span and span.duration_ms >= TRACE_SLOW_MS:
+            await log_slow_trace(span)
+    return True
+
+def get_store():
+    global STORE
+    if STORE is None:
+        STORE = SqliteStore(STORAGE_DB, LEASE_OWNER)
+    return STORE
+
+def get_ledger():
+    global LEDGER
+    if LEDGER is None:
+        LEDGER = Ledger(LEDGER_DIR).open()
+    return LEDGER
+
+def record_ledger_entry(server_id, user_id, amount, balance, kind, reference = None): #Written once the command's data is saved
+    def commit():
+        get_ledger().append(server_id, user_id, amount, balance, kind, reference)
+        count_economy_flow(server_id, kind, amount)
+    run_after_commit(commit)
+
+def count_economy_flow(server_id, kind, amount):
+    flow = ECONOMY_FLOWS.setdefault(str(server_id), {}).setdefault(kind, [0, 0, 0])
+    flow[0] += 1
+    if amount >= 0:
+        flow[1] += amount
+    else:
+        flow[2] -= amount
+
+def adjust_wallet(server_id, user_id, user, amount, kind, reference = None): #Every wallet change goes through here so it lands in the ledger
+    user["wallet"] += amount
+    record_ledger_entry(server_id, user_id, amount, user["wallet"], kind, reference)
+
+def close_wallet(server_id, user_id, user): #Call when a user is removed, the money in their wallet leaves the economy with them
+    record_ledger_entry(server_id, user_id, -user["wallet"], 0, "close")
+
+def pay_for_auction(server_id, server_users, winner_id, seller_id, amount, auction_id): #A user seller gets the winning bid, otherwise it leaves the economy
+    if seller_id in server_users:
+        adjust_wallet(server_id, winner_id, server_users[winner_id], -amount, "auction_won", auction_id)
+        adjust_wallet(server_id, seller_id, server_users[seller_id], amount, "auction_sold", auction_id)
+    else: #Server auctions, or a seller who has left
+        adjust_wallet(server_id, winner_id, server_users[winner_id], -amount, "auction_sink", auction_id)
+
+def count_pool_flow(server_id, kind, amount): #Counted once the command's data is saved, like wallet changes
+    if amount:
+        run_after_commit(lambda: count_economy_flow(server_id, kind, amount))
+
+async def ledger_loop():
+    last_index = time.monotonic()
+    while True:
+        await asyncio.sleep(LEDGER_FLUSH_SECONDS)
+        try:
+            ledger = get_ledger()
+            ledger.flush()
+            if time.monotonic() - last_index >= LEDGER_INDEX_SECONDS:
+                last_index = time.monotonic()
+                await asyncio.to_thread(ledger.write_index, ledger.checkpoint())
+        except Exception as e:
+            print(f"[red]Ledger flush failed: {e!r}")
+
+async def get_archive(server_id): #Opened in a thread the first time, opening may rescan segments
+    server_id = str(server_id)
+    if server_id not in ARCHIVES:
+        opening = ARCHIVES_OPENING.get(server_id)
+        if opening is None:
+            opening = ARCHIVES_OPENING[server_id] = asyncio.ensure_future(asyncio.to_thread(Archive(os.path.join(ARCHIVE_DIR, server_id)).open))
+        try:
+            ARCHIVES[server_id] = await asyncio.shield(opening)
+        finally:
+            if opening.done() and ARCHIVES_OPENING.get(server_id) is opening: #Tried again next time if it failed
+                del ARCHIVES_OPENING[server_id]
+    return ARCHIVES[server_id]
+
+async def archive_record(server_id, kind, record_id, record): #Written once the command's data is saved, like ledger entries
+    record = {key: value for key, value in record.items() if key != "version"}
+    archive = await get_archive(server_id)
+    run_after_commit(lambda: archive.append(kind, record_id, record))
+
+async def archive_loop():
+    while True:
+        await asyncio.sleep(ARCHIVE_INDEX_SECONDS)
+        for archive in list(ARCHIVES.values()):
+            try:
+                while archive.full:
+                    await asyncio.to_thread(archive.compact, archive.full[0])
+                    archive.full.pop(0)
+            except Exception as e:
+                print(f"[red]Archive upkeep failed for {archive.directory}: {e!r}")
+
+def owns_server(server_id): #Whether server_id is on one of this process's shards, always true unsharded
+    return not SHARD_COUNT or (int(server_id) >> 22) % SHARD_COUNT in SHARD_IDS
+
+async def lease_loop(): #Keeps this process's servers leased while it's alive
+    while True:
+        await asyncio.sleep(GUILD_LEASE_SECONDS / 3)
+        try:
+            await asyncio.to_thread(get_store().heartbeat)
+        except sqlite3.Error as e:
+            print(f"[red]Could not renew server leases: {e}")
+
+async def import_files(): #Copies the JSON data files into the SQLite store
+    if STORAGE_BACKEND != "sqlite":
+        print("[red]Set STORAGE_BACKEND=sqlite first.")
+        return
+    files = []
+    for path in FILEPATHS:
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                files.append((os.path.basename(path), decode_data(f.read())))
+    await asyncio.to_thread(get_store().replace_all, files)
+    for file_name, data in files:
+        print(f"[green]{file_name}: {sum(1 for server_id in data if owns_server(server_id))} servers imported into {STORAGE_DB}")
+
+class JsonStream:
+    """
+    Reads one JSON document from a binary file a buffer at a time, so a huge object can be walked member by member
+    without decoding all of it. members() yields an object's keys, the caller reads each value with value() or by
+    walking it with members() too. tell() is the byte offset reached, and a stream opened at such an offset continues
+    the object it was in with members(resume = True).
+    """
+    WHITESPACE = re.compile(r"[ \t\n\r]*")
+    DECODER = json.JSONDecoder()
+    LOOKAHEAD = 64 #Characters before the end of the buffer a value or error may still change in once more is read
+
+    def __init__(self, f, offset = 0, read_bytes = None):
+        f.seek(offset)
+        self.f = f
+        self.read_bytes = read_bytes or MIGRATE_READ_BYTES
+        self.utf8 = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.pos = 0
+        self.offset = offset #Bytes before buffer[0]
+        self.eof = False
+
+    def fill(self): #Reads at least as much again as is buffered, so retrying a long value is never quadratic
+        if self.eof:
+            return False
+        chunk = self.f.read(max(self.read_bytes, len(self.buffer) - self.pos))
+        self.eof = not chunk
+        self.offset += len(self.buffer[:self.pos].encode("utf-8"))
+        self.buffer = self.buffer[self.pos:] + self.utf8.decode(chunk, final = self.eof)
+        self.pos = 0
+        return bool(chunk)
+
+    def tell(self):
+        return self.offset + len(self.buffer[:self.pos].encode("utf-8"))
+
+    def peek(self):
+        while True:
+            self.pos = self.WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ""
+
+    def expect(self, characters):
+        character = self.peek()
+        if not character or character not in characters:
+            raise ValueError(f"expected {" or ".join(characters)} at byte {self.tell():,}, found {character or "the end of the file"}")
+        self.pos += 1
+        return character
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.DECODER.raw_decode(self.buffer, self.pos)
+                if end + self.LOOKAHEAD < len(self.buffer) or self.eof: #A number near the end of the buffer may continue in the next read
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError as e:
+                #A value cut off by the end of the buffer fails right at the end, or as a string still being read.
+                #Anything else is a real syntax error, raised before reading on so a bad file is never buffered whole.
+                if self.eof or (e.pos + self.LOOKAHEAD < len(self.buffer) and not e.msg.startswith("Unterminated string")):
+                    raise ValueError(f"invalid JSON at byte {self.offset + len(self.buffer[:e.pos].encode("utf-8")):,}: {e.msg}")
+            self.fill()
+
+    def members(self, resume = False):
+        if not resume:
+            self.expect("{")
+            if self.peek() == "}":
+                self.pos += 1
+                return
+        elif self.expect(",}") == "}":
+            return
+        while True:
+            key = self.value()
+            if not isinstance(key, str):
+                raise ValueError(f"expected a key at byte {self.tell():,}")
+            self.expect(":")
+            yield key
+            if self.expect(",}") == "}":
+                return
+
+class MigrationReport:
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.servers = 0
+        self.records = 0
+        self.normalized = 0 #Values rewritten to the form the bot writes, e.g "5" -> 5 or "free" -> "Free"
+        self.problems = 0 #Values that had to be replaced or dropped
+        self.messages = []
+
+    def problem(self, where, text):
+        self.problems += 1
+        if len(self.messages) < MIGRATE_MAX_PROBLEMS:
+            self.messages.append(f"{where}: {text}")
+
+def migrate_int(value, report, where, default = 0):
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, float) and value.is_integer() or isinstance(value, str) and value.strip().lstrip("-").isdigit():
+        report.normalized += 1
+        return int(value)
+    report.problem(where, f"{value!r} is not a whole number, set to {default}")
+    return default
+
+def migrate_id(value, report, where): #Ids are digit strings everywhere, older data has some as ints
+    if isinstance(value, str) and value.isdigit():
+        return value
+    if isinstance(value, int) and not isinstance(value, bool) and value >= 0 or isinstance(value, str) and value.strip().isdigit():
+        report.normalized += 1
+        return str(value).strip()
+    return None
+
+def migrate_sentinel(value, word, report, where, zero_means_word = False): #Counts that can also be "Free", "Unlimited" or "Never"
+    if value == word:
+        return word
+    if value is None or isinstance(value, str) and value.strip().lower() == word.lower() or zero_means_word and value in (0, "0"):
+        report.normalized += 1
+        return word
+    return migrate_int(value, report, where, word)
+
+def migrate_user(user, report, where):
+    if not isinstance(user, dict):
+        report.problem(where, "not a user record, dropped")
+        return None
+    record = dict(user)
+    for field, default in new_user_record("", "").items():
+        if field == "inventory":
+            continue
+        if field not in user:
+            report.normalized += 1
+            record[field] = default
+        elif field in ("display_name", "user_name"):
+            record[field] = str(user[field]) if user[field] is not None else ""
+        else:
+            record[field] = migrate_int(user[field], report, f"{where} {field}", default)
+    inventory = user.get("inventory", {})
+    record["inventory"] = {}
+    for item_id, item in (inventory.items() if isinstance(inventory, dict) else []):
+        normalized_id = migrate_id(item_id, report, where)
+        if normalized_id is None or not isinstance(item, dict) or not item.get("name"):
+            report.problem(f"{where} inventory {item_id}", "not an inventory item, dropped")
+            continue
+        quantity = migrate_int(item.get("quantity", 0), report, f"{where} inventory {item_id} quantity")
+        if quantity <= 0:
+            report.normalized += 1
+            continue
+        record["inventory"][normalized_id] = dict(item, name = str(item["name"]), quantity = quantity, value = migrate_int(item.get("value", 0), report, f"{where} inventory {item_id} value"))
+    return record
+
+def migrate_ids(section, report, where, migrate_record): #{id: record} with every id a digit string, records that can't be fixed are dropped
+    migrated = {}
+    for record_id, record in (section.items() if isinstance(section, dict) else []):
+        normalized_id = migrate_id(record_id, report, where)
+        record = migrate_record(record, report, f"{where} {record_id}") if normalized_id is not None and isinstance(record, dict) else None
+        if record is None:
+            report.problem(f"{where} {record_id}", "dropped")
+            continue
+        migrated[normalized_id] = record
+    return migrated
+
+def migrate_shop_item(item, report, where):
+    if not item.get("name"):
+        return None
+    return dict(
+        item,
+        name = str(item["name"]),
+        price = migrate_sentinel(item.get("price"), "Free", report, f"{where} price", zero_means_word = True),
+        quantity = migrate_sentinel(item.get("quantity"), "Unlimited", report, f"{where} quantity"),
+        refresh_time = migrate_sentinel(item.get("refresh_time"), "Never", report, f"{where} refresh_time"),
+        active = bool(item.get("active", True))
+    )
+
+def migrate_auction(auction, report, where):
+    migrated = dict(auction)
+    for field in ("quantity", "current_bid", "value", "number_of_bids"):
+        migrated[field] = migrate_int(auction.get(field, 0), report, f"{where} {field}")
+    for field in ("item_id", "user_id", "current_highest_bidder_id"): #user_id is None for moderator auctions
+        if auction.get(field) is not None:
+            migrated[field] = migrate_id(auction[field], report, where)
+    migrated["bids"] = migrate_ids(auction.get("bids", {}), report, f"{where} bid", lambda bid, report, where: dict(bid, user_id = migrate_id(bid.get("user_id"), report, where), amount = migrate_int(bid.get("amount", 0), report, f"{where} amount")))
+    return migrated
+
+def migrate_prediction(prediction, report, where):
+    migrated = dict(prediction, title = str(prediction.get("title", "")), open = bool(prediction.get("open", False)))
+    migrated["options"] = {str(option_id): str(option) for option_id, option in prediction.get("options", {}).items()}
+    migrated["user_bets"] = migrate_ids(prediction.get("user_bets", {}), report, f"{where} bet", lambda bet, report, where: dict(bet, option = str(bet.get("option")), amount = migrate_int(bet.get("amount", 0), report, f"{where} amount")))
+    total_bets = sum(bet["amount"] for bet in migrated["user_bets"].values())
+    if migrate_int(prediction.get("total_bets", 0), report, f"{where} total_bets") != total_bets:
+        report.problem(where, f"total_bets was {prediction.get("total_bets")!r}, set to the bets' sum {total_bets}")
+    migrated["total_bets"] = total_bets
+    return migrated
+
+def next_id(current, records, report, where): #Next ids always have to be past every id in use
+    current = migrate_int(current, report, where, 1)
+    highest = max((int(record_id) for record_id in records), default = 0)
+    if current <= highest:
+        report.problem(where, f"{current} is already in use, set to {highest + 1}")
+        return highest + 1
+    return current
+
+def migrate_server(file_name, server, report, where):
+    """Checks and normalizes one server's data from file_name. users.json is normally streamed a user at a time instead"""
+    if not isinstance(server, dict):
+        report.problem(where, "not an object, dropped")
+        return None
+    if file_name == os.path.basename(USERS_FILE):
+        return migrate_ids(server, report, f"{where} user", migrate_user)
+    if file_name == os.path.basename(SHOP_FILE):
+        items = migrate_ids(server.get("Items", {}), report, f"{where} item", migrate_shop_item)
+        auctions = migrate_ids(server.get("Auctions", {}), report, f"{where} auction", migrate_auction)
+        return dict(
+            server, Items = items, Auctions = auctions,
+            **{"Next Shop ID": next_id(server.get("Next Shop ID", 1), items, report, f"{where} Next Shop ID"),
+               "Next Auction ID": next_id(server.get("Next Auction ID", 1), auctions, report, f"{where} Next Auction ID")}
+        )
+    if file_name == os.path.basename(PREDICTIONS_FILE):
+        predictions = migrate_ids(server.get("Predictions", {}), report, f"{where} prediction", migrate_prediction)
+        data = dict(server.get("Data", {}))
+        data["next_bet_number"] = next_id(data.get("next_bet_number", 1), predictions, report, f"{where} next_bet_number")
+        return dict(server, Predictions = predictions, Data = data)
+    return server
+
+def encode_member(key, value, storage_format): #One key and value of an object, joined by encode_members
+    if storage_format == "msgpack" and msgpack:
+        return msgpack.packb(key) + msgpack.packb(value, use_bin_type = True)
+    return encode_json(key) + b":" + encode_json(value)
+
+def encode_members(members, storage_format): #Same bytes as encode_data would write for the whole object (compact for pretty)
+    if storage_format == "msgpack" and msgpack:
+        packer = msgpack.Packer()
+        return MSGPACK_MARKER + packer.pack_map_header(len(members)) + b"".join(members)
+    return b"{" + b",".join(members) + b"}"
+
+def migrate_file(path, store, restart, chunk_bytes):
+    """
+    Streams one data file into the SQLite store a server at a time (a user at a time for users.json), committing
+    every chunk_bytes together with how far the file was read. A rerun picks up after the last commit.
+    """
+    file_name = os.path.basename(path)
+    report = MigrationReport(file_name)
+    if not os.path.exists(path):
+        return report
+    stat = os.stat(path)
+    source = [stat.st_size, stat.st_mtime_ns]
+    offset = 0
+    if store and not restart:
+        row = store.connection.execute("SELECT size, mtime, offset, done FROM migration WHERE file = ?", (file_name,)).fetchone()
+        if row and list(row[:2]) == source:
+            if row[3]:
+                print(f"[green]{file_name}: already migrated, skipped (--restart to migrate it again)")
+                return report
+            offset = row[2]
+            print(f"[green]{file_name}: resuming at byte {offset:,} of {stat.st_size:,}")
+        elif row:
+            print(f"[yellow]{file_name}: changed since the interrupted migration, starting over")
+
+    with open(path, "rb") as f:
+        if f.read(len(MSGPACK_MARKER)) == MSGPACK_MARKER: #Already compact, and msgpack can't be walked like JSON
+            f.seek(0)
+            servers = decode_data(f.read())
+            stream = None
+        else:
+            stream = JsonStream(f, offset)
+            servers = stream.members(resume = offset > 0) if offset or stream.peek() else iter(())
+        rows, pending, first_commit = [], 0, offset == 0
+        last_progress = time.monotonic()
+
+        def progress(force = False):
+            nonlocal last_progress
+            if force or time.monotonic() - last_progress >= MIGRATE_PROGRESS_SECONDS:
+                last_progress = time.monotonic()
+                done = stream.tell() if stream else stat.st_size
+                print(f"{file_name}: {done / max(stat.st_size, 1):6.1%}  {done / 1e6:,.1f} of {stat.st_size / 1e6:,.1f} MB  {report.servers:,} servers  {report.records:,} records")
+
+        def commit(done = False):
+            nonlocal rows, pending, first_commit
+            if store:
+                with store.lock:
+                    store.connection.execute("BEGIN IMMEDIATE")
+                    try:
+                        if first_commit: #The file replaces whatever an earlier migration or import-files wrote for it
+                            store.connection.execute("DELETE FROM state WHERE file = ?", (file_name,))
+                        store.connection.executemany(
+                            "INSERT INTO state (file, server_id, data) VALUES (?, ?, ?) ON CONFLICT (file, server_id) DO UPDATE SET data = excluded.data", rows
+                        )
+                        store.connection.execute(
+                            "INSERT OR REPLACE INTO migration (file, size, mtime, offset, done) VALUES (?, ?, ?, ?, ?)",
+                            (file_name, *source, stream.tell() if stream and not done else stat.st_size, int(done))
+                        )
+                        store.connection.execute("COMMIT")
+                    except BaseException:
+                        store.connection.execute("ROLLBACK")
+                        raise
+            rows, pending, first_commit = [], 0, False
+
+        for server_id in servers:
+            where = f"{file_name} server {server_id}"
+            valid_id = migrate_id(server_id, report, where)
+            if file_name == os.path.basename(USERS_FILE) and stream and stream.peek() == "{":
+                members = []
+                for user_id in stream.members():
+                    user = migrate_user(stream.value(), report, f"{where} user {user_id}")
+                    valid_user_id = migrate_id(user_id, report, where) if user is not None else None
+                    if valid_user_id is not None:
+                        members.append(encode_member(valid_user_id, user, STORAGE_FORMAT))
+                    elif user is not None:
+                        report.problem(f"{where} user {user_id}", "id is not a number, dropped")
+                    report.records += 1
+                    if report.records % 10_000 == 0:
+                        progress()
+                content = encode_members(members, STORAGE_FORMAT)
+                del members
+            else:
+                server = migrate_server(file_name, stream.value() if stream else servers[server_id], report, where)
+                content = encode_data(server) if server is not None else None
+                report.records += 1
+            if valid_id is None:
+                report.problem(where, "server id is not a number, dropped")
+                continue
+            report.servers += 1
+            if content is not None:
+                rows.append((file_name, valid_id, content))
+                pending += len(content)
+            if pending >= chunk_bytes:
+                commit()
+            progress()
+        if stream and stream.peek():
+            raise ValueError(f"unexpected data after the end of {file_name} at byte {stream.tell():,}")
+        commit(done = True)
+        progress(force = True)
+    return report
+
+def migrate_files(dry_run = False, restart = False, chunk_bytes = None):
+    """python bot.py migrate: streams every data file into the SQLite store, validating and normalizing as it goes"""
+    if not dry_run and STORAGE_BACKEND != "sqlite":
+        print("[red]Set STORAGE_BACKEND=sqlite first, or use --dry-run to only check the files.")
+        return False
+    store = None
+    if not dry_run:
+        store = get_store()
+        store.connection.execute("CREATE TABLE IF NOT EXISTS migration (file TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, offset INTEGER, done INTEGER)")
+    clean = True
+    for path in FILEPATHS:
+        try:
+            report = migrate_file(path, store, restart, chunk_bytes or MIGRATE_CHUNK_BYTES)
+        except ValueError as e:
+            print(f"[red]{os.path.basename(path)}: {e}. Everything before it was {"checked" if dry_run else "committed"}, rerun after fixing the file.")
+            return False
+        if report.problems:
+            clean = False
+            print(f"[yellow]{report.file_name}: {report.problems:,} problem{"s" if report.problems != 1 else ""}{", showing the first " + str(MIGRATE_MAX_PROBLEMS) if report.problems > MIGRATE_MAX_PROBLEMS else ""}")
+            for message in report.messages:
+                print(f"  {message}")
+        if report.servers or report.normalized:
+            print(f"[green]{report.file_name}: {report.servers:,} servers {"checked" if dry_run else "migrated"}, {report.normalized:,} values normalized or filled in")
+    if dry_run:
+        print(f"[green]Dry run, nothing was written.{"" if clean else " Problems above are fixed or dropped as described when migrating."}")
+    else:
+        store.hashes.clear()
+    return True
+
+# Codecs
+def stringify_keys(data): #msgpack keeps int keys, JSON turns them into strings. The handlers expect strings.
+    if isinstance(data, dict):
+        return {str(key): stringify_keys(value) for key, value in data.items()}
+    if isinstance(data, list):
+        return [stringify_keys(value) for value in data]
+    return data
+
+def encode_json(data, pretty = False):
+    if orjson and not pretty:
+        try:
+            return orjson.dumps(data, option = orjson.OPT_NON_STR_KEYS)
+        except (TypeError, orjson.JSONEncodeError): #e.g ints over 64 bits, the stdlib handles them
+            pass
+    if pretty:
+        return json.dumps(data, indent = 4).encode("utf-8")
+    return json.dumps(data, separators = (",", ":")).encode("utf-8")
+
+def decode_json(content):
+    if orjson:
+        return orjson.loads(content)
+    return json.loads(content)
+
+def encode_data(data, storage_format = None):
+    storage_format = storage_format or STORAGE_FORMAT
+    if storage_format == "msgpack" and msgpack:
+        try:
+            return MSGPACK_MARKER + msgpack.packb(stringify_keys(data), use_bin_type = True)
+        except (OverflowError, TypeError, ValueError): #Anything msgpack can't hold is still written, as JSON
+            if DEBUG:
+                print("[yellow]Data could not be packed as msgpack, writing JSON instead.")
+    return encode_json(data, pretty = storage_format == "pretty")
+
+def decode_data(content):
+    if content.startswith(MSGPACK_MARKER):
+        if not msgpack:
+            raise RuntimeError("This data file is stored as msgpack. Install msgpack (pip install msgpack) to read it.")
+        return msgpack.unpackb(content[len(MSGPACK_MARKER):], raw = False, strict_map_key = False)
+    if not content.strip():
+        return {}
+    return decode_json(content)
+
+def copy_data(data): #Deep copy with the same result as writing and reading the data back
+    return decode_json(encode_json(data))
+
+async def convert_storage(storage_format): #Rewrites every data file in storage_format
+    if storage_format == "msgpack" and not msgpack:
+        print("[red]msgpack is not installed. Run pip install msgpack first.")
+        return
+    for path in FILEPATHS:
+        data = await read_json_file(path)
+        if STORAGE_BACKEND == "sqlite":
+            await write_json_file(path, data, storage_format)
+            print(f"[green]{os.path.basename(path)}: {len(data)} servers rewritten in {STORAGE_DB} ({storage_format})")
+            continue
+        before = os.path.getsize(path)
+        await write_json_file(path, data, storage_format)
+        print(f"[green]{os.path.basename(path)}: {before:,} -> {os.path.getsize(path):,} bytes ({storage_format})")
+
+# Snapshots
+def open_snapshot(path, mode): #Binary stream, zstd or gzip depending on the file name
+    if path.endswith(".zst"):
+        if not zstandard:
+            raise RuntimeError("This snapshot is compressed with zstd. Install zstandard (pip install zstandard) to read it.")
+        f = open(path, mode)
+        if mode == "wb":
+            return zstandard.ZstdCompressor(level = 6).stream_writer(f, closefd = True)
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(f, closefd = True))
+    return gzip.open(path, mode, compresslevel = 6)
+
+def file_checksum(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def snapshot_servers(content): #Yields (server_id, data) of one file, a JSON file is decoded a server at a time
+    if not isinstance(content, bytes): #Already decoded and shared with fast reads, only read here
+        yield from content.items()
+    elif content.startswith(MSGPACK_MARKER) or not content.strip():
+        yield from decode_data(content).items()
+    else:
+        stream = JsonStream(io.BytesIO(content))
+        for server_id in stream.members():
+            yield server_id, stream.value()
+
+def write_snapshot(path, state):
+    """
+    Writes state ({file_path: encoded or decoded data}) to path as one JSON line per (file, server), between a header and a trailer line.
+    Servers are decoded and encoded one at a time, so the whole data set is never held decoded or serialized at once.
+    Runs in a worker thread. Returns the number of records written
+    """
+    records = 0
+    with open_snapshot(path, "wb") as stream:
+        header = {"format": SNAPSHOT_FORMAT, "version": 1, "created": datetime.now(timezone.utc).isoformat(), "files": [os.path.basename(file_path) for file_path in state]}
+        stream.write(encode_json(header) + b"\n")
+        for file_path, content in state.items():
+            file_name = os.path.basename(file_path)
+            for server_id, server_data in snapshot_servers(content):
+                stream.write(encode_json({"file": file_name, "server_id": server_id, "data": server_data}) + b"\n")
+                records += 1
+        stream.write(encode_json({"end": True, "records": records}) + b"\n")
+    with open(f"{path}.sha256", "w", encoding = "utf-8") as f: #Same layout as sha256sum, so sha256sum -c works too
+        f.write(f"{file_checksum(path)}  {os.path.basename(path)}\n")
+    return records
+
+def list_snapshots(): #Oldest first
+    if not os.path.isdir(SNAPSHOT_DIR):
+        return []
+    names = [name for name in os.listdir(SNAPSHOT_DIR) if name.startswith("snapshot-") and name.endswith((".jsonl.gz", ".jsonl.zst"))]
+    return sorted(names) #Names start with a fixed width UTC timestamp
+
+def prune_snapshots(keep = None):
+    keep = SNAPSHOT_KEEP if keep is None else keep
+    snapshots = list_snapshots()
+    for name in snapshots[:max(0, len(snapshots) - keep)]:
+        for path in (os.path.join(SNAPSHOT_DIR, name), os.path.join(SNAPSHOT_DIR, f"{name}.sha256")):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+
+async def take_snapshot(label = None):
+    """Writes a compressed, checksummed snapshot of every data file and returns its path. Older generations past SNAPSHOT_KEEP are removed."""
+    os.makedirs(SNAPSHOT_DIR, exist_ok = True)
+    extension = ".jsonl.zst" if zstandard else ".jsonl.gz"
+    name = f"snapshot-{datetime.now(timezone.utc):%Y%m%d-%H%M%S-%f}{f"-{label}" if label else ""}{extension}"
+    path = os.path.join(SNAPSHOT_DIR, name)
+    started_at = time.perf_counter()
+    with trace_span("snapshot", root = True) as span:
+        async with STATE_LOCK: #No command runs in between, so every file is from the same moment
+            committed = {**READ_STATE, **READ_STATE_PENDING}
+            state = {}
+            for file_path in FILEPATHS: #As committed, mostly still encoded, so nothing is decoded while commands wait
+                if file_path in committed:
+                    state[file_path] = committed[file_path]
+                elif STORAGE_BACKEND == "sqlite":
+                    state[file_path] = await read_json_file(file_path)
+                else: #Nothing has written it since startup
+                    await ensure_file_exists(file_path)
+                    async with aiofiles.open(file_path, "rb") as f:
+                        state[file_path] = await f.read()
+            del committed
+        lock_seconds = time.perf_counter() - started_at
+        records = await asyncio.to_thread(write_snapshot, path, state)
+        del state
+        await asyncio.to_thread(prune_snapshots)
+        if span:
+            span.attributes.update(records = records, bytes = os.path.getsize(path))
+    if DEBUG:
+        print(f"[green]Snapshot {name}: {records} records, {os.path.getsize(path):,} bytes in {time.perf_counter() - started_at:.2f}s (commands paused {lock_seconds * 1000:.0f}ms)")
+    return path
+
+async def snapshot_loop():
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL_MINUTES * 60)
+        try:
+            await take_snapshot()
+        except Exception as e:
+            print(f"[red]Snapshot failed: {e}")
+
+def find_snapshot(name): #Accepts a file name, a path or "latest"
+    if name == "latest":
+        snapshots = list_snapshots()
+        if not snapshots:
+            raise FileNotFoundError(f"No snapshots in {SNAPSHOT_DIR}")
+        return os.path.join(SNAPSHOT_DIR, snapshots[-1])
+    if os.path.exists(name):
+        return name
+    return os.path.join(SNAPSHOT_DIR, name)
+
+def verify_snapshot(path):
+    checksum_path = f"{path}.sha256"
+    if not os.path.exists(checksum_path):
+        raise ValueError(f"{os.path.basename(path)} has no checksum file, refusing to restore it.")
+    with open(checksum_path, encoding = "utf-8") as f:
+        expected = f.read().split()[0]
+    if file_checksum(path) != expected:
+        raise ValueError(f"{os.path.basename(path)} does not match its checksum, the snapshot is damaged.")
+
+def read_snapshot(path):
+    """Yields (file_name, {server_id: data}) one file at a time. Raises ValueError if the snapshot is cut short or not a snapshot."""
+    with open_snapshot(path, "rb") as stream:
+        header = decode_json(stream.readline() or b"{}")
+        if header.get("format") != SNAPSHOT_FORMAT:
+            raise ValueError(f"{os.path.basename(path)} is not a snapshot.")
+        file_name, data, records = None, {}, 0
+        for line in stream:
+            record = decode_json(line)
+            if record.get("end"):
+                if record["records"] != records:
+                    raise ValueError(f"{os.path.basename(path)} should hold {record['records']} records but has {records}.")
+                break
+            if record["file"] != file_name:
+                if file_name is not None:
+                    yield file_name, data
+                file_name, data = record["file"], {}
+            data[record["server_id"]] = record["data"]
+            records += 1
+        else:
+            raise ValueError(f"{os.path.basename(path)} is incomplete.")
+        if file_name is not None:
+            yield file_name, data
+
+async def restore_snapshot(name):
+    """
+    Checks the snapshot's checksum and contents, writes every data file next to the live one, then swaps them all in.
+    The current data is snapshotted first so a restore can be undone. Stop the bot before restoring.
+    """
+    path = find_snapshot(name)
+    await asyncio.to_thread(verify_snapshot, path)
+    if STORAGE_BACKEND == "sqlite": #One transaction, rolled back if the snapshot turns out to be bad
+        backup = await take_snapshot("pre-restore")
+        await asyncio.to_thread(get_store().replace_all, read_snapshot(path))
+        print(f"[green]Restored {os.path.basename(path)} into {STORAGE_DB}. The previous data was saved as {os.path.basename(backup)}.")
+        return
+    paths = {os.path.basename(file_path): file_path for file_path in FILEPATHS}
+    staged = {}
+    try:
+        for file_name, data in read_snapshot(path):
+            if file_name not in paths:
+                raise ValueError(f"{os.path.basename(path)} contains unknown file {file_name}.")
+            staged[file_name] = f"{paths[file_name]}.restore"
+            await write_json_file(staged[file_name], data)
+        for file_name in paths:
+            if file_name not in staged: #Was empty when the snapshot was taken
+                staged[file_name] = f"{paths[file_name]}.restore"
+                await write_json_file(staged[file_name], {})
+    except Exception:
+        for staged_path in staged.values():
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(staged_path)
+        raise
+    backup = await take_snapshot("pre-restore")
+    for file_name, staged_path in staged.items():
+        os.replace(staged_path, paths[file_name])
+    print(f"[green]Restored {os.path.basename(path)}. The previous data was saved as {os.path.basename(backup)}.")
+
+def run_after_commit(callback): #Runs now, or once the current batch is written to disk
+    transaction = CURRENT_TRANSACTION.get()
+    if transaction and not transaction.closed:
+        transaction.after_commit.append(callback)
+    else:
+        callback()
 
 async def handle_message(message):
+    CURRENT_COMMAND.set("handle_message")
     server_id, user_id = await get_message_ids(message)
-    await add_server_to_jsons(str(server_id))
+    if str(server_id) not in BOOTSTRAPPED_SERVERS:
+        await run_transaction(lambda: add_server_to_jsons(str(server_id)))
     if message.content.startswith("!"):
-        COMMAND_QUEUE.append(message)
+        throttled_scope = check_rate_limits(str(server_id), str(user_id), message.content)
+        if throttled_scope:
+            await send_throttle_notice(message, throttled_scope)
+            return
+        if await try_fast_read(message):
+            return
+        COMMAND_QUEUE.append((message, time.perf_counter()))
+        COMMAND_WAKEUP.set()
+
+def get_command_class(command): #None for anything that isn't a command, those are never charged or throttled
+    if command in DEFAULT_PRIVILEGED_COMMANDS:
+        return "moderator"
+    if command in READ_COMMANDS:
+        return "read"
+    if command in LIST_OF_COMMANDS:
+        return "write"
+    return None
+
+def check_rate_limits(server_id, user_id, content):
+    """
+    Takes tokens for a message from the user's and the server's bucket of each command class it uses (a batch uses one per line,
+    at most a full bucket, so any batch can run once the bucket has refilled). Lines that aren't commands cost nothing.
+    Nothing is taken unless every bucket has enough. Returns the scope that ran out ("user" or "guild"), or None if the message may be queued.
+    """
+    batch = parse_batch(content)
+    costs = {}
+    for line in batch[0] if batch else [content]:
+        command_class = get_command_class(line.split()[0].lower() if line.split() else "")
+        if command_class:
+            costs[command_class] = costs.get(command_class, 0) + 1
+    now = time.monotonic()
+    buckets = []
+    for command_class, lines in costs.items():
+        for scope, key in (("user", (server_id, user_id)), ("guild", server_id)):
+            capacity, per_minute = RATE_LIMITS[command_class][scope]
+            if not per_minute:
+                continue
+            cost = min(lines, capacity)
+            bucket = RATE_BUCKETS.get((scope, key, command_class))
+            if bucket is None:
+                bucket = RATE_BUCKETS[(scope, key, command_class)] = TokenBucket(capacity, per_minute, now)
+            if bucket.refill(now) < cost:
+                METRICS.inc("commerce_commands_throttled_total", command = get_command_label(content), command_class = command_class, scope = scope)
+                return scope
+            buckets.append((bucket, cost))
+    for bucket, cost in buckets:
+        bucket.tokens -= cost
+    if len(RATE_BUCKETS) > RATE_BUCKET_LIMIT: #A full bucket is the same as no bucket
+        for bucket_key in [bucket_key for bucket_key, bucket in RATE_BUCKETS.items() if bucket.is_full(now)]:
+            del RATE_BUCKETS[bucket_key]
+    return None
+
+async def send_throttle_notice(message, scope): #One reply per RATE_LIMIT_NOTICE_SECONDS, further throttled messages are dropped silently
+    if isinstance(message, InteractionCommandMessage): #A deferred slash command always needs an answer
+        await message.interaction.followup.send("You're sending commands too fast. Try again in a few seconds." if scope == "user" else "This server is sending commands too fast. Try again in a few seconds.", ephemeral = True)
+        return
+    key = (str(message.guild.id), str(message.author.id) if scope == "user" else None) #Server-wide throttling gets one reply for everyone
+    now = time.monotonic()
+    if now - THROTTLE_NOTICES.get(key, -RATE_LIMIT_NOTICE_SECONDS) < RATE_LIMIT_NOTICE_SECONDS:
+        return
+    THROTTLE_NOTICES[key] = now
+    if len(THROTTLE_NOTICES) > RATE_BUCKET_LIMIT:
+        for notice_key in [notice_key for notice_key, sent_at in THROTTLE_NOTICES.items() if now - sent_at >= RATE_LIMIT_NOTICE_SECONDS]:
+            del THROTTLE_NOTICES[notice_key]
+    if scope == "user":
+        await send_message(f"{message.author.mention} slow down, you're sending commands too fast. Try again in a few seconds.", message.channel.id)
+    else:
+        await send_message("This server is sending commands faster than the bot can handle them. Try again in a few seconds.", message.channel.id)
+
+class BatchCommandMessage:
+    """A single line of a batch message, everything but the content comes from the original message."""
+    def __init__(self, message, content):
+        self._message = message
+        self.content = content
+
+    def __getattr__(self, name):
+        return getattr(self._message, name)
+
+def parse_batch(content):
+    """
+    Splits a batch message into its commands. The first line may be "!batch" or "!batch atomic".
+    Without the header it's a batch only if every line is a command, so a command followed by chat or with its
+    (...) arguments split across lines still runs as one command.
+    Returns (list_of_command_lines, atomic) or None if the message is a single command.
+    """
+    lines = [line.strip() for line in content.splitlines() if line.strip()]
+    atomic = False
+    is_batch = len(lines) > 1 and all(line.startswith("!") for line in lines)
+    if lines and lines[0].split()[0].lower() == "!batch":
+        header = lines.pop(0).split()
+        atomic = len(header) > 1 and header[1].lower() == "atomic"
+        is_batch = True
+    if not is_batch:
+        return None
+    return lines, atomic
+
+async def handle_batch(message, lines, atomic): #!batch <OPTIONAL_atomic> followed by one command per line
+    channel_id = message.channel.id
+    if not lines:
+        await send_error("Invalid syntax. [SYNTAX] !batch <OPTIONAL_atomic> followed by one command per line.", channel_id)
+        return
+    if len(lines) > BATCH_MAX_COMMANDS:
+        await send_error(f"Batches are limited to {BATCH_MAX_COMMANDS} commands.", channel_id)
+        return
+    unknown = [line.split()[0] for line in lines if line.split()[0].lower() not in LIST_OF_COMMANDS + ["!help", "!commands"]]
+    if unknown:
+        await send_error(f"Batch not run, unknown command{"s" if len(unknown) > 1 else ""}: {", ".join(unknown)}", channel_id)
+        return
+
+    results = []
+    failed_line = None
+    async def run(): #Runs again from the first line if the commit conflicts
+        nonlocal failed_line
+        transaction = CURRENT_TRANSACTION.get()
+        results.clear()
+        failed_line = None
+        for line in lines:
+            replies_before = len(transaction.replies)
+            failures_before = transaction.failures
+            failed = False
+            try:
+                await check_for_command(BatchCommandMessage(message, line))
+            except Exception as e:
+                if DEBUG:
+                    print(f"[red][ERROR] Batch command {line} failed: {e}")
+                transaction.replies.append(f"Command failed: {e}")
+                failed = True
+            replies = transaction.replies[replies_before:]
+            failed = failed or transaction.failures > failures_before
+            results.append((line, replies, failed))
+            if failed and failed_line is None:
+                failed_line = line
+                if atomic:
+                    break
+        if atomic and failed_line is not None:
+            transaction.rollback()
+
+    transaction = await run_transaction(run, channel_id, str(message.guild.id))
+    if atomic and failed_line is not None:
+        drop_server_caches(message.guild.id)
+        summary = f"**⛔ Batch rolled back,** `{failed_line}` failed:\n" + "\n".join(results[-1][1])
+        await send_message(summary[:2000], channel_id)
+        return
+
+    summary = "\n".join(
+        f"{"⚠️" if failed else "✅"} `{line}`" + "".join(f"\n> {reply}" for reply in replies)
+        for line, replies, failed in results
+    )
+    await send_message(summary[:2000], channel_id)
+    if transaction.embeds:
+        await send_batch_embeds(transaction.embeds, channel_id)
+    for path, file_name, content in transaction.attachments:
+        await send_file(path, file_name, content, channel_id)
 
 async def check_for_command(message):
+    if isinstance(message, InteractionCommandMessage) and not CURRENT_TRANSACTION.get():
+        await handle_interaction_command(message)
+        return
+    batch = parse_batch(message.content)
+    if batch:
+        await handle_batch(message, *batch)
+        return
     await set_enabled_commands(message)
     users = await async_load_json(USERS_FILE)
     server_id, user_id = await get_message_ids(message)
-    if str(user_id) not in users[str(server_id)]:
-        await add_user_to_json(str(server_id), str(user_id))
-        users = await async_load_json(USERS_FILE)
-    elif users[str(server_id)][str(user_id)]["display_name"] != message.author.display_name:
-        await update_display_name(str(server_id), str(user_id), message.author.display_name)
-        users = await async_load_json(USERS_FILE)
+    user = users[str(server_id)].get(str(user_id))
+    if user is None:
+        await add_user_to_json(str(server_id), str(user_id), message.author)
+    elif user["display_name"] != message.author.display_name or user.get("user_name") != message.author.name:
+        queue_name_update(server_id, user_id, message.author.display_name, message.author.name) #Written by the next name flush
     args = message.content.split()
     command = args[0].lower()
     if command in USER_COMMANDS or command == "!help" or command == "!commands":
@@ -642,9 +3534,30 @@ async def check_for_command(message):
         elif command == "!my_bets": #Tested and Working
             await handle_my_bets(message)
             return
+        elif command == "!leaderboard": #!leaderboard <OPTIONAL_wallet|profit|wins>
+            await handle_leaderboard(message)
+            return
+        elif command == "!stocks": #!stocks <OPTIONAL_symbol>
+            await handle_stocks(message)
+            return
+        elif command == "!buy_stock": #!buy_stock <symbol> <number_of_shares>
+            await handle_buy_stock(message)
+            return
+        elif command == "!sell_stock": #!sell_stock <symbol> <number_of_shares or all>
+            await handle_sell_stock(message)
+            return
+        elif command == "!history": #!history <OPTIONAL_page>
+            await handle_history(message)
+            return
+        elif command == "!prediction_history": #!prediction_history <OPTIONAL_prediction_number> or <OPTIONAL_page:number>
+            await handle_prediction_history(message)
+            return
+        elif command == "!auction_history": #!auction_history <OPTIONAL_auction_id> or <OPTIONAL_page:number>
+            await handle_auction_history(message)
+            return
     elif command in MODERATOR_COMMANDS and await validate_user_permission(server_id, user_id):
-        if command == "!reward": #!reward <amount> <user_name or user_id or user_display_name>
-            await reward_user(message) #Tested and Working
+        if command == "!reward": #!reward <amount> <@user, user_id, @role, (display_name) or everyone> [...]
+            await reward_user(message)
             return
         elif command == "!create_auction": #!create_auction (<name_of_item>) <quantity> <starting_bid> <number_of_minutes>
             await handle_create_auction(message) #Tested and Working
@@ -670,10 +3583,10 @@ async def check_for_command(message):
         elif command == "!reset_user_inventory": #!reset_user_inventory (<name_of_user or user_id>)
             await handle_reset_user_inventory(message) #Tested and Working
             return
-        elif command == "!reset_user": #!reset_user (<name_of_user or user_id>)    #Currently does not reset bets done by the user on predictions
+        elif command == "!reset_user": #!reset_user (<name_of_user or user_id>)
             await handle_reset_user(message) #Tested and Working
             return
-        elif command == "!purge_deprecated_users": #!purge_deprecated_users
+        elif command == "!purge_deprecated_users": #!purge_deprecated_users <OPTIONAL_cancel>
             await handle_purge_deprecated_users(message) #Tested and Working
             return
         elif command == "!set_default_channel": #!set_default_channel <OPTIONAL_channel_id>
@@ -682,6 +3595,27 @@ async def check_for_command(message):
         elif command == "!toggle_command": #!toggle_command (!command) (true/false) [...]
             await handle_toggle_command(message) #Tested and Working
             return
+        elif command == "!stats": #!stats
+            await handle_stats(message)
+            return
+        elif command == "!profile": #!profile <number_of_commands or off>
+            await handle_profile(message)
+            return
+        elif command == "!create_stock": #!create_stock <SYMBOL> (<name>) <price> <OPTIONAL_volatility_percent_per_hour>
+            await handle_create_stock(message)
+            return
+        elif command == "!delete_stock": #!delete_stock <SYMBOL>
+            await handle_delete_stock(message)
+            return
+        elif command == "!economy": #!economy <OPTIONAL_hours>
+            await handle_economy(message)
+            return
+        elif command == "!export": #!export <users|inventory|shop|predictions> <OPTIONAL_csv|jsonl>
+            await handle_export(message)
+            return
+        elif command == "!import": #!import <users|inventory|shop> with a .csv or .jsonl file attached
+            await handle_import(message)
+            return
         
 async def handle_shop(message):
     shop = await async_load_json(SHOP_FILE)
@@ -767,27 +3701,56 @@ async def handle_inventory(message):
     await send_embed_message(embed, channel_id)
     
 
-async def handle_auctions_command(message):
-    shop = await async_load_json(SHOP_FILE)
+async def handle_auctions_command(message): #!auctions <OPTIONAL_ending|price|bids> <OPTIONAL_(item)> <OPTIONAL_@seller> <OPTIONAL_min:price> <OPTIONAL_max:price> <OPTIONAL_page>
     server_id = str(message.guild.id)
+    channel_id = message.channel.id
+    sort = next(iter(AUCTION_SORTS))
+    item = seller = low = high = None
+    page = 1
+    for match in re.finditer(r"\(([^)]+)\)|<@!?(\d+)>|(seller|min|max):(\d+)|(\S+)", message.content.strip()[len("!auctions"):]):
+        name, mention, key, number, word = match.groups()
+        if name:
+            item = name.strip().lower()
+        elif mention or key == "seller":
+            seller = mention or number
+        elif key == "min":
+            low = int(number)
+        elif key == "max":
+            high = int(number)
+        elif word.lower() in AUCTION_SORTS:
+            sort = word.lower()
+        elif word.isdigit() and int(word) >= 1:
+            page = int(word)
+        else:
+            await send_error(f"Invalid syntax. [SYNTAX] !auctions <OPTIONAL_{"|".join(AUCTION_SORTS)}> <OPTIONAL_(item)> <OPTIONAL_@seller> <OPTIONAL_min:price> <OPTIONAL_max:price> <OPTIONAL_page>", channel_id)
+            return
+
+    shop, users = await asyncio.gather(async_load_json(SHOP_FILE), async_load_json(USERS_FILE))
     auctions = shop.get(server_id, {}).get("Auctions", {})
-    if not auctions:
+    server_users = users.get(server_id, {})
+    filtered = any(value is not None for value in (item, seller, low, high))
+    index = auction_index(server_id, auctions)
+    matches = (auction_id for auction_id in index.query(sort, item, seller, low, high) if auction_id in auctions) #The index may be ahead of the data loaded
+    listed = list(itertools.islice(matches, (page - 1) * AUCTION_PAGE_SIZE, page * AUCTION_PAGE_SIZE + 1)) #One extra to know if there's a next page
+    if not listed:
         embed = discord.Embed(
             title="🛒 Current Auctions",
-            description="There are no active auctions at the moment.",
+            description="No auctions match those filters." if filtered else ("There are no active auctions at the moment." if page == 1 else "There are no auctions this far back."),
             color=discord.Color.greyple()
         )
-        return embed
+        await send_embed_message(embed, channel_id)
+        return
 
     embed = discord.Embed(
-        title="🛒 Current Auctions",
+        title=f"🛒 Current Auctions • {AUCTION_SORTS[sort]}",
         color=discord.Color.blurple()
     )
 
     now = datetime.now(timezone.utc)
 
-    for auction_id, auction in auctions.items():
-        item = auction["item"]
+    for auction_id in listed[:AUCTION_PAGE_SIZE]:
+        auction = auctions[auction_id]
+        item_name = auction["item"]
         quantity = auction["quantity"]
         auction_end = datetime.fromisoformat(auction["auction_end"])
         remaining = auction_end - now
@@ -801,14 +3764,15 @@ async def handle_auctions_command(message):
         else:
             time_left = f"{round(remaining.total_seconds() / 86400)} day(s)"
 
-        auctioner_user = await get_display_name(int(server_id), int(auction["user_id"]))
+        auctioner_id = auction["user_id"]
+        auctioner_user = server_users.get(auctioner_id, {}).get("display_name", auctioner_id) if auctioner_id else "The server" #Server auctions have no seller
         highest_bid = auction["current_bid"]
         highest_bidder_id = auction["current_highest_bidder_id"]
-        highest_bidder = await get_display_name(int(server_id), int(highest_bidder_id)) if highest_bidder_id else "None"
+        highest_bidder = server_users.get(highest_bidder_id, {}).get("display_name", highest_bidder_id) if highest_bidder_id else "None"
         bid_count = auction["number_of_bids"]
 
         embed.add_field(
-            name=f"🆔 Auction ID: `{auction_id}` • {quantity}x {item}",
+            name=f"🆔 Auction ID: `{auction_id}` • {quantity}x {item_name}",
             value=(
                 f"• 🧑‍💼 Auctioned by: **{auctioner_user}**\n"
                 f"• 💰 Current Bid: `${highest_bid:,}`\n"
@@ -819,8 +3783,13 @@ async def handle_auctions_command(message):
             inline=False
         )
 
-    embed.set_footer(text="Use !bid <auction_id> <amount> to place your bid!")
-    await send_embed_message(embed, message.channel.id)
+    footer = "Use !bid <auction_id> <amount> to place your bid!"
+    if len(listed) > AUCTION_PAGE_SIZE:
+        footer += f" Page {page}, add {page + 1} for the next page."
+    elif page > 1:
+        footer += f" Page {page}."
+    embed.set_footer(text=footer)
+    await send_embed_message(embed, channel_id)
 
 async def handle_buy(message):
     shop, users = await asyncio.gather(async_load_json(SHOP_FILE), async_load_json(USERS_FILE))
@@ -832,7 +3801,7 @@ async def handle_buy(message):
     pattern = r"^!buy\s+\(([^)]+)\)(?:\s+(\d+))?$"
     match = re.match(pattern, content)
     if not match:
-        await send_message("Invalid syntax. [SYNTAX] !buy (<name_of_item>) <OPTIONAL_quantity>", channel_id)
+        await send_error("Invalid syntax. [SYNTAX] !buy (<name_of_item>) <OPTIONAL_quantity>", channel_id)
         return
     
     if match:
@@ -842,7 +3811,7 @@ async def handle_buy(message):
     server_data = shop.get(server_id)
 
     if not server_data or not server_data.get("Items"):
-        await send_message(f"{name} is not currently in the shop.", channel_id)
+        await send_error(f"{name} is not currently in the shop.", channel_id)
         return
     
     found = False
@@ -856,23 +3825,24 @@ async def handle_buy(message):
                 price = item["price"] * quantity
                 value = int(round(item["price"] * 0.25))
             if price > users_data[user_id]["wallet"]:
-                await send_message(f"You do not have enough in your wallet to purchase {quantity} {name}{"s." if quantity > 1 else "."}", channel_id)
+                await send_error(f"You do not have enough in your wallet to purchase {quantity} {name}{"s." if quantity > 1 else "."}", channel_id)
                 return
             elif item["quantity"] != "Unlimited":
                 if item["quantity"] < quantity:
-                    await send_message(f"There are not enough {name}s in stock.", channel_id)
+                    await send_error(f"There are not enough {name}s in stock.", channel_id)
                     return
                 item["quantity"] -= quantity
 
-            users_data[user_id]["wallet"] -= price
+            adjust_wallet(server_id, user_id, users_data[user_id], -price, "buy", item_id)
             await async_save_json(USERS_FILE, users)
+            sync_user_rankings(server_id, user_id, users_data[user_id])
             await add_item_to_inventory(user_id, item_id, value, name, quantity, server_id)
             await async_save_json(SHOP_FILE, shop)
 
     if found:
         await send_message(f"{quantity} {name}{"s" if quantity > 1 else ""} successfully purchased.", channel_id)
     else:
-        await send_message(f"{name} is not currently in the shop.", channel_id)
+        await send_error(f"{name} is not currently in the shop.", channel_id)
 
 async def add_item_to_inventory(user_id, item_id, value, name, quantity, server_id):
     users = await async_load_json(USERS_FILE)
@@ -902,7 +3872,7 @@ async def handle_sell(message):
     pattern = r"^!sell\s+\(([^)]+)\)(?:\s+(\d+))?$"
     match = re.match(pattern, content)
     if not match:
-        await send_message("Invalid syntax. [SYNTAX] !sell (<name_of_item>) <OPTIONAL_quantity>", channel_id)
+        await send_error("Invalid syntax. [SYNTAX] !sell (<name_of_item>) <OPTIONAL_quantity>", channel_id)
         return
     
     if match:
@@ -914,17 +3884,18 @@ async def handle_sell(message):
         if item["name"].lower() == name.lower():
             found = True
             if item["quantity"] < quantity:
-                await send_message(f"You do not have {quantity} {name}s.", channel_id)
+                await send_error(f"You do not have {quantity} {name}s.", channel_id)
                 return
             worth = item["value"] * quantity
-            users_data[user_id]["wallet"] += worth
+            adjust_wallet(server_id, user_id, users_data[user_id], worth, "sell", item_id)
             await async_save_json(USERS_FILE, users)
+            sync_user_rankings(server_id, user_id, users_data[user_id])
             await remove_item_from_inventory(user_id, item_id, name, quantity, server_id)
     
     if found:
         await send_message(f"Successfully sold {quantity} {name}{"s" if quantity > 1 else ""} for a total of {worth}!", channel_id)
     else:
-        await send_message(f"You do not have any {name}s.", channel_id)
+        await send_error(f"You do not have any {name}s.", channel_id)
                 
 async def remove_item_from_inventory(user_id, item_id, name, quantity, server_id):
     users = await async_load_json(USERS_FILE)
@@ -945,7 +3916,7 @@ async def handle_auction_item(message):
     pattern = r"^!auction_item\s+\(([^)]+)\)\s+(\d+)\s+(\d+)\s+(\d+)$"
     match = re.match(pattern, message.content.strip())
     if not match:
-        await send_message("Invalid syntax. [SYNTAX] !auction_item (<name_of_item>) <quantity> <starting_bid> <number_of_minutes>", channel_id)
+        await send_error("Invalid syntax. [SYNTAX] !auction_item (<name_of_item>) <quantity> <starting_bid> <number_of_minutes>", channel_id)
         return
 
     item_name = match.group(1)
@@ -963,7 +3934,7 @@ async def handle_auction_item(message):
             item_id = id
             value = item["value"]
             if item["quantity"] < quantity:
-                await send_message(f"You do not have {quantity} {item_name}s.", channel_id)
+                await send_error(f"You do not have {quantity} {item_name}s.", channel_id)
                 return
             elif item["quantity"] == quantity:
                 del item
@@ -977,24 +3948,32 @@ async def handle_auction_item(message):
         await create_auction(item_name, item_id, quantity, starting_bid, value, duration_minutes, user_id, server_id)
         await send_message(f"Auction created for {quantity} {item_name}{"s" if quantity > 1 else ""} with starting bid of {starting_bid}. Auction ends in {f"{duration_minutes} minutes." if duration_minutes < 60 else f"{duration_minutes / 60} hour{"s." if duration_minutes / 60 != 1 else "."}"}", channel_id)
     else:
-        await send_message(f"You do not have any {item_name}s.", channel_id)
+        await send_error(f"You do not have any {item_name}s.", channel_id)
 
 
 async def auction_timer(server_id, auction_id, end_time):
+    CURRENT_COMMAND.set("auction_timer")
     end_utc = datetime.fromisoformat(end_time)
     now_utc = datetime.now(timezone.utc)
     seconds_remaining = (end_utc - now_utc).total_seconds()
     seconds_remaining = int(seconds_remaining)
     if seconds_remaining <= 0:
-        await resolve_auction(server_id, auction_id)
+        async with STATE_LOCK, locked_transaction():
+            await resolve_auction(server_id, auction_id)
         return
     if DEBUG:
         print(f"[green]Seconds remaining for auction: {seconds_remaining}")
 
     await asyncio.sleep(seconds_remaining)
-    await resolve_auction(server_id, auction_id)
+    METRICS.observe("commerce_auction_timer_lag_seconds", (datetime.now(timezone.utc) - end_utc).total_seconds(), TIMER_LAG_BUCKETS)
+    async with STATE_LOCK, locked_transaction():
+        with trace_span("auction_timer", root = True, server_id = server_id, auction_id = str(auction_id)) as span:
+            await resolve_auction(server_id, auction_id)
+    if span.duration_ms >= TRACE_SLOW_MS:
+        await log_slow_trace(span)
 
 
+@traced("resolve_auction")
 async def resolve_auction(server_id, auction_id):
     auction_id = str(auction_id)
     shop, users, settings = await asyncio.gather(async_load_json(SHOP_FILE), async_load_json(USERS_FILE), async_load_json(SETTINGS_FILE))
@@ -1039,7 +4018,7 @@ async def resolve_auction(server_id, auction_id):
                     winner_id = user_id
                     winner_user = await get_display_name(int(server_id), int(winner_id))
                     highest_bid = amount
-                    users[server_id][user_id]["wallet"] -= amount
+                    pay_for_auction(server_id, users[server_id], user_id, auctioner_user_id, amount, auction_id)
                     success = True
                     break
             if not success:
@@ -1051,8 +4030,7 @@ async def resolve_auction(server_id, auction_id):
     elif users[server_id].get(highest_bid_user_id, {}).get("wallet", 0) >= highest_bid:
         winner_id = highest_bid_user_id
         winner_user = await get_display_name(int(server_id), int(winner_id))
-        users[server_id][winner_id]["wallet"] -= highest_bid
-        users[server_id][auctioner_user_id]["wallet"] += highest_bid
+        pay_for_auction(server_id, users[server_id], winner_id, auctioner_user_id, highest_bid, auction_id)
         success = True
 
     # If auction failed, return item to original owner
@@ -1091,53 +4069,711 @@ async def resolve_auction(server_id, auction_id):
             if DEBUG:
                 print("[yellow]DEFAULT CHANNEL NOT SET!", success_message)
 
-    # Final cleanup: delete the auction and save
-    del shop[server_id]["Auctions"][auction_id]
-    await asyncio.gather(
-        async_save_json(SHOP_FILE, shop),
-        async_save_json(USERS_FILE, users)
+    # Final cleanup: delete the auction and save
+    del shop[server_id]["Auctions"][auction_id]
+    await asyncio.gather(
+        async_save_json(SHOP_FILE, shop),
+        async_save_json(USERS_FILE, users)
+    )
+    sync_auction_index(server_id, auction_id)
+    await archive_record(server_id, "auction", auction_id, {**auction, "winner_id": winner_id if success else None, "price": highest_bid if success else None})
+    for user_id in (winner_id, auctioner_user_id):
+        if user_id and user_id in users[server_id]:
+            sync_user_rankings(server_id, user_id, users[server_id][user_id])
+
+
+async def handle_my_bets(message):
+    user_id = str(message.author.id)
+    server_id = str(message.guild.id)
+    channel_id = message.channel.id
+    user_bets_summary = []
+
+    predictions = await async_load_json(PREDICTIONS_FILE)
+
+
+    server_predictions = predictions.get(server_id, {}).get("Predictions", {})
+
+    for pred_id in sorted(user_open_bets(server_id, user_id, server_predictions), key = int):
+        prediction = server_predictions.get(pred_id)
+        if prediction and prediction.get("open", False):  # Only include open predictions
+            user_bet = prediction.get("user_bets", {}).get(user_id)
+            if user_bet:
+                option_num = user_bet["option"]
+                option_label = prediction["options"].get(option_num, "Unknown Option")
+                amount = user_bet["amount"]
+                title = prediction["title"]
+
+                user_bets_summary.append(f"**{title}**\n🪙 Bet `{amount}` on **{option_label}**\n")
+
+    if not user_bets_summary:
+        embed = discord.Embed(
+            title="📊 Your Current Bets",
+            description="You have no active bets right now.",
+            color=discord.Color.gold()
+        )
+    else:
+        embed = discord.Embed(
+            title="📊 Your Current Bets",
+            description="\n".join(user_bets_summary),
+            color=discord.Color.gold()
+        )
+
+    await send_embed_message(embed, channel_id)
+
+def build_server_leaderboards(server_id, server_users):
+    LEADERBOARDS[server_id] = {
+        board: RankIndex({user_id: user.get(stat, 0) for user_id, user in server_users.items()})
+        for board, stat in LEADERBOARD_STATS.items()
+    }
+    WALLET_SKETCHES[server_id] = WalletSketch({user_id: user.get("wallet", 0) for user_id, user in server_users.items()})
+    return LEADERBOARDS[server_id]
+
+def rebuild_leaderboards(users):
+    LEADERBOARDS.clear()
+    WALLET_SKETCHES.clear()
+    for server_id, server_users in users.items():
+        build_server_leaderboards(server_id, server_users)
+
+def sync_user_rankings(server_id, user_id, user = None): #Call after any wallet/stat change. No user means they were removed.
+    boards = LEADERBOARDS.get(server_id)
+    if boards is None: #Server gets built from users.json the first time its leaderboard is needed
+        return
+    for board, stat in LEADERBOARD_STATS.items():
+        if user is None:
+            boards[board].remove(user_id)
+        else:
+            boards[board].update(user_id, user.get(stat, 0))
+    if user is None:
+        WALLET_SKETCHES[server_id].remove(user_id)
+    else:
+        WALLET_SKETCHES[server_id].update(user_id, user.get("wallet", 0))
+
+async def handle_leaderboard(message): #!leaderboard <OPTIONAL_wallet|profit|wins>
+    server_id = str(message.guild.id)
+    user_id = str(message.author.id)
+    channel_id = message.channel.id
+    args = message.content.split()
+    board = args[1].lower() if len(args) > 1 else "wallet"
+    if board not in LEADERBOARD_STATS:
+        await send_error("Invalid syntax. [SYNTAX] !leaderboard <OPTIONAL_wallet|profit|wins>", channel_id)
+        return
+
+    users = await async_load_json(USERS_FILE)
+    server_users = users.get(server_id, {})
+    boards = LEADERBOARDS.get(server_id) or build_server_leaderboards(server_id, server_users)
+    index = boards[board]
+
+    lines = []
+    for position, (uid, score) in enumerate(index.top(LEADERBOARD_PAGE_SIZE), start = 1):
+        name = server_users.get(uid, {}).get("display_name", uid)
+        score_str = f"{score:,} win{"s" if score != 1 else ""}" if board == "wins" else f"${score:,}"
+        lines.append(f"**{position}.** {name} — `{score_str}`")
+
+    embed = discord.Embed(
+        title=f"🏅 {board.capitalize()} Leaderboard",
+        description="\n".join(lines) if lines else "No one is on the leaderboard yet.",
+        color=discord.Color.gold()
+    )
+    rank = index.rank(user_id)
+    if rank:
+        embed.set_footer(text=f"Your rank: #{rank:,} of {len(index):,}")
+    await send_embed_message(embed, channel_id)
+
+async def handle_history(message): #!history <OPTIONAL_page>
+    server_id = str(message.guild.id)
+    user_id = str(message.author.id)
+    channel_id = message.channel.id
+    args = message.content.split()
+    if len(args) > 2 or (len(args) == 2 and not (args[1].isdigit() and 1 <= int(args[1]) <= LEDGER_MAX_PAGE)):
+        await send_error(f"Invalid syntax. [SYNTAX] !history <OPTIONAL_page from 1 to {LEDGER_MAX_PAGE}>", channel_id)
+        return
+    page = int(args[1]) if len(args) == 2 else 1
+    entries = get_ledger().history(server_id, user_id, LEDGER_PAGE_SIZE + 1, (page - 1) * LEDGER_PAGE_SIZE) #One extra to know if there's an older page
+
+    lines = []
+    for when, amount, balance, kind, reference in entries[:LEDGER_PAGE_SIZE]:
+        lines.append(f"<t:{int(when)}:d> {LEDGER_KINDS[kind]}{f" #{reference}" if reference else ""} `{"+" if amount >= 0 else "-"}${abs(amount):,}` → `${balance:,}`")
+    embed = discord.Embed(
+        title=f"🧾 {message.author.display_name}'s Wallet History",
+        description="\n".join(lines) if lines else ("No wallet changes recorded yet." if page == 1 else "There are no entries this far back."),
+        color=discord.Color.blue()
     )
+    if len(entries) > LEDGER_PAGE_SIZE and page < LEDGER_MAX_PAGE:
+        embed.set_footer(text=f"Page {page}, !history {page + 1} for older entries")
+    elif page > 1:
+        embed.set_footer(text=f"Page {page}")
+    await send_embed_message(embed, channel_id)
 
+async def parse_archive_command(message, command, id_name):
+    """Returns (record id or None, page) for !prediction_history and !auction_history, or None once the syntax error is sent"""
+    record_id, page = None, 1
+    for word in message.content.split()[1:]:
+        if word.lower().startswith("page:") and word[5:].isdigit() and int(word[5:]) >= 1:
+            page = int(word[5:])
+        elif word.isdigit() and record_id is None:
+            record_id = word
+        else:
+            await send_error(f"Invalid syntax. [SYNTAX] {command} <OPTIONAL_{id_name}> or {command} <OPTIONAL_page:number>", message.channel.id)
+            return None
+    return record_id, page
+
+async def send_archive_page(message, kind, title, page, format_line):
+    archive = await get_archive(message.guild.id)
+    records = await archive.newest(kind, ARCHIVE_PAGE_SIZE, (page - 1) * ARCHIVE_PAGE_SIZE)
+    total = archive.total(kind)
+    embed = discord.Embed(
+        title=title,
+        description="\n".join(format_line(record) for record in records) if records else (f"No {kind}s have been archived yet." if page == 1 else f"There are no {kind}s this far back."),
+        color=discord.Color.dark_teal()
+    )
+    command = message.content.split()[0].lower()
+    if page * ARCHIVE_PAGE_SIZE < total:
+        embed.set_footer(text=f"Page {page} of {math.ceil(total / ARCHIVE_PAGE_SIZE)}, {command} page:{page + 1} for older ones, {command} <id> for one in full")
+    elif page > 1:
+        embed.set_footer(text=f"Page {page} of {math.ceil(total / ARCHIVE_PAGE_SIZE)}")
+    await send_embed_message(embed, message.channel.id)
 
-async def handle_my_bets(message):
+async def handle_prediction_history(message): #!prediction_history <OPTIONAL_prediction_number> or <OPTIONAL_page:number>
+    parsed = await parse_archive_command(message, "!prediction_history", "prediction_number")
+    if not parsed:
+        return
+    prediction_id, page = parsed
+    server_id = str(message.guild.id)
     user_id = str(message.author.id)
+    channel_id = message.channel.id
+    if prediction_id is None:
+        def format_line(prediction):
+            winner = prediction["options"].get(prediction["winning_option"], prediction["winning_option"])
+            return f"<t:{int(prediction["archived_at"])}:d> #{prediction["id"]} **{prediction["title"]}** → {winner} • `${prediction["total_bets"]:,}` from {len(prediction["user_bets"]):,} bet{"s" if len(prediction["user_bets"]) != 1 else ""}"
+        await send_archive_page(message, "prediction", "📜 Resolved Predictions", page, format_line)
+        return
+
+    archive = await get_archive(server_id)
+    prediction = await archive.find("prediction", prediction_id)
+    if prediction is None:
+        await send_error(f"Prediction #{prediction_id} has not been resolved, or never existed.", channel_id)
+        return
+    users = await async_load_json(USERS_FILE)
+    server_users = users.get(server_id, {})
+    user_bets = prediction["user_bets"]
+    payouts = prediction.get("payouts", {})
+    winning_option = prediction["winning_option"]
+    embed = discord.Embed(
+        title=f"📜 #{prediction_id} {prediction["title"]}",
+        description=(
+            f"**Winner:** {prediction["options"].get(winning_option, winning_option)}\n"
+            f"Resolved <t:{int(prediction["archived_at"])}:f>\n"
+            f"`${prediction["total_bets"]:,}` bet by {len(user_bets):,} user{"s" if len(user_bets) != 1 else ""}"
+        ),
+        color=discord.Color.dark_teal()
+    )
+    option_lines = []
+    for option_id, option in prediction["options"].items():
+        bets = [bet["amount"] for bet in user_bets.values() if bet["option"] == option_id]
+        option_lines.append(f"{"🏆" if option_id == winning_option else "•"} {option}: `${sum(bets):,}` ({len(bets):,} bet{"s" if len(bets) != 1 else ""})")
+    embed.add_field(name="Options", value="\n".join(option_lines), inline=False)
+    top = sorted(payouts.items(), key = lambda payout: -payout[1])[:ARCHIVE_PAGE_SIZE]
+    embed.add_field(
+        name="Top Payouts",
+        value="\n".join(
+            f"• **{server_users.get(winner_id, {}).get("display_name") or user_bets[winner_id]["name"]}** won `${winnings:,}` (bet `${user_bets[winner_id]["amount"]:,}`)"
+            for winner_id, winnings in top
+        ) or "No one bet on the winning option.",
+        inline=False
+    )
+    if user_id in user_bets:
+        bet = user_bets[user_id]
+        result = f"won `${payouts[user_id]:,}`" if user_id in payouts else "lost"
+        embed.add_field(name="Your Bet", value=f"`${bet["amount"]:,}` on {prediction["options"].get(bet["option"], bet["option"])}, {result}", inline=False)
+    await send_embed_message(embed, channel_id)
+
+async def handle_auction_history(message): #!auction_history <OPTIONAL_auction_id> or <OPTIONAL_page:number>
+    parsed = await parse_archive_command(message, "!auction_history", "auction_id")
+    if not parsed:
+        return
+    auction_id, page = parsed
     server_id = str(message.guild.id)
     channel_id = message.channel.id
-    user_bets_summary = []
+    users = await async_load_json(USERS_FILE)
+    server_users = users.get(server_id, {})
+    def name(user_id, fallback = None):
+        if not user_id:
+            return "The server" #Server auctions have no seller
+        return server_users.get(user_id, {}).get("display_name") or fallback or "A departed user"
+    def result(auction):
+        if auction["winner_id"]:
+            winning_bid = next((bid for bid in auction["bids"].values() if bid["user_id"] == auction["winner_id"]), {})
+            return f"sold to **{name(auction["winner_id"], winning_bid.get("user_name"))}** for `${auction["price"]:,}`"
+        return "no bids" if not auction["number_of_bids"] else "unsold, no bidder could pay"
+    if auction_id is None:
+        def format_line(auction):
+            ended = int(datetime.fromisoformat(auction["auction_end"]).timestamp())
+            return f"<t:{ended}:d> #{auction["id"]} {auction["quantity"]}x {auction["item"]}, {result(auction)}"
+        await send_archive_page(message, "auction", "📜 Ended Auctions", page, format_line)
+        return
 
-    predictions = await async_load_json(PREDICTIONS_FILE)
+    archive = await get_archive(server_id)
+    auction = await archive.find("auction", auction_id)
+    if auction is None:
+        await send_error(f"Auction #{auction_id} has not ended, or never existed.", channel_id)
+        return
+    ended = int(datetime.fromisoformat(auction["auction_end"]).timestamp())
+    embed = discord.Embed(
+        title=f"📜 Auction #{auction_id}: {auction["quantity"]}x {auction["item"]}",
+        description=(
+            f"Auctioned by **{name(auction["user_id"])}**, ended <t:{ended}:f>\n"
+            f"{result(auction)[0].upper()}{result(auction)[1:]}"
+            f"{f"\n{auction["number_of_bids"]:,} bid{"s" if auction["number_of_bids"] != 1 else ""}" if auction["number_of_bids"] else ""}"
+        ),
+        color=discord.Color.dark_teal()
+    )
+    bids = list(auction["bids"].values())[-ARCHIVE_PAGE_SIZE:]
+    if bids:
+        embed.add_field(
+            name="Last Bids" if auction["number_of_bids"] > len(bids) else "Bids",
+            value="\n".join(f"• **{name(bid["user_id"], bid.get("user_name"))}** `${bid["amount"]:,}`" for bid in reversed(bids)),
+            inline=False
+        )
+    await send_embed_message(embed, channel_id)
 
+def economy_hour(moment = None): #Rollup key, one per UTC hour
+    return (moment or datetime.now(timezone.utc)).strftime("%Y-%m-%dT%H")
+
+def sketch_summary(sketch):
+    return {
+        "supply": sketch.supply,
+        "wallets": len(sketch),
+        "median": round(sketch.percentile(0.5)),
+        "p90": round(sketch.percentile(0.9)),
+        "p99": round(sketch.percentile(0.99)),
+        "gini": round(sketch.gini(), 4)
+    }
 
-    server_predictions = predictions.get(server_id, {}).get("Predictions", {})
+async def flush_economy():
+    """
+    Adds the flows counted since the last flush to the current hour of each server in economy.json, together with the
+    server's money supply and wallet distribution at this moment. Hours older than ECONOMY_ROLLUP_HOURS are dropped.
+    """
+    flows = dict(ECONOMY_FLOWS)
+    ECONOMY_FLOWS.clear()
+    hour = economy_hour()
+    oldest = economy_hour(datetime.now(timezone.utc) - timedelta(hours = ECONOMY_ROLLUP_HOURS))
+    async with STATE_LOCK:
+        economy = await async_load_json(ECONOMY_FILE)
+        for server_id in set(flows) | set(WALLET_SKETCHES):
+            hours = economy.setdefault(server_id, {"Hours": {}})["Hours"]
+            rollup = hours.setdefault(hour, {"flows": {}})
+            for kind, (count, money_in, money_out) in flows.get(server_id, {}).items():
+                total = rollup["flows"].setdefault(kind, [0, 0, 0])
+                total[0] += count
+                total[1] += money_in
+                total[2] += money_out
+            if server_id in WALLET_SKETCHES:
+                rollup.update(sketch_summary(WALLET_SKETCHES[server_id]))
+            for old_hour in [old_hour for old_hour in hours if old_hour < oldest]:
+                del hours[old_hour]
+        await async_save_json(ECONOMY_FILE, economy)
+    if DEBUG:
+        print(f"[green]Economy flush: {len(flows)} servers with new flows")
 
-    for pred_id, prediction in server_predictions.items():
-        if prediction.get("open", False):  # Only include open predictions
-            user_bet = prediction.get("user_bets", {}).get(user_id)
-            if user_bet:
-                option_num = user_bet["option"]
-                option_label = prediction["options"].get(option_num, "Unknown Option")
-                amount = user_bet["amount"]
-                title = prediction["title"]
+async def economy_loop():
+    while True:
+        await asyncio.sleep(ECONOMY_FLUSH_SECONDS)
+        try:
+            await flush_economy()
+        except Exception as e:
+            print(f"[red]Economy flush failed: {e!r}")
 
-                user_bets_summary.append(f"**{title}**\n🪙 Bet `{amount}` on **{option_label}**\n")
+async def handle_economy(message): #!economy <OPTIONAL_hours>
+    server_id = str(message.guild.id)
+    channel_id = message.channel.id
+    args = message.content.split()
+    if len(args) > 2 or (len(args) == 2 and not (args[1].isdigit() and 1 <= int(args[1]) <= ECONOMY_MAX_HOURS)):
+        await send_error(f"Invalid syntax. [SYNTAX] !economy <OPTIONAL_hours from 1 to {ECONOMY_MAX_HOURS}>", channel_id)
+        return
+    window = int(args[1]) if len(args) == 2 else 24
 
-    if not user_bets_summary:
-        embed = discord.Embed(
-            title="📊 Your Current Bets",
-            description="You have no active bets right now.",
-            color=discord.Color.gold()
-        )
-    else:
-        embed = discord.Embed(
-            title="📊 Your Current Bets",
-            description="\n".join(user_bets_summary),
-            color=discord.Color.gold()
+    sketch = WALLET_SKETCHES.get(server_id)
+    if sketch is None: #Only after a rolled back batch, or before the server's first leaderboard
+        users = await async_load_json(USERS_FILE)
+        build_server_leaderboards(server_id, users.get(server_id, {}))
+        sketch = WALLET_SKETCHES[server_id]
+    economy = await async_load_json(ECONOMY_FILE)
+    hours = economy.get(server_id, {}).get("Hours", {})
+    since = economy_hour(datetime.now(timezone.utc) - timedelta(hours = window - 1))
+    recent = [hours[hour] for hour in sorted(hours) if hour >= since]
+
+    flows = {}
+    for rollup in recent + [{"flows": ECONOMY_FLOWS.get(server_id, {})}]:
+        for kind, (count, money_in, money_out) in rollup["flows"].items():
+            total = flows.setdefault(kind, [0, 0, 0])
+            total[0] += count
+            total[1] += money_in
+            total[2] += money_out
+    sources = {kind: flow for kind, flow in flows.items() if kind not in ECONOMY_TRANSFER_KINDS}
+    transfers = {kind: flow for kind, flow in flows.items() if kind in ECONOMY_TRANSFER_KINDS}
+    minted = sum(money_in for _, money_in, _ in sources.values())
+    destroyed = sum(money_out for _, _, money_out in sources.values())
+    paid_in = sum(money_out for _, _, money_out in transfers.values())
+    paid_out = sum(money_in for _, money_in, _ in transfers.values())
+
+    summary = sketch_summary(sketch)
+    embed = discord.Embed(
+        title="🏦 Server Economy",
+        description=(
+            f"Money supply `${summary['supply']:,}` across {summary['wallets']:,} wallets\n"
+            f"Wallets: median `${summary['median']:,}`, 90th percentile `${summary['p90']:,}`, 99th percentile `${summary['p99']:,}` (approximate)\n"
+            f"Gini coefficient `{summary['gini']:.2f}` (0 is perfectly equal, 1 is one person holding everything)"
+        ),
+        color=discord.Color.teal()
+    )
+    def flow_lines(kinds):
+        return [
+            f"{LEDGER_KINDS.get(kind) or ECONOMY_POOL_KINDS[kind]}: {f"`+${money_in:,}`" if money_in else ""}{" " if money_in and money_out else ""}{f"`-${money_out:,}`" if money_out else ""} ({count:,})"
+            for kind, (count, money_in, money_out) in sorted(kinds.items(), key = lambda flow: -(flow[1][1] + flow[1][2]))
+        ]
+    embed.add_field(
+        name=f"Last {window}h: `+${minted:,}` created, `-${destroyed:,}` removed, net `{"+" if minted >= destroyed else "-"}${abs(minted - destroyed):,}`",
+        value="\n".join(flow_lines(sources)) or "No money was created or removed.",
+        inline=False
+    )
+    if transfers: #Not part of the net, what's paid in and not out is still in open predictions or went with a pool nobody won
+        embed.add_field(
+            name=f"Between users: `${paid_in:,}` paid in, `${paid_out:,}` paid out",
+            value="\n".join(flow_lines(transfers)),
+            inline=False
         )
-
+    supplies = [rollup["supply"] for rollup in recent if "supply" in rollup] + [summary["supply"]]
+    if len(supplies) > 2:
+        embed.add_field(name="Money supply by hour", value=f"`{sparkline(supplies)}` `${min(supplies):,}` to `${max(supplies):,}`", inline=False)
     await send_embed_message(embed, channel_id)
 
+def import_id(value):
+    value = str(value).strip()
+    if not value.isdigit():
+        raise ValueError("must be a number")
+    return value
+
+def import_int(value):
+    if isinstance(value, (bool, float)):
+        raise ValueError("must be a whole number")
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError("must be a whole number")
+
+def import_count(value):
+    value = import_int(value)
+    if value < 0:
+        raise ValueError("can't be negative")
+    return value
+
+def import_text(value):
+    value = str(value).strip()
+    if not value or len(value) > 100 or "(" in value or ")" in value:
+        raise ValueError("must be 1 to 100 characters without parentheses")
+    return value
+
+def import_bool(value):
+    value = str(value).strip().lower()
+    if value not in ("true", "false", "1", "0", "yes", "no"):
+        raise ValueError("must be true or false")
+    return value in ("true", "1", "yes")
+
+def import_or_word(word): #Shop fields that are a count or a word like "Unlimited"
+    def parse(value):
+        return word if str(value).strip().lower() == word.lower() else import_count(value)
+    return parse
+
+IMPORT_PARSERS = { #{table: {column: parser}}, a parser raises ValueError for an invalid value
+    "users": {
+        "user_id": import_id, "display_name": str, "user_name": str, "wallet": import_count,
+        "total_currency_bet": import_count, "total_currency_won": import_count, "total_currency_lost": import_count,
+        "profit": import_int, "bets_won": import_count, "bets_lost": import_count
+    },
+    "inventory": {"user_id": import_id, "item_id": import_id, "name": import_text, "quantity": import_count, "value": import_count},
+    "shop": {
+        "item_id": import_id, "name": import_text, "price": import_or_word("Free"), "quantity": import_or_word("Unlimited"),
+        "refresh_time": import_or_word("Never"), "active": import_bool
+    },
+}
+IMPORT_REQUIRED = {"users": ["user_id"], "inventory": ["user_id", "item_id", "quantity"], "shop": ["item_id"]}
+
+def export_rows(table, server_id, data): #Rows of EXPORT_TABLES[table], one at a time
+    if table == "users":
+        for user_id, user in data[USERS_FILE].get(server_id, {}).items():
+            yield [user_id, user.get("display_name", ""), user.get("user_name", "")] + [user.get(column, 0) for column in EXPORT_TABLES["users"][3:]]
+    elif table == "inventory":
+        for user_id, user in data[USERS_FILE].get(server_id, {}).items():
+            for item_id, item in user.get("inventory", {}).items():
+                yield [user_id, item_id, item["name"], item["quantity"], item["value"]]
+    elif table == "shop":
+        for item_id, item in data[SHOP_FILE].get(server_id, {}).get("Items", {}).items():
+            yield [item_id, item["name"], item["price"], item["quantity"], item["refresh_time"], item.get("active", True)]
+    elif table == "predictions":
+        for prediction_id, prediction in data[PREDICTIONS_FILE].get(server_id, {}).get("Predictions", {}).items():
+            bets = prediction.get("user_bets", {})
+            if not bets:
+                yield [prediction_id, prediction["title"], prediction.get("open", False), "", "", "", "", ""]
+            for user_id, bet in bets.items():
+                yield [prediction_id, prediction["title"], prediction.get("open", False), bet["option"], prediction["options"].get(bet["option"], ""), user_id, bet["name"], bet["amount"]]
+
+async def write_export(table, rows, file_format, path):
+    """Writes rows to path as CSV or JSONL, a chunk at a time so the whole document is never held in memory. Returns the row count."""
+    columns = EXPORT_TABLES[table]
+    count = 0
+    with open(path, "w", encoding = "utf-8", newline = "") if file_format == "csv" else open(path, "wb") as f:
+        writer = csv.writer(f) if file_format == "csv" else None
+        if writer:
+            writer.writerow(columns)
+        for row in rows:
+            if writer:
+                writer.writerow(row)
+            else:
+                f.write(encode_json(dict(zip(columns, row))) + b"\n")
+            count += 1
+            if count % EXPORT_YIELD_ROWS == 0:
+                await asyncio.sleep(0) #Lets the gateway heartbeat through on very large exports
+    return count
+
+def gzip_file(path): #Streams path into path.gz and removes path
+    with open(path, "rb") as source, gzip.open(path + ".gz", "wb") as target:
+        shutil.copyfileobj(source, target, EXPORT_CHUNK_BYTES)
+    os.remove(path)
+    return path + ".gz"
+
+async def handle_export(message): #!export <users|inventory|shop|predictions> <OPTIONAL_csv|jsonl>
+    server_id = str(message.guild.id)
+    channel_id = message.channel.id
+    args = message.content.lower().split()
+    if not 2 <= len(args) <= 3 or args[1] not in EXPORT_TABLES or (len(args) == 3 and args[2] not in EXPORT_FORMATS):
+        await send_error(f"Invalid syntax. [SYNTAX] !export <{"|".join(EXPORT_TABLES)}> <OPTIONAL_{"|".join(EXPORT_FORMATS)}>", channel_id)
+        return
+    table = args[1]
+    file_format = args[2] if len(args) == 3 else "csv"
+    paths = [USERS_FILE] if table in ("users", "inventory") else [SHOP_FILE] if table == "shop" else [PREDICTIONS_FILE]
+    data = dict(zip(paths, await asyncio.gather(*(async_load_json(path) for path in paths))))
+
+    handle, path = tempfile.mkstemp(prefix = "commerce-export-", suffix = f".{file_format}")
+    os.close(handle)
+    try:
+        count = await write_export(table, export_rows(table, server_id, data), file_format, path)
+        if os.path.getsize(path) > EXPORT_ATTACHMENT_BYTES:
+            path = await asyncio.to_thread(gzip_file, path)
+        if os.path.getsize(path) > EXPORT_ATTACHMENT_BYTES:
+            await send_error(f"Could not export {table}: the file is {os.path.getsize(path) / 1e6:.1f} MB compressed, over Discord's attachment limit.", channel_id)
+            os.remove(path)
+            return
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+        raise
+    file_name = f"{table}-{message.guild.id}-{datetime.now(timezone.utc).strftime("%Y%m%d-%H%M")}.{file_format}{".gz" if path.endswith(".gz") else ""}"
+    await send_file(path, file_name, f"Exported {count:,} row{"s" if count != 1 else ""} of {table}.", channel_id)
+
+async def download_attachment(attachment, path): #Streamed to disk in chunks, Attachment.read() would hold the whole file in memory
+    async with aiohttp.ClientSession() as session:
+        async with session.get(attachment.url) as response:
+            response.raise_for_status()
+            with open(path, "wb") as f:
+                async for chunk in response.content.iter_chunked(EXPORT_CHUNK_BYTES):
+                    f.write(chunk)
+
+def read_import_rows(path, file_name):
+    """Yields (line_number, row dict) from a CSV or JSONL file (optionally gzipped), one line at a time."""
+    opener = gzip.open if file_name.endswith(".gz") else open
+    with opener(path, "rt", encoding = "utf-8-sig", newline = "") as f:
+        if file_name.removesuffix(".gz").endswith(".csv"):
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield reader.line_num, {column: value for column, value in row.items() if column is not None}
+        else:
+            for line_number, line in enumerate(f, start = 1):
+                if line.strip():
+                    try:
+                        row = decode_json(line)
+                    except ValueError:
+                        raise ValueError(f"line {line_number} is not valid JSON")
+                    if not isinstance(row, dict):
+                        raise ValueError(f"line {line_number} is not a JSON object")
+                    yield line_number, row
+
+def parse_import_row(table, row):
+    parsers = IMPORT_PARSERS[table]
+    unknown = [column for column in row if column not in parsers]
+    if unknown:
+        raise ValueError(f"unknown column {unknown[0]}")
+    fields = {}
+    for column, value in row.items():
+        if value is None or value == "": #Empty cells leave the current value alone
+            continue
+        try:
+            fields[column] = parsers[column](value)
+        except ValueError as e:
+            raise ValueError(f"{column} {e}")
+    missing = [column for column in IMPORT_REQUIRED[table] if column not in fields]
+    if missing:
+        raise ValueError(f"{missing[0]} is missing")
+    return fields
+
+def check_import_row(table, fields, server_users, items, item_names): #Checks that need the current data, None when the row can be applied
+    if table == "inventory" and fields["user_id"] not in server_users:
+        return f"user {fields['user_id']} has no wallet, import users first"
+    if table == "inventory" and fields["quantity"] and "name" not in fields and fields["item_id"] not in items and fields["item_id"] not in server_users[fields["user_id"]].get("inventory", {}):
+        return f"item {fields['item_id']} is not in the shop, give it a name"
+    if table == "shop" and fields["item_id"] not in items and ("name" not in fields or "price" not in fields):
+        return f"new item {fields['item_id']} needs a name and a price"
+    if table == "shop" and "name" in fields:
+        owner = item_names.setdefault(fields["name"].lower(), fields["item_id"]) #Also catches the same name twice in one file
+        if owner != fields["item_id"]:
+            return f"item {owner} is already called {fields['name']}"
+    return None
+
+def apply_import_row(table, fields, server_id, server_users, shop):
+    if table == "users":
+        user_id = fields["user_id"]
+        user = server_users.get(user_id)
+        if user is None:
+            user = server_users[user_id] = new_user_record(fields.get("display_name", user_id), fields.get("user_name", ""))
+            record_ledger_entry(server_id, user_id, user["wallet"], user["wallet"], "open")
+        for column, value in fields.items():
+            if column not in ("user_id", "wallet"):
+                user[column] = value
+        if "wallet" in fields and fields["wallet"] != user["wallet"]:
+            adjust_wallet(server_id, user_id, user, fields["wallet"] - user["wallet"], "import")
+    elif table == "inventory":
+        inventory = server_users[fields["user_id"]].setdefault("inventory", {})
+        item_id = fields["item_id"]
+        if not fields["quantity"]:
+            inventory.pop(item_id, None)
+            return
+        current = inventory.get(item_id, {})
+        shop_item = shop["Items"].get(item_id, {})
+        inventory[item_id] = {
+            "name": fields.get("name", current.get("name", shop_item.get("name"))),
+            "quantity": fields["quantity"],
+            "value": fields.get("value", current.get("value", int(round(shop_item["price"] * 0.25)) if isinstance(shop_item.get("price"), int) else 0)) #Same resale value !buy gives
+        }
+    elif table == "shop":
+        item_id = fields["item_id"]
+        item = shop["Items"].setdefault(item_id, {"quantity": "Unlimited", "refresh_time": "Never", "active": True})
+        item.update({column: value for column, value in fields.items() if column != "item_id"})
+        if item.get("price") == 0:
+            item["price"] = "Free"
+        shop["Next Shop ID"] = max(shop["Next Shop ID"], int(item_id) + 1)
+
+def get_import_request(message): #(table, attachment, file_name) of an !import, or the reply saying why it can't run
+    args = message.content.lower().split()
+    attachment = message.attachments[0] if message.attachments else None
+    if len(args) != 2 or args[1] not in IMPORT_PARSERS or attachment is None:
+        return f"Invalid syntax. [SYNTAX] !import <{"|".join(IMPORT_PARSERS)}> with a .csv or .jsonl file attached"
+    table = args[1]
+    file_name = attachment.filename.lower()
+    if not file_name.removesuffix(".gz").endswith((".csv", ".jsonl", ".ndjson")):
+        return "Invalid file. Attach a .csv, .jsonl or .ndjson file, optionally gzipped."
+    if attachment.size > IMPORT_MAX_BYTES:
+        return f"Could not import {table}: files are limited to {IMPORT_MAX_BYTES // 1_000_000} MB."
+    return table, attachment, file_name
+
+async def prepare_import(message):
+    """
+    Downloads and parses an !import's file before its transaction opens, so a retried transaction never downloads it again
+    and the locked attempt doesn't hold STATE_LOCK through the download.
+    Returns (row_count, [(line_number, fields)], [(line_number, problem)], problem_count), the reply if the file can't be read,
+    or None if there is nothing to import.
+    """
+    request = get_import_request(message)
+    if isinstance(request, str) or not await validate_user_permission(message.guild.id, message.author.id):
+        return None
+    table, attachment, file_name = request
+    handle, path = tempfile.mkstemp(prefix = "commerce-import-")
+    os.close(handle)
+    rows, parsed, errors, error_count = 0, [], [], 0
+    try:
+        await download_attachment(attachment, path)
+        for line_number, row in read_import_rows(path, file_name):
+            rows += 1
+            try:
+                parsed.append((line_number, parse_import_row(table, row)))
+            except ValueError as e:
+                error_count += 1
+                if len(errors) < IMPORT_MAX_ERRORS:
+                    errors.append((line_number, str(e)))
+            if rows % EXPORT_YIELD_ROWS == 0:
+                await asyncio.sleep(0)
+    except (ValueError, UnicodeDecodeError, OSError, csv.Error) as e:
+        return f"Could not import {table}: the file could not be read ({e})."
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+    return rows, parsed, errors, error_count
+
+async def handle_import(message): #!import <users|inventory|shop> with a .csv or .jsonl file (optionally .gz) attached
+    server_id = str(message.guild.id)
+    channel_id = message.channel.id
+    request = get_import_request(message)
+    if isinstance(request, str):
+        await send_error(request, channel_id)
+        return
+    table = request[0]
+    prepared = PREPARED_IMPORT.get()
+    if prepared is None: #Only read by run_command, a batch can't wait on a download
+        await send_error(f"Could not import {table}: send !import on its own, not in a batch.", channel_id)
+        return
+    if isinstance(prepared, str):
+        await send_error(prepared, channel_id)
+        return
+    rows, parsed, errors, error_count = prepared
+
+    users, shop = await asyncio.gather(async_load_json(USERS_FILE), async_load_json(SHOP_FILE))
+    server_users = users[server_id]
+    server_shop = shop[server_id]
+    item_names = {item["name"].lower(): str(item_id) for item_id, item in server_shop["Items"].items()} if table == "shop" else None
+    errors = list(errors) #Kept as prepared for a retry of the transaction
+    for count, (line_number, fields) in enumerate(parsed, start = 1): #Checked against the current data first, nothing changes unless every row is valid
+        problem = check_import_row(table, fields, server_users, server_shop["Items"], item_names)
+        if problem:
+            error_count += 1
+            errors.append((line_number, problem))
+        if count % EXPORT_YIELD_ROWS == 0:
+            await asyncio.sleep(0)
+    if error_count:
+        errors = sorted(errors)[:IMPORT_MAX_ERRORS]
+        await send_error(f"Could not import {table}, nothing was changed. {error_count:,} of {rows:,} rows have problems:\n" + "\n".join(f"line {line_number}: {problem}" for line_number, problem in errors), channel_id)
+        return
+    for count, (line_number, fields) in enumerate(parsed, start = 1):
+        apply_import_row(table, fields, server_id, server_users, server_shop)
+        if count % EXPORT_YIELD_ROWS == 0:
+            await asyncio.sleep(0)
 
+    if table == "shop":
+        await async_save_json(SHOP_FILE, shop)
+    else:
+        await async_save_json(USERS_FILE, users)
+        build_server_leaderboards(server_id, server_users) #One rebuild instead of a ranking update per row
+    await send_message(f"Imported {rows:,} row{"s" if rows != 1 else ""} of {table}.", channel_id)
+
+def auction_index(server_id, server_auctions = None):
+    index = AUCTION_INDEXES.get(server_id)
+    if index is None:
+        if SHOP_FILE in READ_STATE: #Built from what's committed, the changes made since are applied by sync_auction_index
+            server_auctions = decode_published(SHOP_FILE, READ_STATE[SHOP_FILE]).get(server_id, {}).get("Auctions", {})
+        index = AUCTION_INDEXES[server_id] = AuctionIndex(server_auctions)
+    return index
+
+def sync_auction_index(server_id, auction_id, auction = None): #Call after an auction is created, bid on or ended (auction None), applied once committed
+    entry = AuctionIndex.entry(auction) if auction is not None else None
+    def commit():
+        index = AUCTION_INDEXES.get(server_id)
+        if index is None: #Built from shop.json the first time it's needed
+            return
+        if entry is None:
+            index.remove(str(auction_id))
+        else:
+            index.update(str(auction_id), entry)
+    run_after_commit(commit)
 
+@traced("create_auction")
 async def create_auction(name, item_id, quantity, starting_bid, value, duration_minutes, user_id, server_id):
     shop = await async_load_json(SHOP_FILE)
     auction_id = shop[server_id]["Next Auction ID"]
@@ -1157,7 +4793,8 @@ async def create_auction(name, item_id, quantity, starting_bid, value, duration_
     }
     shop[server_id]["Next Auction ID"] += 1
     await async_save_json(SHOP_FILE, shop)
-    asyncio.create_task(auction_timer(server_id, auction_id, end_time_utc.isoformat()))
+    sync_auction_index(server_id, auction_id, shop[server_id]["Auctions"][auction_id])
+    run_after_commit(lambda: schedule_auction(server_id, auction_id, end_time_utc.isoformat()))
 
 async def handle_bid(message): #!bid <auction_id> <amount_of_money>
     channel_id = message.channel.id
@@ -1166,22 +4803,22 @@ async def handle_bid(message): #!bid <auction_id> <amount_of_money>
     pattern = r"^!bid\s+(\d+)\s+(\d+)"
     match = re.match(pattern, message.content.strip())
     if not match:
-        await send_message("Invalid syntax. [SYNTAX] !bid <auction_id> <amount_of_money>", channel_id)
+        await send_error("Invalid syntax. [SYNTAX] !bid <auction_id> <amount_of_money>", channel_id)
         return
     auction_id = match.group(1)
     shop = await async_load_json(SHOP_FILE)
     if auction_id in shop[server_id]["Auctions"]:
         if user_id == shop[server_id]["Auctions"][auction_id]["user_id"]:
-            await send_message(f"You can not bid on your own auction.", channel_id)
+            await send_error(f"You can not bid on your own auction.", channel_id)
         users = await async_load_json(USERS_FILE)
         amount = int(match.group(2))
         if user_id in users[server_id]:
             if users[server_id][user_id]["wallet"] < amount:
-                await send_message(f"You do not have {amount} in your wallet, please try again.", channel_id)
+                await send_error(f"You do not have {amount} in your wallet, please try again.", channel_id)
                 return
             else:
                 if amount <= shop[server_id]["Auctions"][auction_id]["current_bid"]:
-                    await send_message(f"Your bid needs to be higher than the current highest bid. Current highest bid: {shop[server_id]["Auctions"][auction_id]["current_bid"]}.", channel_id)
+                    await send_error(f"Your bid needs to be higher than the current highest bid. Current highest bid: {shop[server_id]["Auctions"][auction_id]["current_bid"]}.", channel_id)
                     return
                 else:
                     shop[server_id]["Auctions"][auction_id]["bids"][shop[server_id]["Auctions"][auction_id]["number_of_bids"] + 1] = {
@@ -1194,11 +4831,12 @@ async def handle_bid(message): #!bid <auction_id> <amount_of_money>
                     shop[server_id]["Auctions"][auction_id]["current_bid"] = amount
                     shop[server_id]["Auctions"][auction_id]["current_highest_bidder_id"] = user_id
                     await async_save_json(SHOP_FILE, shop)
+                    sync_auction_index(server_id, auction_id, shop[server_id]["Auctions"][auction_id])
         else:
             if DEBUG:
                 print("[red][ERROR] User not found in users.json. Was there an issue with the create_user method?")
     else:
-        await send_message(f"Auction ID {auction_id} does not exist or has already ended, please try again.", channel_id)
+        await send_error(f"Auction ID {auction_id} does not exist or has already ended, please try again.", channel_id)
         return
     await send_message(f"Bid of {amount} successful.", channel_id)
 
@@ -1208,7 +4846,7 @@ async def handle_create_auction(message): #!create_auction(<name_of_item>) <quan
     pattern = r"^!create_auction\s+\(([^)]+)\)\s+(\d+)\s+(\d+)\s+(\d+)$"
     match = re.match(pattern, message.content.strip())
     if not match:
-        await send_message("Invalid syntax. [SYNTAX] !create_auction (<name_of_item>) <quantity> <starting_bid> <number_of_minutes>", channel_id)
+        await send_error("Invalid syntax. [SYNTAX] !create_auction (<name_of_item>) <quantity> <starting_bid> <number_of_minutes>", channel_id)
         return
 
     item_name = match.group(1)
@@ -1250,7 +4888,7 @@ async def handle_create_shop_item(message): #!create_shop_item (<name_of_item>)
     pattern = r"^!create_shop_item\s+\(([^)]+)\)\s+(\d+)\s*(\d+)?\s*(\d+)?$"
     match = re.match(pattern, content)
     if not match:
-        await send_message("Invalid syntax. [SYNTAX] !create_shop_item (<name_of_item>) <price_int> <OPTIONAL_quantity> <OPTIONAL_refresh_time_in_days>", channel_id)
+        await send_error("Invalid syntax. [SYNTAX] !create_shop_item (<name_of_item>) <price_int> <OPTIONAL_quantity> <OPTIONAL_refresh_time_in_days>", channel_id)
         return
     
     if match:
@@ -1263,7 +4901,7 @@ async def handle_create_shop_item(message): #!create_shop_item (<name_of_item>)
     server_id = message.guild.id
     for key, item in shop[str(server_id)]["Items"].items():
         if item["name"].lower() == name.lower():
-            await send_message(f"{name} already exists in the shop. Use !edit_shop_item if you want to change it.", channel_id)
+            await send_error(f"{name} already exists in the shop. Use !edit_shop_item if you want to change it.", channel_id)
             return
     item_id = shop[str(server_id)]["Next Shop ID"]
     if price == 0:
@@ -1285,7 +4923,7 @@ async def handle_delete_shop_item(message): #!delete_shop_item (<name_of_item>)
     pattern = r"^!delete_shop_item\s+\(([^)]+)\)"
     match = re.match(pattern, content)
     if not match:
-        await send_message("Invalid syntax. [SYNTAX] !delete_shop_item (<name_of_item>)", channel_id)
+        await send_error("Invalid syntax. [SYNTAX] !delete_shop_item (<name_of_item>)", channel_id)
         return
     
     if match:
@@ -1303,7 +4941,7 @@ async def handle_delete_shop_item(message): #!delete_shop_item (<name_of_item>)
         await async_save_json(SHOP_FILE, shop)
         await send_message(f"{name} successfully removed from the shop.", channel_id)
     else:
-        await send_message(f"{name} is not currently in the shop.", channel_id)
+        await send_error(f"{name} is not currently in the shop.", channel_id)
 
 async def handle_edit_shop_item(message):
     content = message.content.strip()
@@ -1313,7 +4951,7 @@ async def handle_edit_shop_item(message):
     changes_made = False
     changes_skipped = False
     if not match:
-        await send_message("Invalid syntax. [SYNTAX] !edit_shop_item (<name_of_item>) (<name|price|quantity|refresh_time>) (<new_value>)... e.g !edit_shop_item (Cool Item) (name) (Even Cooler Item) (price) (500)", channel_id)
+        await send_error("Invalid syntax. [SYNTAX] !edit_shop_item (<name_of_item>) (<name|price|quantity|refresh_time>) (<new_value>)... e.g !edit_shop_item (Cool Item) (name) (Even Cooler Item) (price) (500)", channel_id)
         return
     
     server_id = message.guild.id
@@ -1332,7 +4970,7 @@ async def handle_edit_shop_item(message):
             found = True
             break
     if not found:
-        await send_message(f"{name} is not currently in the shop.", channel_id)
+        await send_error(f"{name} is not currently in the shop.", channel_id)
         return
 
     tail = content[match.end(1):]
@@ -1345,7 +4983,7 @@ async def handle_edit_shop_item(message):
     for attr, val in updates.items():
         if attr.lower() in ["name", "price", "quantity", "refresh_time"]:
             if not val.isdigit() and attr.lower() != "name":
-                await send_message(f"{attr.capitalize()} needs to be a number.", channel_id)
+                await send_error(f"{attr.capitalize()} needs to be a number.", channel_id)
                 return
             if attr.lower() == "quantity" and val == "0":
                 val = "Unlimited"
@@ -1370,7 +5008,7 @@ async def handle_edit_shop_item(message):
         else:
             await send_message(f"{name} successfully edited. Some requested changes were invalid, and skipped.", channel_id)
     else:
-        await send_message(f"There were no valid attributes to change in the command.", channel_id)
+        await send_error(f"There were no valid attributes to change in the command.", channel_id)
 
 async def handle_reset_user_inventory(message):
     content = message.content.strip()
@@ -1381,7 +5019,7 @@ async def handle_reset_user_inventory(message):
     user_id = None
     user_name = None
     if not match:
-        await send_message("Invalid syntax. [SYNTAX] !reset_user_inventory (<name_of_user OR user_id>)", channel_id)
+        await send_error("Invalid syntax. [SYNTAX] !reset_user_inventory (<name_of_user OR user_id>)", channel_id)
         return
     
     if match.group(1).isdigit():
@@ -1407,7 +5045,7 @@ async def handle_reset_user_inventory(message):
     if found:
         await send_message(f"{user_name}'s inventory has been cleared.", channel_id)
     else:
-        await send_message(f"{user_name if user_name else user_id} was not found.", channel_id)
+        await send_error(f"{user_name if user_name else user_id} was not found.", channel_id)
     await async_save_json(USERS_FILE, users) 
 
 async def handle_reset_user(message):
@@ -1419,7 +5057,7 @@ async def handle_reset_user(message):
     user_id = None
     user_name = None
     if not match:
-        await send_message("Invalid syntax. [SYNTAX] !reset_user (<name_of_user OR user_id>)", channel_id)
+        await send_error("Invalid syntax. [SYNTAX] !reset_user (<name_of_user OR user_id>)", channel_id)
         return
     
     if match.group(1).isdigit():
@@ -1427,61 +5065,225 @@ async def handle_reset_user(message):
     else:
         user_name = match.group(1)
 
-    users = await async_load_json(USERS_FILE)
+    users, predictions = await asyncio.gather(async_load_json(USERS_FILE), async_load_json(PREDICTIONS_FILE))
     found = False
     if user_id:
         if user_id in users[server_id]:
-            del users[server_id][user_id]
+            close_wallet(server_id, user_id, users[server_id].pop(user_id))
             found = True
     elif user_name:
         for uid, user_data in users[server_id].items():
             if user_data["display_name"].lower() == user_name.lower() or user_data["user_name"].lower() == user_name.lower():
-                del users[server_id][uid]
+                close_wallet(server_id, uid, users[server_id].pop(uid))
                 found = True
                 user_id = uid
                 break
     
     if found:
-        await async_save_json(USERS_FILE, users)
-        await add_user_to_json(server_id, user_id)
+        refunds = cancel_user_bets(server_id, user_id, predictions[server_id]["Predictions"])
+        await asyncio.gather(async_save_json(USERS_FILE, users), async_save_json(PREDICTIONS_FILE, predictions))
+        sync_user_rankings(server_id, user_id)
+        await add_user_to_json(server_id, user_id, message.guild.get_member(int(user_id)))
+        if refunds: #Open bets are taken off their predictions and the stakes given back on top of the new balance
+            users = await async_load_json(USERS_FILE)
+            for prediction_id, amount in refunds.items():
+                adjust_wallet(server_id, user_id, users[server_id][user_id], amount, "refund", prediction_id)
+            await async_save_json(USERS_FILE, users)
+            sync_user_rankings(server_id, user_id, users[server_id][user_id])
         if not user_name:
             user_name = await get_display_name(int(server_id), int(user_id))
-        await send_message(f"{user_name} has been reset.", channel_id)
+        await send_message(f"{user_name} has been reset{f", {len(refunds)} open bet{"" if len(refunds) == 1 else "s"} refunded" if refunds else ""}.", channel_id)
     else:
-        await send_message(f"{user_name if user_name else user_id} was not found.", channel_id)
-    #Currently does not reset bets done by the user on predictions
+        await send_error(f"{user_name if user_name else user_id} was not found.", channel_id)
 
-async def handle_purge_deprecated_users(message):
+async def handle_purge_deprecated_users(message): #!purge_deprecated_users <OPTIONAL_cancel>
     server_id = str(message.guild.id)
     channel_id = message.channel.id
-    guild = bot.get_guild(int(server_id))
-    if not guild:
-        if DEBUG:
-            print(F"[red][ERROR] Could not fetch guild! Is Discord down?")
+    args = message.content.split()
+    task = PURGE_JOBS.get(server_id)
+    if len(args) > 1 and args[1].lower() == "cancel":
+        if task and not task.done():
+            task.cancel()
+            await remove_purge_job(server_id)
+            await send_message("Purge cancelled.", channel_id)
+        else:
+            await send_error("There is no purge running.", channel_id)
         return
-    members = []
-    try:
-        async for member in guild.fetch_members(limit=None): members.append(member)
-        current_member_ids = {str(member.id) for member in members}
-    except Exception as e:
-        if DEBUG:
-            print(f"[red][ERROR] Failed to fetch members: {e}")
+    if task and not task.done():
+        job = await load_purge_job(server_id)
+        await send_error(f"A purge is already running: {format_purge_progress(message.guild, job)}", channel_id)
         return
+    job = {"cursor": 0, "checked": 0, "removed": 0, "channel_id": channel_id, "message_id": None, "started": datetime.now(timezone.utc).isoformat()}
+    await save_purge_job(server_id, job)
+    start_purge_job(server_id)
+    await send_message("Checking every member of the server in the background, progress will be posted here.", channel_id)
+
+def start_purge_job(server_id):
+    task = asyncio.create_task(run_purge_job(server_id), context = contextvars.Context()) #Not part of the command that started it
+    PURGE_JOBS[server_id] = task
+    return task
+
+async def load_purge_job(server_id):
+    path = os.path.join(PURGE_JOB_DIR, f"{server_id}.json")
+    if not os.path.exists(path):
+        return None
+    async with aiofiles.open(path, "rb") as f:
+        return decode_json(await f.read())
 
+async def save_purge_job(server_id, job):
+    os.makedirs(PURGE_JOB_DIR, exist_ok = True)
+    async with aiofiles.open(os.path.join(PURGE_JOB_DIR, f"{server_id}.json"), "wb") as f:
+        await f.write(encode_json(job))
 
-    users = await async_load_json(USERS_FILE)
-    if server_id not in users:
-        await send_message("No user data found for this servercha.", channel_id)
+async def remove_purge_job(server_id):
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(os.path.join(PURGE_JOB_DIR, f"{server_id}.json"))
+
+def format_purge_progress(guild, job):
+    total = getattr(guild, "member_count", None)
+    checked = f"{job['checked']:,}/{total:,}" if total else f"{job['checked']:,}"
+    return f"{checked} members checked, {job['removed']:,} departed user{"" if job['removed'] == 1 else "s"} removed."
+
+async def resume_purge_jobs(): #Jobs interrupted by a restart carry on from their last checkpoint
+    if not os.path.isdir(PURGE_JOB_DIR):
         return
-    
-    removed_users = []
-    for user_id in list(users[server_id].keys()):
-        if user_id not in current_member_ids:
-            del users[server_id][user_id]
-            removed_users.append(user_id)
+    for file_name in os.listdir(PURGE_JOB_DIR):
+        server_id = file_name.removesuffix(".json")
+        if file_name.endswith(".json") and owns_server(server_id) and server_id not in PURGE_JOBS:
+            start_purge_job(server_id)
 
-    await async_save_json(USERS_FILE, users)
-    await send_message(f"Removed {len(removed_users)} user{"s" if len(removed_users) > 1 or len(removed_users) == 0 else ""} no longer in the server.", channel_id)
+@traced("purge_job")
+async def run_purge_job(server_id):
+    """
+    Walks the member list in id order, PURGE_CHUNK_SIZE members per REST call, outside the command queue.
+    users.json ids between the previous and the last member id of a chunk that weren't in the chunk have left and are removed.
+    The cursor is saved after every chunk so an interrupted job resumes where it stopped.
+    """
+    CURRENT_COMMAND.set("purge_job")
+    job = await load_purge_job(server_id)
+    guild = bot.get_guild(int(server_id))
+    if not job or not guild:
+        await remove_purge_job(server_id)
+        return
+    last_progress = 0
+    while True:
+        try:
+            with rest_call("fetch_members"):
+                members = [member async for member in guild.fetch_members(limit = PURGE_CHUNK_SIZE, after = discord.Object(id = job["cursor"]) if job["cursor"] else None)]
+        except Exception as e:
+            print(f"[red]Purge of server {server_id} stopped at member {job['cursor']}, it resumes on restart: {e}")
+            return
+        member_ids = {member.id for member in members}
+        last_id = max(member_ids) if len(members) == PURGE_CHUNK_SIZE else None #None: last chunk, everyone after the cursor is covered
+        async with STATE_LOCK, locked_transaction():
+            users = await async_load_json(USERS_FILE)
+            departed = [
+                user_id for user_id in users.get(server_id, {})
+                if user_id.isdigit() and int(user_id) > job["cursor"] and (last_id is None or int(user_id) <= last_id) and int(user_id) not in member_ids
+            ]
+            if departed:
+                for user_id in departed:
+                    close_wallet(server_id, user_id, users[server_id].pop(user_id))
+                await async_save_json(USERS_FILE, users)
+                await remove_departed_bets(server_id, departed)
+                for user_id in departed:
+                    sync_user_rankings(server_id, user_id)
+                    DEPARTED_USERS.get(server_id, {}).pop(user_id, None)
+        job["checked"] += len(members)
+        job["removed"] += len(departed)
+        if last_id is None:
+            break
+        job["cursor"] = last_id
+        await save_purge_job(server_id, job)
+        if time.monotonic() - last_progress >= PURGE_PROGRESS_SECONDS:
+            last_progress = time.monotonic()
+            job["message_id"] = await update_purge_progress(guild, job)
+    await remove_purge_job(server_id)
+    await send_message(f"Purge finished: {format_purge_progress(guild, job)}", job["channel_id"])
+
+async def update_purge_progress(guild, job): #Edits the progress message, or posts it the first time. Returns its id
+    content = f"Purge in progress: {format_purge_progress(guild, job)}"
+    if job["message_id"]:
+        try:
+            await edit_message(content, job["channel_id"], job["message_id"])
+            return job["message_id"]
+        except Exception as e:
+            if DEBUG:
+                print(f"[yellow]Could not edit purge progress message: {e}")
+    return await send_message(content, job["channel_id"])
+
+async def remove_departed_bets(server_id, user_ids): #Their stakes leave the prediction pools with them, nobody is left to refund
+    predictions = await async_load_json(PREDICTIONS_FILE)
+    server_predictions = predictions.get(server_id, {}).get("Predictions", {})
+    cancelled = [cancel_user_bets(server_id, user_id, server_predictions) for user_id in user_ids]
+    if any(cancelled):
+        await async_save_json(PREDICTIONS_FILE, predictions)
+        count_pool_flow(server_id, "unclaimed_pool", -sum(sum(refunds.values()) for refunds in cancelled))
+
+def mark_departure(server_id, user_id, departed_at): #departed_at None means the user came back
+    PENDING_DEPARTURES.setdefault(str(server_id), {})[str(user_id)] = departed_at
+
+def index_departed_users(users):
+    DEPARTED_USERS.clear()
+    for server_id, server_users in users.items():
+        departed = {user_id: user["departed_at"] for user_id, user in server_users.items() if user.get("departed_at")}
+        if departed:
+            DEPARTED_USERS[server_id] = departed
+
+async def sweep_departures():
+    """
+    Writes the buffered join/leave events into users.json and removes users who left more than DEPARTURE_GRACE_HOURS ago.
+    Does nothing, and reads nothing, when there are no events and nobody's grace period is over.
+    """
+    cutoff = (datetime.now(timezone.utc) - timedelta(hours = DEPARTURE_GRACE_HOURS)).isoformat()
+    expired = {server_id: [user_id for user_id, departed_at in departed.items() if departed_at <= cutoff] for server_id, departed in DEPARTED_USERS.items()}
+    if not PENDING_DEPARTURES and not any(expired.values()):
+        return 0
+    pending = dict(PENDING_DEPARTURES)
+    PENDING_DEPARTURES.clear()
+    removed = 0
+    changed = False
+    async with STATE_LOCK, locked_transaction():
+        users = await async_load_json(USERS_FILE)
+        for server_id, events in pending.items():
+            server_users = users.get(server_id, {})
+            for user_id, departed_at in events.items():
+                if user_id not in server_users:
+                    continue
+                changed = True
+                if departed_at:
+                    server_users[user_id]["departed_at"] = departed_at
+                    DEPARTED_USERS.setdefault(server_id, {})[user_id] = departed_at
+                    if departed_at <= cutoff:
+                        expired.setdefault(server_id, []).append(user_id)
+                else:
+                    server_users[user_id].pop("departed_at", None)
+                    DEPARTED_USERS.get(server_id, {}).pop(user_id, None)
+        removed_users = {}
+        for server_id, user_ids in expired.items():
+            for user_id in user_ids:
+                if users.get(server_id, {}).get(user_id, {}).get("departed_at"): #Still gone
+                    close_wallet(server_id, user_id, users[server_id].pop(user_id))
+                    sync_user_rankings(server_id, user_id)
+                    removed_users.setdefault(server_id, []).append(user_id)
+                    removed += 1
+                    changed = True
+                DEPARTED_USERS.get(server_id, {}).pop(user_id, None)
+        if changed:
+            await async_save_json(USERS_FILE, users)
+        for server_id, user_ids in removed_users.items():
+            await remove_departed_bets(server_id, user_ids)
+    if DEBUG:
+        print(f"[green]Membership sweep: {sum(len(events) for events in pending.values())} events applied, {removed} departed users removed")
+    return removed
+
+async def membership_sweep_loop():
+    while True:
+        await asyncio.sleep(MEMBERSHIP_SWEEP_SECONDS)
+        try:
+            await sweep_departures()
+        except Exception as e:
+            print(f"[red]Membership sweep failed: {e!r}")
 
 async def handle_set_default_channel(message):
     content = message.content
@@ -1493,7 +5295,7 @@ async def handle_set_default_channel(message):
             channel_name = await get_channel_name(channel_id)
             if not channel_name:
                 channel_id = message.channel.id
-                await send_message("Invalid channel id. Try again, or go to the channel you want as default and use command !set_default_channel.", channel_id)
+                await send_error("Invalid channel id. Try again, or go to the channel you want as default and use command !set_default_channel.", channel_id)
                 return
             else:
                 settings[str(message.guild.id)]["Default Commerce Channel ID"] = channel_id
@@ -1507,7 +5309,8 @@ async def handle_set_default_channel(message):
 
 async def get_channel_name(channel_id):
     channel_id = int(channel_id)
-    channel = await bot.fetch_channel(channel_id)
+    with rest_call("fetch_channel"):
+        channel = await bot.fetch_channel(channel_id)
     channel_name = channel.name
     return channel_name
 
@@ -1521,13 +5324,13 @@ async def handle_toggle_command(message):
     matches = re.findall(r"\(([^)]+)\)\s+\(([^)]+)\)", content)
 
     if not matches:
-        await send_message("Invalid syntax. [SYNTAX] !toggle_command (!command) (true/false) [...]", channel_id)
+        await send_error("Invalid syntax. [SYNTAX] !toggle_command (!command) (true/false) [...]", channel_id)
         return
 
     settings = await async_load_json(SETTINGS_FILE)
 
     if server_id not in settings:
-        await send_message("Server settings not found.", channel_id)
+        await send_error("Server settings not found.", channel_id)
         return
 
     updated = []
@@ -1563,32 +5366,387 @@ async def handle_toggle_command(message):
     if failed:
         result += "**⚠️ Failed:**\n" + "\n".join(failed)
 
-    await send_message(result, channel_id)
+    if updated:
+        await send_message(result, channel_id)
+    else:
+        await send_error(result, channel_id)
+
 
+async def log_slow_trace(span): #One JSON object per line so the log can be grepped or loaded line by line
+    record = {"time": datetime.now(timezone.utc).isoformat(), "threshold_ms": TRACE_SLOW_MS, **span.to_record()}
+    if DEBUG:
+        print(f"[yellow]Slow {span.name}: {span.duration_ms:.1f}ms")
+    try:
+        async with aiofiles.open(TRACE_LOG_FILE, "a", encoding="utf-8") as f:
+            await f.write(json.dumps(record) + "\n")
+    except OSError as e:
+        if DEBUG:
+            print(f"[red][ERROR] Could not write slow trace: {e}")
+
+def start_command_profile():
+    if PROFILER["remaining"] <= 0:
+        return None
+    if PROFILER["profiler"] is None:
+        PROFILER["profiler"] = cProfile.Profile()
+    PROFILER["profiler"].enable()
+    return PROFILER["profiler"]
+
+@contextlib.asynccontextmanager
+async def command_profile(): #Profiles the command run inside it when !profile asked for it, one command at a time
+    if PROFILER["remaining"] <= 0:
+        yield
+        return
+    async with PROFILE_LOCK:
+        profiler = start_command_profile() #None if the last profiled command finished while this one waited
+        try:
+            yield
+        finally:
+            await finish_command_profile(profiler)
+
+async def finish_command_profile(profiler):
+    if profiler is None:
+        return
+    profiler.disable()
+    PROFILER["remaining"] -= 1
+    PROFILER["profiled"] += 1
+    if PROFILER["remaining"] > 0:
+        return
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f"profile-{datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S")}.prof")
+    profiler.dump_stats(path)
+    summary = io.StringIO()
+    pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(30)
+    with open(path[:-len(".prof")] + ".txt", "w", encoding="utf-8") as f:
+        f.write(summary.getvalue())
+    channel_id = PROFILER["channel_id"]
+    count = PROFILER["profiled"]
+    PROFILER.update({"profiler": None, "remaining": 0, "profiled": 0, "channel_id": None})
+    if channel_id:
+        await send_message(f"Profile of the last {count} command{"s" if count != 1 else ""} saved to `{os.path.relpath(path, BASE_DIR)}` (summary in the matching .txt file).", channel_id)
+
+async def handle_profile(message): #!profile <number_of_commands or off>
+    args = message.content.split()
+    channel_id = message.channel.id
+    if len(args) > 1 and args[1].lower() in ("off", "0"):
+        PROFILER.update({"profiler": None, "remaining": 0, "profiled": 0, "channel_id": None})
+        await send_message("Profiling stopped.", channel_id)
+        return
+    if len(args) < 2 or not args[1].isdigit():
+        await send_error("Invalid syntax. [SYNTAX] !profile <number_of_commands or off>", channel_id)
+        return
+    PROFILER.update({"profiler": None, "remaining": int(args[1]), "profiled": 0, "channel_id": channel_id})
+    await send_message(f"Profiling the next {args[1]} command{"s" if args[1] != "1" else ""}.", channel_id)
+
+async def handle_stats(message): #!stats
+    embed = discord.Embed(title="📈 Bot Stats", color=discord.Color.blurple())
+
+    queue_wait = METRICS.histograms.get(("commerce_command_queue_wait_seconds", ()))
+    embed.add_field(
+        name="Command Queue",
+        value=f"Waiting: `{len(COMMAND_QUEUE)}`\nWait p50: `≤{format_seconds(queue_wait.quantile(0.5)) if queue_wait else "-"}` • p99: `≤{format_seconds(queue_wait.quantile(0.99)) if queue_wait else "-"}`",
+        inline=False
+    )
+
+    durations = sorted(METRICS.series("commerce_command_duration_seconds"), key=lambda item: item[1].count, reverse=True)
+    command_lines = []
+    for labels, histogram in durations[:15]:
+        command = labels["command"]
+        command_lines.append(
+            f"`{command}` ×{histogram.count} • avg `{format_seconds(histogram.sum / histogram.count)}` • p99 `≤{format_seconds(histogram.quantile(0.99))}`"
+            f" • io `{METRICS.total("commerce_json_loads_total", command=command)}r/{METRICS.total("commerce_json_saves_total", command=command)}w`"
+            f" • rest `{METRICS.total("commerce_rest_calls_total", command=command)}`"
+        )
+    embed.add_field(name="Commands", value="\n".join(command_lines) or "No commands yet.", inline=False)
+
+    embed.add_field(
+        name="Storage",
+        value=(
+            f"Loads: `{METRICS.total("commerce_json_loads_total"):,}` (`{METRICS.total("commerce_json_load_bytes_total") / 1e6:,.1f} MB`)\n"
+            f"Saves: `{METRICS.total("commerce_json_saves_total"):,}` (`{METRICS.total("commerce_json_save_bytes_total") / 1e6:,.1f} MB`)"
+        ),
+        inline=True
+    )
+    rest_calls = {}
+    for labels, value in METRICS.series("commerce_rest_calls_total"):
+        rest_calls[labels["call"]] = rest_calls.get(labels["call"], 0) + value
+    embed.add_field(name="Discord REST", value="\n".join(f"{call}: `{count:,}`" for call, count in rest_calls.items()) or "None", inline=True)
+
+    lag = METRICS.histograms.get(("commerce_auction_timer_lag_seconds", ()))
+    if lag:
+        embed.add_field(name="Auction Timers", value=f"Resolved: `{lag.count}` • avg lag `{format_seconds(lag.sum / lag.count)}` • p99 `≤{format_seconds(lag.quantile(0.99))}`", inline=False)
+    await send_embed_message(embed, message.channel.id)
+
+def format_seconds(seconds):
+    if seconds == float("inf"):
+        return "∞"
+    if seconds < 1:
+        return f"{seconds * 1000:.0f}ms"
+    return f"{seconds:.2f}s"
+
+async def start_metrics_server():
+    global METRICS_SERVER
+    if not METRICS_PORT or METRICS_SERVER:
+        return
+    METRICS_SERVER = await asyncio.start_server(handle_metrics_request, METRICS_HOST, METRICS_PORT)
+    print(f"[green]Metrics available at http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+async def handle_metrics_request(reader, writer):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()).strip(): #Headers aren't needed
+            pass
+        parts = request_line.split()
+        if len(parts) > 1 and parts[0] == b"GET" and parts[1].split(b"?")[0] == b"/metrics":
+            status = "200 OK"
+            body = METRICS.render().encode("utf-8")
+        else:
+            status = "404 Not Found"
+            body = b"Not found, try /metrics\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("ascii") + body
+        )
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
 
 async def command_loop():
+    await asyncio.gather(*(command_worker() for _ in range(COMMAND_WORKERS)))
+
+async def command_worker():
     while True:
-        while not COMMAND_QUEUE:
-            await asyncio.sleep(1)
-        await check_for_command(COMMAND_QUEUE[0])
-        COMMAND_QUEUE.pop(0)
+        COMMAND_WAKEUP.clear()
+        try:
+            if await process_next_command():
+                continue
+        except Exception as e: #Logged and counted in process_next_command, the worker keeps going
+            print(f"[red]Command failed: {e!r}")
+            continue
+        await COMMAND_WAKEUP.wait()
+
+def next_command(): #Oldest queued command that isn't waiting for an earlier one from the same user
+    waiting = set()
+    for entry in COMMAND_QUEUE:
+        message = entry[0]
+        user = (message.guild.id, message.author.id)
+        if user not in waiting and id(message) not in RUNNING_COMMANDS:
+            return entry
+        waiting.add(user)
+    return None
 
-async def start_auction_timers():
-    shop = await async_load_json(SHOP_FILE)
-    if not shop:
-        return
+async def process_next_command(): #Returns False when nothing in the queue can run yet
+    entry = next_command()
+    if entry is None:
+        return False
+    message, enqueued_at = entry
+    RUNNING_COMMANDS.add(id(message))
+    started_at = time.perf_counter()
+    command = get_command_label(message.content)
+    METRICS.observe("commerce_command_queue_wait_seconds", started_at - enqueued_at)
+    token = CURRENT_COMMAND.set(command)
+    span = None
+    try:
+        async with command_profile():
+            with trace_span(command, root = True, server_id = str(message.guild.id), user_id = str(message.author.id), content = message.content[:200]) as span:
+                await run_command(message)
+    except Exception:
+        METRICS.inc("commerce_command_errors_total", command = command)
+        raise
+    finally:
+        CURRENT_COMMAND.reset(token)
+        METRICS.inc("commerce_commands_total", command = command)
+        METRICS.observe("commerce_command_duration_seconds", time.perf_counter() - started_at, command = command)
+        COMMAND_QUEUE.remove(entry)
+        RUNNING_COMMANDS.discard(id(message))
+        COMMAND_WAKEUP.set() #The user's next command can run now
+        if span and span.duration_ms >= TRACE_SLOW_MS:
+            await log_slow_trace(span)
+    return True
+
+async def run_command(message):
+    """Runs a queued command in its own transaction, retried when it conflicts. Batches and slash commands open theirs in check_for_command."""
+    token = PREPARED_IMPORT.set(await prepare_import(message) if get_command_label(message.content) == "!import" else None)
+    try:
+        if isinstance(message, InteractionCommandMessage) or parse_batch(message.content):
+            await check_for_command(message)
+        else:
+            await run_transaction(lambda: check_for_command(message), server_id = str(message.guild.id))
+    finally:
+        PREPARED_IMPORT.reset(token)
+
+def get_command_label(content): #Command name used as a metrics label, anything unknown is grouped so labels stay bounded
+    if parse_batch(content):
+        return "!batch"
+    args = content.split()
+    command = args[0].lower() if args else ""
+    return command if command in LIST_OF_COMMANDS or command in ("!help", "!commands") else "other"
+
+def schedule_auction(server_id, auction_id, end_time): #Starts the auction's timer unless it already has one
+    key = (str(server_id), str(auction_id))
+    task = AUCTION_TIMERS.get(key)
+    if task and not task.done():
+        return task
+    task = asyncio.create_task(auction_timer(str(server_id), str(auction_id), end_time))
+    AUCTION_TIMERS[key] = task
+    task.add_done_callback(lambda finished: AUCTION_TIMERS.pop(key) if AUCTION_TIMERS.get(key) is finished else None)
+    return task
+
+async def start_auction_timers(shop = None):
+    if shop is None:
+        shop = await async_load_json(SHOP_FILE)
     for server_id, server_data in shop.items():
-        auctions = server_data.get("Auctions", {})
-        if auctions:
-            for auction_id, auction in auctions.items():
-                end_time = auction["auction_end"]
-                asyncio.create_task(auction_timer(server_id, auction_id, end_time))
+        for auction_id, auction in server_data.get("Auctions", {}).items():
+            schedule_auction(server_id, auction_id, auction["auction_end"])
+
+def validate_state(settings, users, shop, predictions):
+    """
+    Checks the loaded data files for missing sections and fields and fills them in with defaults.
+    Returns (list_of_problems, set_of_changed_file_paths)
+    """
+    problems = []
+    changed = set()
+    for path, data in ((SETTINGS_FILE, settings), (USERS_FILE, users), (SHOP_FILE, shop), (PREDICTIONS_FILE, predictions)):
+        if not isinstance(data, dict):
+            raise ValueError(f"{os.path.basename(path)} does not contain an object, fix or remove it before starting the bot.")
+
+    for server_id, server_shop in shop.items():
+        for section, default in (("Items", {}), ("Auctions", {})):
+            if section not in server_shop:
+                server_shop[section] = default
+                problems.append(f"shop.json server {server_id} was missing {section}")
+                changed.add(SHOP_FILE)
+        for counter, section in (("Next Shop ID", "Items"), ("Next Auction ID", "Auctions")):
+            next_id = max((int(key) for key in server_shop[section] if str(key).isdigit()), default = 0) + 1
+            if server_shop.get(counter, 0) < next_id:
+                server_shop[counter] = next_id
+                problems.append(f"shop.json server {server_id} had {counter} behind existing ids")
+                changed.add(SHOP_FILE)
+        for auction_id, auction in list(server_shop["Auctions"].items()):
+            if "auction_end" not in auction:
+                del server_shop["Auctions"][auction_id]
+                problems.append(f"shop.json server {server_id} auction {auction_id} had no end time and was removed")
+                changed.add(SHOP_FILE)
+
+    for server_id, server_predictions in predictions.items():
+        if "Predictions" not in server_predictions:
+            server_predictions["Predictions"] = {}
+            problems.append(f"predictions.json server {server_id} was missing Predictions")
+            changed.add(PREDICTIONS_FILE)
+        next_bet_number = max((int(key) for key in server_predictions["Predictions"] if str(key).isdigit()), default = 0) + 1
+        data = server_predictions.setdefault("Data", {})
+        if data.get("next_bet_number", 0) < next_bet_number:
+            data["next_bet_number"] = next_bet_number
+            problems.append(f"predictions.json server {server_id} had next_bet_number behind existing ids")
+            changed.add(PREDICTIONS_FILE)
+
+    defaults = new_user_record("", "")
+    for server_id, server_users in users.items():
+        for user_id, user in server_users.items():
+            missing = [field for field in defaults if field not in user]
+            for field in missing:
+                user[field] = copy_data(defaults[field]) if field != "wallet" else 0
+            if missing:
+                problems.append(f"users.json server {server_id} user {user_id} was missing {", ".join(missing)}")
+                changed.add(USERS_FILE)
+    return problems, changed
+
+async def startup():
+    """Runs once per process: loads and checks every data file, sets up every server, warms caches and starts the workers."""
+    timings = []
+    step_started = time.perf_counter()
+    def step_done(step):
+        nonlocal step_started
+        now = time.perf_counter()
+        timings.append((step, now - step_started))
+        step_started = now
+
+    await populate_data_folder()
+    step_done("data folder")
+    if STORAGE_BACKEND == "sqlite":
+        refused = await asyncio.to_thread(get_store().claim, [str(guild.id) for guild in bot.guilds])
+        for server_id, owner in refused.items():
+            print(f"[red]Server {server_id} is owned by {owner}, its commands will fail until that process stops or its lease runs out ({GUILD_LEASE_SECONDS}s after it last checked in).")
+        asyncio.create_task(lease_loop())
+        step_done(f"lease servers ({SHARD_OWNER})")
+    settings, users, shop, predictions, stocks, economy = await asyncio.gather(*(async_load_json(path) for path in FILEPATHS))
+    state = {SETTINGS_FILE: settings, USERS_FILE: users, SHOP_FILE: shop, PREDICTIONS_FILE: predictions}
+    step_done("load data files")
+    problems, changed = validate_state(settings, users, shop, predictions)
+    for problem in problems:
+        print(f"[yellow]{problem}")
+    step_done("validate")
+    for guild in bot.guilds:
+        changed |= apply_server_defaults(str(guild.id), settings, users, shop, predictions)
+        BOOTSTRAPPED_SERVERS.add(str(guild.id))
+    await asyncio.gather(*(async_save_json(path, state[path]) for path in changed))
+    step_done(f"bootstrap {len(bot.guilds)} servers")
+    rebuild_leaderboards(users)
+    index_departed_users(users)
+    index_autocomplete(SHOP_FILE, shop)
+    index_autocomplete(PREDICTIONS_FILE, predictions)
+    index_autocomplete(STOCKS_FILE, stocks)
+    load_market(stocks)
+    step_done("warm caches")
+    ledger = await asyncio.to_thread(get_ledger)
+    step_done(f"open ledger ({ledger.count:,} entries)")
+    await start_auction_timers(shop)
+    step_done(f"schedule {len(AUCTION_TIMERS)} auctions")
+    asyncio.create_task(command_loop())
+    asyncio.create_task(membership_sweep_loop())
+    asyncio.create_task(name_flush_loop())
+    asyncio.create_task(market_loop())
+    asyncio.create_task(ledger_loop())
+    asyncio.create_task(archive_loop())
+    asyncio.create_task(economy_loop())
+    await resume_purge_jobs()
+    if SNAPSHOT_INTERVAL_MINUTES > 0:
+        asyncio.create_task(snapshot_loop())
+    await start_metrics_server()
+    step_done("start workers")
+    try:
+        step_done("sync slash commands" if await sync_slash_commands() else "slash commands unchanged")
+    except discord.HTTPException as e:
+        print(f"[red]Could not sync slash commands: {e}")
+
+    total = time.perf_counter() - PROCESS_STARTED_AT
+    breakdown = ", ".join(f"{step} {seconds * 1000:.0f}ms" for step, seconds in timings)
+    print(f"[green]Ready in {total:.2f}s since launch ({breakdown})")
 
 @bot.event
 async def on_ready():
+    global STARTED
+    if STARTED:
+        print(f"[yellow]Reconnected as {bot.user}, startup already done")
+        return
+    STARTED = True
     print(f"[green]Logged in as {bot.user}")
-    asyncio.create_task(command_loop())
-    await start_auction_timers()
+    await startup()
+
+@bot.event
+async def on_guild_join(guild):
+    await run_transaction(lambda: add_server_to_jsons(str(guild.id)))
+
+@bot.event
+async def on_member_join(member):
+    mark_departure(member.guild.id, member.id, None)
+
+@bot.event
+async def on_member_update(before, after):
+    if before.display_name != after.display_name or before.name != after.name:
+        queue_name_update(after.guild.id, after.id, after.display_name, after.name)
+
+@bot.event
+async def on_user_update(before, after): #Username and global display name changes, for every server the bot shares with them
+    if before.name != after.name or before.display_name != after.display_name:
+        for guild in after.mutual_guilds:
+            member = guild.get_member(after.id)
+            if member:
+                queue_name_update(guild.id, after.id, member.display_name, after.name)
+
+@bot.event
+async def on_member_remove(member):
+    mark_departure(member.guild.id, member.id, datetime.now(timezone.utc).isoformat())
 
 @bot.event
 async def on_message(message):
@@ -1598,22 +5756,38 @@ async def get_message_ids(message):
     return message.guild.id, message.author.id
 
 async def send_message(message_to_send = "", channel_id = 0, pin = False):
+    transaction = CURRENT_TRANSACTION.get()
+    if transaction and not transaction.closed:
+        if transaction.channel_id == channel_id:
+            transaction.replies.append(message_to_send)
+        else:
+            transaction.outbox.append((send_message, (message_to_send, channel_id, pin)))
+        return
     channel = bot.get_channel(channel_id)
     if channel is None:
         try:
-            channel = await bot.fetch_channel(channel_id)
+            with rest_call("fetch_channel"):
+                channel = await bot.fetch_channel(channel_id)
         except Exception as e:
             if DEBUG:
                 print(f"[red][ERROR] Could not fetch channel {channel_id}: {e}")
             return
-    sent = await channel.send(message_to_send)
+    with trace_span("discord.send"):
+        sent = await channel.send(message_to_send)
     if pin == True: #Assuming if pinning, want everything else from the bot unpinned except the first message.
         await unpin_bot_messages(channel_id)
         await sent.pin()
     return sent.id
 
+async def send_error(message_to_send = "", channel_id = 0): #For replies saying a command did nothing, a batch rolls back on them
+    transaction = CURRENT_TRANSACTION.get()
+    if transaction and not transaction.closed:
+        transaction.failures += 1
+    return await send_message(message_to_send, channel_id)
+
 async def pin_message(message_id, channel_id, pin = True):
-    channel = await bot.fetch_channel(channel_id)
+    with rest_call("fetch_channel"):
+        channel = await bot.fetch_channel(channel_id)
     message = await channel.fetch_message(message_id)
     if pin:
         await message.pin()
@@ -1621,31 +5795,64 @@ async def pin_message(message_id, channel_id, pin = True):
         await message.unpin()
 
 async def edit_message(content, channel_id, message_id):
-    channel = await bot.fetch_channel(channel_id)
+    with rest_call("fetch_channel"):
+        channel = await bot.fetch_channel(channel_id)
     message = await channel.fetch_message(message_id)
     await message.edit(content = content)
 
 #Sends a message to discord as an embed
 async def send_embed_message(embed_message, channel_id, pin = False):
+    transaction = CURRENT_TRANSACTION.get()
+    if transaction and not transaction.closed:
+        if transaction.channel_id == channel_id:
+            transaction.embeds.append(embed_message)
+        else:
+            transaction.outbox.append((send_embed_message, (embed_message, channel_id, pin)))
+        return
     channel = bot.get_channel(channel_id)
-    sent = await channel.send(embed = embed_message)
+    with trace_span("discord.send"):
+        sent = await channel.send(embed = embed_message)
     if pin == True:
         await unpin_bot_messages(channel_id)
         await sent.pin()
 
+#Sends a temporary file as an attachment and removes it afterwards
+async def send_file(path, file_name, content, channel_id):
+    transaction = CURRENT_TRANSACTION.get()
+    if transaction and not transaction.closed:
+        if transaction.channel_id == channel_id:
+            transaction.attachments.append((path, file_name, content))
+        else:
+            transaction.outbox.append((send_file, (path, file_name, content, channel_id)))
+        return
+    try:
+        channel = bot.get_channel(channel_id)
+        if channel is None:
+            with rest_call("fetch_channel"):
+                channel = await bot.fetch_channel(channel_id)
+        with trace_span("discord.send"):
+            await channel.send(content, file = discord.File(path, filename = file_name))
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+
 async def validate_user_permission(server_id, user_id):
+    transaction = CURRENT_TRANSACTION.get()
+    if transaction and not transaction.closed and user_id in transaction.permissions:
+        return transaction.permissions[user_id]
     guild = bot.get_guild(server_id)
     if not guild:
         if DEBUG:
             print("[red]Server not found")
-    user = await guild.fetch_member(user_id)
+    with rest_call("fetch_member"):
+        user = await guild.fetch_member(user_id)
     if not user:
         if DEBUG:
             print("[red]User not found")
-    if user.guild_permissions.manage_channels:
-        return True
-    else:
-        return False
+    allowed = bool(user.guild_permissions.manage_channels)
+    if transaction and not transaction.closed:
+        transaction.permissions[user_id] = allowed
+    return allowed
     
 async def unpin_bot_messages(channel_id, is_reset = False):
     pst = ZoneInfo("America/Los_Angeles")
@@ -1653,7 +5860,8 @@ async def unpin_bot_messages(channel_id, is_reset = False):
     channel = bot.get_channel(channel_id)
     if channel is None:
         try:
-            channel = await bot.fetch_channel(channel_id)
+            with rest_call("fetch_channel"):
+                channel = await bot.fetch_channel(channel_id)
         except Exception as e:
             if DEBUG:
                 print(f"[red][ERROR][bot.py][unpin_bot_messages] Could not fetch channel {channel_id}")
@@ -1675,32 +5883,51 @@ async def unpin_bot_messages(channel_id, is_reset = False):
                     print(f"[red]Failed to unpin message: {e}")
 
 async def send_batch_embeds(list_of_embeds, channel_id):
+    transaction = CURRENT_TRANSACTION.get()
+    if transaction and not transaction.closed:
+        if transaction.channel_id == channel_id:
+            transaction.embeds.extend(list_of_embeds)
+        else:
+            transaction.outbox.append((send_batch_embeds, (list_of_embeds, channel_id)))
+        return
     channel = bot.get_channel(channel_id)
     for i in range(0, len(list_of_embeds), 10):
-        await channel.send(embeds = list_of_embeds[i:i + 10])
+        with trace_span("discord.send"):
+            await channel.send(embeds = list_of_embeds[i:i + 10])
+
+@contextlib.contextmanager
+def rest_call(call): #Wraps every Discord REST lookup so it's counted and shows up in traces
+    METRICS.inc("commerce_rest_calls_total", command = CURRENT_COMMAND.get(), call = call)
+    with trace_span(f"discord.{call}"):
+        yield
 
 async def get_display_name(server_id, user_id):
     guild = await get_guild(server_id)
-    user = await guild.fetch_member(int(user_id))
+    with rest_call("fetch_member"):
+        user = await guild.fetch_member(int(user_id))
     return user.display_name
 
 async def get_user_name(server_id, user_id):
     guild = await get_guild(server_id)
-    user = await guild.fetch_member(int(user_id))
+    with rest_call("fetch_member"):
+        user = await guild.fetch_member(int(user_id))
     return user.name
 
 async def get_guild(server_id):
     server_id = int(server_id)
-    guild = await bot.fetch_guild(server_id)
+    with rest_call("fetch_guild"):
+        guild = await bot.fetch_guild(server_id)
     return guild
 
 async def get_user(server_id, user_id):
     guild = await get_guild(int(server_id))
-    return await guild.fetch_member(int(user_id))
+    with rest_call("fetch_member"):
+        return await guild.fetch_member(int(user_id))
 
 async def get_user_id_from_username(server_id, name):
     guild = await get_guild(int(server_id))
-    members = [member async for member in guild.fetch_members(limit=None)]
+    with rest_call("fetch_members"):
+        members = [member async for member in guild.fetch_members(limit=None)]
     if DEBUG:
         print(f"[green]Fetched {len(members)} members")
     for member in members:
@@ -1708,7 +5935,407 @@ async def get_user_id_from_username(server_id, name):
             return member.id
     return None
 
+# Slash commands
+class InteractionCommandMessage:
+    """Stands in for a discord.Message when a slash command runs, content is the equivalent text command."""
+    def __init__(self, interaction, content):
+        self.interaction = interaction
+        self.id = interaction.id
+        self.content = content
+        self.guild = interaction.guild
+        self.author = interaction.user
+        self.channel = interaction.channel
+        self.mentions = []
+        self.role_mentions = []
+        self.attachments = [value for value in vars(interaction.namespace).values() if hasattr(value, "filename") and hasattr(value, "url")] #discord.Attachment options
+        self.created_at = interaction.created_at
+
+async def handle_interaction_command(message):
+    """Runs a slash command through check_for_command, collecting its replies to answer the deferred interaction with."""
+    try:
+        transaction = await run_transaction(lambda: check_for_command(message), message.channel.id, str(message.guild.id))
+    except Exception as e:
+        await message.interaction.followup.send(f"Command failed: {e}", ephemeral = True)
+        raise
+    if not transaction.replies and not transaction.embeds and not transaction.attachments:
+        await message.interaction.followup.send("Nothing to show. The command may be turned off here or need moderator permissions.", ephemeral = True)
+        return
+    for path, file_name, content in transaction.attachments:
+        try:
+            with trace_span("discord.send"):
+                await message.interaction.followup.send(content = content, file = discord.File(path, filename = file_name))
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+    replies = "\n".join(transaction.replies)
+    chunks = [replies[i:i + 2000] for i in range(0, len(replies), 2000)]
+    embed_groups = [transaction.embeds[i:i + 10] for i in range(0, len(transaction.embeds), 10)]
+    for index in range(max(len(chunks), len(embed_groups))):
+        with trace_span("discord.send"):
+            await message.interaction.followup.send(
+                content = chunks[index] if index < len(chunks) else None,
+                embeds = embed_groups[index] if index < len(embed_groups) else discord.utils.MISSING
+            )
+
+async def run_slash_command(interaction, content):
+    await interaction.response.defer(thinking = True) #Answered once the command gets through the queue
+    await handle_message(InteractionCommandMessage(interaction, content))
+
+def wrap(text): #Puts a slash command argument in the parentheses the text syntax uses
+    text = text.strip()
+    if "(" in text or ")" in text:
+        raise SlashArgumentError("Names can't contain parentheses.")
+    return f"({text})"
+
+class SlashArgumentError(ValueError):
+    pass
+
+def slash_command(name, description, moderator = False):
+    """
+    Registers build_content as the slash command /name. build_content gets the typed arguments and returns the
+    equivalent text command, which then goes through handle_message and the command queue like a typed one.
+    """
+    def decorator(build_content):
+        @functools.wraps(build_content)
+        async def callback(interaction, **arguments):
+            try:
+                content = build_content(interaction, **arguments)
+            except SlashArgumentError as e:
+                await interaction.response.send_message(str(e), ephemeral = True)
+                return
+            await run_slash_command(interaction, content)
+        command = app_commands.guild_only(bot.tree.command(name = name, description = description)(callback))
+        if moderator:
+            command = app_commands.default_permissions(manage_channels = True)(command)
+        return command
+    return decorator
+
+def index_autocomplete(path, data): #Called with every shop.json, predictions.json and stocks.json write
+    if path == PREDICTIONS_FILE:
+        for server_id, server_predictions in data.items():
+            AUTOCOMPLETE.setdefault(str(server_id), {})["predictions"] = {
+                str(prediction_id): (prediction["title"], dict(prediction.get("options", {})), prediction.get("open", False))
+                for prediction_id, prediction in server_predictions.get("Predictions", {}).items()
+            }
+    elif path == SHOP_FILE:
+        for server_id, server_shop in data.items():
+            index = AUTOCOMPLETE.setdefault(str(server_id), {})
+            index["items"] = {str(item_id): item["name"] for item_id, item in server_shop.get("Items", {}).items() if item.get("active", True)}
+            index["auctions"] = {
+                str(auction_id): f"#{auction_id} {auction['item']} x{auction['quantity']}, bid ${auction['current_bid']}"
+                for auction_id, auction in server_shop.get("Auctions", {}).items()
+            }
+    elif path == STOCKS_FILE:
+        for server_id, server_stocks in data.items():
+            AUTOCOMPLETE.setdefault(str(server_id), {})["stocks"] = {symbol: ticker["name"] for symbol, ticker in server_stocks.get("Tickers", {}).items()}
+
+def autocomplete_choices(options, current): #options is [(label, value)], matched on the label
+    current = current.lower()
+    return [app_commands.Choice(name = label[:100], value = value) for label, value in options if current in label.lower()][:AUTOCOMPLETE_LIMIT]
+
+async def prediction_autocomplete(interaction, current):
+    predictions = AUTOCOMPLETE.get(str(interaction.guild_id), {}).get("predictions", {})
+    return autocomplete_choices([(f"#{prediction_id} {title}{"" if is_open else " (closed)"}", prediction_id) for prediction_id, (title, options, is_open) in predictions.items()], current)
+
+async def prediction_option_autocomplete(interaction, current): #Options of the prediction picked in the same command
+    predictions = AUTOCOMPLETE.get(str(interaction.guild_id), {}).get("predictions", {})
+    prediction = predictions.get(str(getattr(interaction.namespace, "prediction", "")))
+    options = prediction[1] if prediction else {}
+    return autocomplete_choices([(f"{option_id}. {option}", option_id) for option_id, option in options.items()], current)
+
+async def item_autocomplete(interaction, current):
+    items = AUTOCOMPLETE.get(str(interaction.guild_id), {}).get("items", {})
+    return autocomplete_choices([(name, name) for name in items.values()], current)
+
+async def auction_autocomplete(interaction, current):
+    auctions = AUTOCOMPLETE.get(str(interaction.guild_id), {}).get("auctions", {})
+    return autocomplete_choices([(label, auction_id) for auction_id, label in auctions.items()], current)
+
+async def stock_autocomplete(interaction, current):
+    stocks = AUTOCOMPLETE.get(str(interaction.guild_id), {}).get("stocks", {})
+    return autocomplete_choices([(f"{symbol} {name}", symbol) for symbol, name in sorted(stocks.items())], current)
+
+@slash_command("help", "List the commands you can use")
+def slash_help(interaction):
+    return "!help"
+
+@slash_command("wallet", "Show your wallet balance")
+def slash_wallet(interaction):
+    return "!wallet"
+
+@slash_command("bet", "Bet on an open prediction")
+@app_commands.describe(prediction = "prediction to bet on", amount = "how much to bet", option = "option you're betting on")
+@app_commands.autocomplete(prediction = prediction_autocomplete, option = prediction_option_autocomplete)
+def slash_bet(interaction, prediction: str, amount: app_commands.Range[int, 1], option: str):
+    return f"!bet {prediction if prediction.isdigit() else wrap(prediction)} {amount} {option if option.isdigit() else wrap(option)}"
+
+@slash_command("shop", "Show the shop")
+def slash_shop(interaction):
+    return "!shop"
+
+@slash_command("buy", "Buy an item from the shop")
+@app_commands.describe(item = "item to buy", quantity = "how many (default 1)")
+@app_commands.autocomplete(item = item_autocomplete)
+def slash_buy(interaction, item: str, quantity: app_commands.Range[int, 1] = 1):
+    return f"!buy {wrap(item)} {quantity}"
+
+@slash_command("sell", "Sell an item from your inventory")
+@app_commands.describe(item = "item to sell", quantity = "how many (default 1)")
+@app_commands.autocomplete(item = item_autocomplete)
+def slash_sell(interaction, item: str, quantity: app_commands.Range[int, 1] = 1):
+    return f"!sell {wrap(item)} {quantity}"
+
+@slash_command("predictions", "Show the predictions")
+def slash_predictions(interaction):
+    return "!predictions"
+
+@slash_command("auction_item", "Auction an item from your inventory")
+@app_commands.describe(item = "item to auction", quantity = "how many", starting_bid = "lowest bid accepted", minutes = "how long the auction runs")
+@app_commands.autocomplete(item = item_autocomplete)
+def slash_auction_item(interaction, item: str, quantity: app_commands.Range[int, 1], starting_bid: app_commands.Range[int, 0], minutes: app_commands.Range[int, 1]):
+    return f"!auction_item {wrap(item)} {quantity} {starting_bid} {minutes}"
+
+@slash_command("auctions", "Show the running auctions")
+@app_commands.describe(sort = "order to list them in (default ending soonest)", item = "only auctions of items whose name contains this", seller = "only this member's auctions", min_price = "lowest current bid", max_price = "highest current bid", page = "1 is the first page")
+@app_commands.choices(sort = [app_commands.Choice(name = label, value = sort) for sort, label in AUCTION_SORTS.items()])
+@app_commands.autocomplete(item = item_autocomplete)
+def slash_auctions(interaction, sort: str = "ending", item: str = "", seller: discord.Member = None, min_price: app_commands.Range[int, 0] = None, max_price: app_commands.Range[int, 0] = None, page: app_commands.Range[int, 1] = 1):
+    filters = [sort, wrap(item) if item else "", f"seller:{seller.id}" if seller else "", f"min:{min_price}" if min_price is not None else "", f"max:{max_price}" if max_price is not None else "", str(page)]
+    return " ".join(["!auctions"] + [part for part in filters if part])
+
+@slash_command("bid", "Bid on an auction")
+@app_commands.describe(auction = "auction to bid on", amount = "your bid")
+@app_commands.autocomplete(auction = auction_autocomplete)
+def slash_bid(interaction, auction: str, amount: app_commands.Range[int, 1]):
+    if not auction.lstrip("#").isdigit():
+        raise SlashArgumentError("Pick an auction from the list or give its number.")
+    return f"!bid {auction.lstrip("#")} {amount}"
+
+@slash_command("inventory", "Show your inventory")
+def slash_inventory(interaction):
+    return "!inventory"
+
+@slash_command("my_bets", "Show your open bets")
+def slash_my_bets(interaction):
+    return "!my_bets"
+
+@slash_command("leaderboard", "Show the server leaderboard")
+@app_commands.describe(board = "what to rank by (default wallet)")
+@app_commands.choices(board = [app_commands.Choice(name = board, value = board) for board in LEADERBOARD_STATS])
+def slash_leaderboard(interaction, board: str = "wallet"):
+    return f"!leaderboard {board}"
+
+@slash_command("stocks", "Show the stock market, or one stock's chart")
+@app_commands.describe(symbol = "stock to chart (default all of them)")
+@app_commands.autocomplete(symbol = stock_autocomplete)
+def slash_stocks(interaction, symbol: str = ""):
+    return f"!stocks {symbol}".strip()
+
+@slash_command("buy_stock", "Buy shares at the current price")
+@app_commands.describe(symbol = "stock to buy", shares = "how many shares")
+@app_commands.autocomplete(symbol = stock_autocomplete)
+def slash_buy_stock(interaction, symbol: str, shares: app_commands.Range[int, 1]):
+    return f"!buy_stock {symbol} {shares}"
+
+@slash_command("sell_stock", "Sell shares at the current price")
+@app_commands.describe(symbol = "stock to sell", shares = "how many shares (default all of them)")
+@app_commands.autocomplete(symbol = stock_autocomplete)
+def slash_sell_stock(interaction, symbol: str, shares: app_commands.Range[int, 1] = None):
+    return f"!sell_stock {symbol} {shares or "all"}"
+
+@slash_command("history", "Show where your money came from and went")
+@app_commands.describe(page = "1 is the newest entries")
+def slash_history(interaction, page: app_commands.Range[int, 1, LEDGER_MAX_PAGE] = 1):
+    return f"!history {page}"
+
+@slash_command("prediction_history", "Look up resolved predictions")
+@app_commands.describe(prediction = "number of a resolved prediction to show in full", page = "1 is the most recently resolved")
+def slash_prediction_history(interaction, prediction: app_commands.Range[int, 1] = None, page: app_commands.Range[int, 1] = 1):
+    return f"!prediction_history {prediction}" if prediction else f"!prediction_history page:{page}"
+
+@slash_command("auction_history", "Look up ended auctions")
+@app_commands.describe(auction = "id of an ended auction to show in full", page = "1 is the most recently ended")
+def slash_auction_history(interaction, auction: app_commands.Range[int, 1] = None, page: app_commands.Range[int, 1] = 1):
+    return f"!auction_history {auction}" if auction else f"!auction_history page:{page}"
+
+@slash_command("reward", "Give money to users, roles or everyone", moderator = True)
+@app_commands.describe(amount = "how much each recipient gets", user = "a user to reward", role = "reward everyone with this role", everyone = "reward every user", others = "more recipients: @mentions, user ids or (display names)")
+def slash_reward(interaction, amount: int, user: discord.Member = None, role: discord.Role = None, everyone: bool = False, others: str = ""):
+    recipients = [user.mention if user else "", role.mention if role else "", "everyone" if everyone else "", others.strip()]
+    if not any(recipients):
+        raise SlashArgumentError("Choose at least one recipient.")
+    return f"!reward {amount} {" ".join(recipient for recipient in recipients if recipient)}"
+
+@slash_command("create_auction", "Auction an item as the server", moderator = True)
+@app_commands.describe(item = "name of the item", quantity = "how many", starting_bid = "lowest bid accepted", minutes = "how long the auction runs")
+def slash_create_auction(interaction, item: str, quantity: app_commands.Range[int, 1], starting_bid: app_commands.Range[int, 0], minutes: app_commands.Range[int, 1]):
+    return f"!create_auction {wrap(item)} {quantity} {starting_bid} {minutes}"
+
+@slash_command("create_prediction", "Open a prediction users can bet on", moderator = True)
+@app_commands.describe(title = "what the prediction is about", option_1 = "first option", option_2 = "second option")
+def slash_create_prediction(interaction, title: str, option_1: str, option_2: str, option_3: str = None, option_4: str = None, option_5: str = None, option_6: str = None, option_7: str = None, option_8: str = None):
+    options = [option for option in (option_1, option_2, option_3, option_4, option_5, option_6, option_7, option_8) if option]
+    return f"!create_prediction {wrap(title)} {len(options)} {" ".join(wrap(option) for option in options)}"
+
+@slash_command("close_prediction", "Stop taking bets on a prediction", moderator = True)
+@app_commands.describe(prediction = "prediction to close")
+@app_commands.autocomplete(prediction = prediction_autocomplete)
+def slash_close_prediction(interaction, prediction: str):
+    return f"!close_prediction {prediction.lstrip("#")}"
+
+@slash_command("resolve_prediction", "Pay out a prediction", moderator = True)
+@app_commands.describe(prediction = "prediction to resolve", option = "the winning option")
+@app_commands.autocomplete(prediction = prediction_autocomplete, option = prediction_option_autocomplete)
+def slash_resolve_prediction(interaction, prediction: str, option: str):
+    return f"!resolve_prediction {prediction if prediction.isdigit() else wrap(prediction)} {option if option.isdigit() else wrap(option)}"
+
+@slash_command("create_shop_item", "Add an item to the shop", moderator = True)
+@app_commands.describe(name = "name of the item", price = "price, 0 for free", quantity = "stock (default unlimited)", refresh_days = "days until the stock refills (needs a quantity)")
+def slash_create_shop_item(interaction, name: str, price: app_commands.Range[int, 0], quantity: app_commands.Range[int, 0] = None, refresh_days: app_commands.Range[int, 1] = None):
+    if refresh_days is not None and quantity is None:
+        raise SlashArgumentError("A refresh time needs a quantity.")
+    return " ".join(str(part) for part in ("!create_shop_item", wrap(name), price, quantity, refresh_days) if part is not None)
+
+@slash_command("delete_shop_item", "Remove an item from the shop", moderator = True)
+@app_commands.describe(item = "item to remove")
+@app_commands.autocomplete(item = item_autocomplete)
+def slash_delete_shop_item(interaction, item: str):
+    return f"!delete_shop_item {wrap(item)}"
+
+@slash_command("edit_shop_item", "Change a shop item", moderator = True)
+@app_commands.describe(item = "item to change", name = "new name", price = "new price", quantity = "new stock", refresh_time = "new refresh time in days")
+@app_commands.autocomplete(item = item_autocomplete)
+def slash_edit_shop_item(interaction, item: str, name: str = None, price: app_commands.Range[int, 0] = None, quantity: app_commands.Range[int, 0] = None, refresh_time: app_commands.Range[int, 1] = None):
+    changes = [(field, value) for field, value in (("name", name), ("price", price), ("quantity", quantity), ("refresh_time", refresh_time)) if value is not None]
+    if not changes:
+        raise SlashArgumentError("Choose at least one thing to change.")
+    return f"!edit_shop_item {wrap(item)} {" ".join(f"({field}) {wrap(str(value))}" for field, value in changes)}"
+
+@slash_command("reset_user_inventory", "Empty a user's inventory", moderator = True)
+@app_commands.describe(user = "user whose inventory is emptied")
+def slash_reset_user_inventory(interaction, user: discord.Member):
+    return f"!reset_user_inventory ({user.id})"
+
+@slash_command("reset_user", "Delete a user's economy data", moderator = True)
+@app_commands.describe(user = "user to reset")
+def slash_reset_user(interaction, user: discord.Member):
+    return f"!reset_user ({user.id})"
+
+@slash_command("purge_deprecated_users", "Remove data of users who left the server", moderator = True)
+@app_commands.describe(cancel = "stop a purge that is running")
+def slash_purge_deprecated_users(interaction, cancel: bool = False):
+    return "!purge_deprecated_users cancel" if cancel else "!purge_deprecated_users"
+
+@slash_command("set_default_channel", "Set the channel the bot posts in", moderator = True)
+@app_commands.describe(channel = "default channel (default: this one)")
+def slash_set_default_channel(interaction, channel: discord.TextChannel = None):
+    return f"!set_default_channel {channel.id}" if channel else "!set_default_channel"
+
+@slash_command("toggle_command", "Turn a command on or off for this server", moderator = True)
+@app_commands.describe(command = "command to toggle", enabled = "on or off")
+@app_commands.choices(command = [app_commands.Choice(name = command, value = command) for command in list(DEFAULT_USER_COMMANDS) + list(DEFAULT_PRIVILEGED_COMMANDS)][:AUTOCOMPLETE_LIMIT])
+def slash_toggle_command(interaction, command: str, enabled: bool):
+    return f"!toggle_command ({command}) ({str(enabled).lower()})"
+
+@slash_command("stats", "Show the bot's performance stats", moderator = True)
+def slash_stats(interaction):
+    return "!stats"
+
+@slash_command("profile", "Profile the next commands", moderator = True)
+@app_commands.describe(commands = "how many commands to profile, 0 turns profiling off")
+def slash_profile(interaction, commands: app_commands.Range[int, 0, 1000]):
+    return f"!profile {commands}" if commands else "!profile off"
+
+@slash_command("economy", "Show the money supply, where money comes from and how evenly it's spread", moderator = True)
+@app_commands.describe(hours = "how many hours of flows to total (default 24)")
+def slash_economy(interaction, hours: app_commands.Range[int, 1, ECONOMY_MAX_HOURS] = 24):
+    return f"!economy {hours}"
+
+@slash_command("export", "Download a table of this server's data as a file", moderator = True)
+@app_commands.describe(table = "what to export", file_format = "file format (default csv)")
+@app_commands.choices(table = [app_commands.Choice(name = table, value = table) for table in EXPORT_TABLES], file_format = [app_commands.Choice(name = file_format, value = file_format) for file_format in EXPORT_FORMATS])
+def slash_export(interaction, table: str, file_format: str = "csv"):
+    return f"!export {table} {file_format}"
+
+@slash_command("import", "Add or update this server's data from a .csv or .jsonl file", moderator = True)
+@app_commands.describe(table = "what the file holds, in the same columns !export writes", file = ".csv, .jsonl or .ndjson file, optionally gzipped")
+@app_commands.choices(table = [app_commands.Choice(name = table, value = table) for table in IMPORT_PARSERS])
+def slash_import(interaction, table: str, file: discord.Attachment):
+    return f"!import {table}"
+
+@slash_command("create_stock", "List a new stock on the market", moderator = True)
+@app_commands.describe(symbol = "ticker symbol, 1 to 6 letters", name = "company name", price = "starting price, also the price it drifts back to", volatility = "percent the price moves in a typical hour (default 5)")
+def slash_create_stock(interaction, symbol: str, name: str, price: app_commands.Range[int, 1], volatility: app_commands.Range[float, 0, 100] = None):
+    return f"!create_stock {symbol} {wrap(name)} {price}{f" {volatility:g}" if volatility is not None else ""}"
+
+@slash_command("delete_stock", "Remove a stock and pay out its holders", moderator = True)
+@app_commands.describe(symbol = "stock to remove")
+@app_commands.autocomplete(symbol = stock_autocomplete)
+def slash_delete_stock(interaction, symbol: str):
+    return f"!delete_stock {symbol}"
+
+async def sync_slash_commands(): #Global syncs are rate limited, so only when the definitions changed since the last sync
+    definitions = json.dumps([command.to_dict(bot.tree) for command in bot.tree.get_commands()], sort_keys = True).encode("utf-8")
+    digest = hashlib.sha256(definitions).hexdigest()
+    if os.path.exists(SLASH_COMMANDS_HASH_FILE):
+        with open(SLASH_COMMANDS_HASH_FILE, encoding = "utf-8") as f:
+            if f.read().strip() == digest:
+                return False
+    await bot.tree.sync()
+    with open(SLASH_COMMANDS_HASH_FILE, "w", encoding = "utf-8") as f:
+        f.write(digest)
+    return True
+
+def main():
+    parser = argparse.ArgumentParser(description = "Commerce Bot")
+    subcommands = parser.add_subparsers(dest = "command")
+    subcommands.add_parser("run", help = "run the bot (default)")
+    convert_parser = subcommands.add_parser("convert", help = "rewrite the data files in another storage format")
+    convert_parser.add_argument("storage_format", choices = STORAGE_FORMATS)
+    subcommands.add_parser("snapshot", help = "write a snapshot of the data files now")
+    subcommands.add_parser("import-files", help = "copy the JSON data files into the SQLite store (STORAGE_BACKEND=sqlite)")
+    migrate_parser = subcommands.add_parser("migrate", help = "stream data files too big to load at once into the SQLite store, checking and normalizing them (STORAGE_BACKEND=sqlite)")
+    migrate_parser.add_argument("--dry-run", action = "store_true", help = "only check the files and report what would change")
+    migrate_parser.add_argument("--restart", action = "store_true", help = "start over instead of resuming an interrupted migration")
+    migrate_parser.add_argument("--chunk-mb", type = float, default = MIGRATE_CHUNK_BYTES / 1024 / 1024, help = "commit to the store after this many MB (default %(default)g)")
+    restore_parser = subcommands.add_parser("restore", help = "replace the data files with a snapshot (stop the bot first)")
+    restore_parser.add_argument("snapshot", nargs = "?", default = "latest", help = "snapshot file name, path or latest (default)")
+    restore_parser.add_argument("--list", action = "store_true", help = "list the snapshots instead of restoring")
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        asyncio.run(convert_storage(args.storage_format))
+        return
+    if args.command == "import-files":
+        asyncio.run(import_files())
+        return
+    if args.command == "migrate":
+        if not migrate_files(args.dry_run, args.restart, int(args.chunk_mb * 1024 * 1024)):
+            raise SystemExit(1)
+        return
+    if args.command == "snapshot":
+        print(f"[green]Snapshot written to {asyncio.run(take_snapshot())}")
+        return
+    if args.command == "restore":
+        if args.list:
+            for name in list_snapshots():
+                print(f"{name}  {os.path.getsize(os.path.join(SNAPSHOT_DIR, name)):,} bytes")
+            return
+        try:
+            asyncio.run(restore_snapshot(args.snapshot))
+        except (OSError, ValueError, RuntimeError) as e:
+            print(f"[red]Restore failed: {e}")
+            raise SystemExit(1)
+        return
+    if SHARD_COUNT and STORAGE_BACKEND != "sqlite" and SHARD_IDS != list(range(SHARD_COUNT)):
+        print("[red]Running a subset of shards needs the shared store, set STORAGE_BACKEND=sqlite.")
+        raise SystemExit(1)
+    try:
+        bot.run(TOKEN)
+    finally:
+        if STORE:
+            STORE.release()
+
 if __name__ == '__main__':
-    asyncio.run(populate_data_folder())
-    bot.run(TOKEN)
+    main()
 
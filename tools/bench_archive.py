@@ -0,0 +1,133 @@
+"""
+Archive benchmark.
+
+Archives synthetic resolved predictions, each with --bets bets and their payouts, into an Archive at each size, and
+recompresses its full segments the way archive_loop does. Reports how many bytes the records would add to
+predictions.json if resolved predictions stayed in it, against the archive's size on disk and its .ids files. Then times
+looking up one prediction by id and listing a page of the newest and of the oldest ones. Both decompress one or two
+segments, so they should stay flat as the archive grows. Opening the archive is timed from its .ids files and from scratch.
+
+    python tools/bench_archive.py --sizes 1000,10000,100000
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+
+import fake_discord
+import bot
+
+DEFAULT_SIZES = "1000,10000,100000"
+
+
+def build_prediction(prediction_id, bets, rng):
+    options = {str(option): f"Option {option}" for option in range(1, rng.randint(2, 4) + 1)}
+    user_bets = {
+        str(100_000_000 + rng.randrange(100_000)): {"name": f"user-{rng.randrange(100_000)}", "option": rng.choice(list(options)), "amount": rng.randint(1, 500)}
+        for _ in range(bets)
+    }
+    winning_option = rng.choice(list(options))
+    return {
+        "title": f"Prediction {prediction_id}",
+        "options": options,
+        "open": False,
+        "user_bets": user_bets,
+        "total_bets": sum(bet["amount"] for bet in user_bets.values()),
+        "payouts": {user_id: bet["amount"] * 2 for user_id, bet in user_bets.items() if bet["option"] == winning_option},
+        "winning_option": winning_option,
+    }
+
+
+def directory_bytes(directory, suffix):
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory) if name.endswith(suffix))
+
+
+async def time_calls(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await function()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return statistics.median(timings) * 1000, timings[min(len(timings) - 1, int(round(0.99 * (len(timings) - 1))))] * 1000
+
+
+async def run(size, args, rng, directory):
+    archive = bot.Archive(directory).open()
+    hot_bytes = 0
+    start = time.perf_counter()
+    for prediction_id in range(1, size + 1):
+        prediction = build_prediction(prediction_id, args.bets, rng)
+        hot_bytes += len(json.dumps({str(prediction_id): prediction}, indent = 4)) #predictions.json is written indented
+        archive.append("prediction", prediction_id, prediction)
+    append_ms = (time.perf_counter() - start) / size * 1000
+    start = time.perf_counter()
+    while archive.full:
+        archive.compact(archive.full.pop(0))
+    compact_seconds = time.perf_counter() - start
+    archive_bytes = directory_bytes(directory, ".bin")
+    index_bytes = directory_bytes(directory, ".ids")
+
+    find = await time_calls(lambda: archive.find("prediction", rng.randint(1, size)), args.repeat)
+    newest = await time_calls(lambda: archive.newest("prediction", bot.ARCHIVE_PAGE_SIZE), args.repeat)
+    oldest = await time_calls(lambda: archive.newest("prediction", bot.ARCHIVE_PAGE_SIZE, size - bot.ARCHIVE_PAGE_SIZE), args.repeat)
+    start = time.perf_counter()
+    bot.Archive(directory).open()
+    open_indexed = time.perf_counter() - start
+    for name in os.listdir(directory):
+        if name.endswith(".ids"):
+            os.remove(os.path.join(directory, name))
+    start = time.perf_counter()
+    bot.Archive(directory).open()
+    open_scanned = time.perf_counter() - start
+
+    row = {
+        "predictions": size,
+        "segments": archive.segment + 1,
+        "hot_mb": hot_bytes / 1e6,
+        "archive_mb": archive_bytes / 1e6,
+        "index_mb": index_bytes / 1e6,
+        "append_ms": append_ms,
+        "compact_seconds": compact_seconds,
+        "find_p50_ms": find[0], "find_p99_ms": find[1],
+        "newest_page_p50_ms": newest[0], "oldest_page_p50_ms": oldest[0],
+        "open_indexed_seconds": open_indexed, "open_scanned_seconds": open_scanned,
+    }
+    print(f"  {size:>9,} predictions  {row['segments']:>5,} segments  predictions.json +{row['hot_mb']:8.1f} MB  archive {row['archive_mb']:7.1f} MB  "
+          f"index {row['index_mb']:5.2f} MB  append {append_ms:6.3f} ms  compact {compact_seconds:5.2f}s")
+    print(f"    lookup p50 {find[0]:6.2f} ms  p99 {find[1]:6.2f} ms  newest page {newest[0]:6.2f} ms  oldest page {oldest[0]:6.2f} ms  "
+          f"open {open_indexed:5.2f}s from the .ids files, {open_scanned:5.2f}s rescanned")
+    return row
+
+
+async def bench(args, directory):
+    rng = random.Random(args.seed)
+    return [await run(int(size), args, rng, os.path.join(directory, size)) for size in args.sizes.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Times bot.py's prediction archive and compares its size to keeping resolved predictions in predictions.json.")
+    parser.add_argument("--sizes", default = DEFAULT_SIZES, help = f"comma separated archived prediction counts (default {DEFAULT_SIZES})")
+    parser.add_argument("--bets", type = int, default = 20, help = "bets on every prediction")
+    parser.add_argument("--repeat", type = int, default = 100, help = "times each lookup is timed")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--output", help = "also write the results as JSON to this file")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix = "commerce-archive-bench-")
+    try:
+        rows = asyncio.run(bench(args, directory))
+    finally:
+        shutil.rmtree(directory, ignore_errors = True)
+    if args.output:
+        with open(args.output, "w", encoding = "utf-8") as f:
+            json.dump(rows, f, indent = 4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Auction house benchmark.
+
+Builds an AuctionIndex over synthetic live auctions at each size and times the first page of every !auctions sort and
+filter against a scan that filters and sorts every auction, which is what listing them costs without the index.
+Bids and auction endings are timed as index updates. The page time should stay flat as the auction count grows.
+
+    python tools/bench_auctions.py --sizes 1000,10000,100000
+"""
+import argparse
+import itertools
+import json
+import random
+import statistics
+import time
+from datetime import datetime, timedelta, timezone
+
+import fake_discord
+import bot
+
+DEFAULT_SIZES = "1000,10000,100000"
+ITEMS = ["Gem", "Golden Gem", "Sword", "Shield", "Potion", "Rock", "Crown", "Ring", "Scroll", "Lantern"]
+QUERIES = [ #(label, sort, filters)
+    ("ending soonest", "ending", {}),
+    ("most bids", "bids", {}),
+    ("lowest price", "price", {}),
+    ("price 100-200", "ending", {"low": 100, "high": 200}),
+    ("price 100-200 by price", "price", {"low": 100, "high": 200}),
+    ("item (gem)", "ending", {"item": "gem"}),
+    ("one seller", "bids", {"seller": "7"}),
+]
+
+
+def build_auctions(count, sellers, rng):
+    now = datetime.now(timezone.utc)
+    return {
+        str(auction_id): {
+            "item": rng.choice(ITEMS),
+            "quantity": 1,
+            "current_bid": rng.randint(1, 10_000),
+            "auction_end": (now + timedelta(minutes = rng.randint(1, 100_000))).isoformat(),
+            "user_id": str(rng.randrange(sellers)) if rng.random() < 0.9 else None,
+            "number_of_bids": rng.randint(0, 50),
+        }
+        for auction_id in range(1, count + 1)
+    }
+
+
+def scan(auctions, sort, item = None, seller = None, low = None, high = None): #Filter and sort every auction
+    keys = []
+    for auction_id, auction in auctions.items():
+        price = auction["current_bid"]
+        if (item is not None and item not in auction["item"].lower()) or (seller is not None and (auction["user_id"] or "") != seller):
+            continue
+        if (low is not None and price < low) or (high is not None and price > high):
+            continue
+        keys.append(bot.AuctionIndex.keys(auction_id, bot.AuctionIndex.entry(auction))[sort])
+    keys.sort()
+    return [key[-1] for key in keys[:bot.AUCTION_PAGE_SIZE]]
+
+
+def time_calls(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000, result
+
+
+def run(size, args, rng):
+    auctions = build_auctions(size, args.sellers, rng)
+    start = time.perf_counter()
+    index = bot.AuctionIndex(auctions)
+    build_seconds = time.perf_counter() - start
+    row = {"auctions": size, "build_seconds": build_seconds, "queries": {}}
+    for label, sort, filters in QUERIES:
+        page_ms, page = time_calls(lambda: list(itertools.islice(index.query(sort, **filters), bot.AUCTION_PAGE_SIZE)), args.repeat)
+        scan_ms, expected = time_calls(lambda: scan(auctions, sort, **filters), max(1, args.repeat // 10))
+        if page != expected:
+            raise SystemExit(f"{label}: index returned {page}, a scan returned {expected}")
+        row["queries"][label] = {"index_ms": page_ms, "scan_ms": scan_ms}
+    auction_ids = list(auctions)
+    updates = []
+    for _ in range(args.repeat):
+        auction_id = rng.choice(auction_ids)
+        auction = auctions[auction_id]
+        auction["current_bid"] += rng.randint(1, 100)
+        auction["number_of_bids"] += 1
+        start = time.perf_counter()
+        index.update(auction_id, bot.AuctionIndex.entry(auction))
+        updates.append(time.perf_counter() - start)
+    row["bid_update_ms"] = statistics.median(updates) * 1000
+    start = time.perf_counter()
+    for auction_id in auction_ids[:args.repeat]:
+        index.remove(auction_id)
+    row["end_remove_ms"] = (time.perf_counter() - start) / min(args.repeat, len(auction_ids)) * 1000
+    print(f"  {size:>9,} auctions  index built in {build_seconds:6.2f}s  bid update {row['bid_update_ms']:7.4f} ms  auction end {row['end_remove_ms']:7.4f} ms")
+    for label, timings in row["queries"].items():
+        print(f"    {label:<24} page {timings['index_ms']:8.4f} ms  scan {timings['scan_ms']:9.3f} ms")
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Times bot.py's auction index queries against scanning every auction.")
+    parser.add_argument("--sizes", default = DEFAULT_SIZES, help = f"comma separated live auction counts (default {DEFAULT_SIZES})")
+    parser.add_argument("--sellers", type = int, default = 1000, help = "users the auctions are spread across")
+    parser.add_argument("--repeat", type = int, default = 200, help = "times each index query and update is timed, scans run a tenth as often")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--output", help = "also write the results as JSON to this file")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    rows = [run(int(size), args, rng) for size in args.sizes.split(",")]
+    if args.output:
+        with open(args.output, "w", encoding = "utf-8") as f:
+            json.dump(rows, f, indent = 4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+Contention benchmark.
+
+Runs the same mix of !buy and !bet commands on one guild through bot.py's command queue with 1, 8 and 64 command
+workers. Every command waits on simulated Discord round trips (--discord-ms), which is what concurrent workers
+overlap. The commands share a handful of limited stock items and open predictions, so concurrent commits keep
+changing the same records and have to be retried.
+After each run the data is checked for lost updates: every item's stock left plus what's in inventories adds up to
+what was stocked, every prediction's total matches its bets, and the wallets plus everything spent add up to what was
+handed out.
+
+    python tools/bench_contention.py --workers 1,8,64 --users 200 --commands 2000
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import fake_discord
+import bot
+
+PRICE = 10
+STOCK = 1_000_000
+REWARD = 1_000_000
+
+
+def conflicts():
+    return sum(value for key, value in bot.METRICS.counters.items() if key[0] == "commerce_transaction_conflicts_total")
+
+
+async def worker(): #Like bot.command_worker, but stops once the queue is empty
+    while bot.COMMAND_QUEUE:
+        bot.COMMAND_WAKEUP.clear()
+        try:
+            if await bot.process_next_command():
+                continue
+        except Exception as e:
+            print(f"  command failed: {e!r}")
+            continue
+        await bot.COMMAND_WAKEUP.wait()
+
+
+async def send(guild, author, content):
+    await bot.handle_message(fake_discord.FakeMessage(guild, author, guild.channel, content))
+    await worker()
+
+
+async def check(server_id, args, spent):
+    """Returns the lost updates found, as a list of descriptions"""
+    shop, users, predictions = [await bot.read_json_file(path) for path in (bot.SHOP_FILE, bot.USERS_FILE, bot.PREDICTIONS_FILE)]
+    users = users[server_id]
+    problems = []
+    for item_id, item in shop[server_id]["Items"].items():
+        owned = sum(user["inventory"].get(item_id, {}).get("quantity", 0) for user in users.values())
+        if item["quantity"] + owned != STOCK:
+            problems.append(f"{item['name']}: {item['quantity']:,} left + {owned:,} owned != {STOCK:,}")
+    bets = 0
+    for prediction_id, prediction in predictions[server_id]["Predictions"].items():
+        placed = sum(bet["amount"] for bet in prediction["user_bets"].values())
+        bets += placed
+        if prediction["total_bets"] != placed:
+            problems.append(f"prediction {prediction_id}: total {prediction['total_bets']:,} != {placed:,} bet")
+    bought = sum(entry["quantity"] for user in users.values() for entry in user["inventory"].values()) * PRICE
+    wallets = sum(user["wallet"] for user in users.values())
+    if wallets + bought + bets != spent:
+        problems.append(f"wallets {wallets:,} + bought {bought:,} + bets {bets:,} != {spent:,} handed out")
+    return problems
+
+
+async def run(args, workers, directory, guild_id):
+    fake_discord.use_data_dir(bot, directory)
+    fake_discord.LATENCY = 0
+    client = fake_discord.build_world(bot, 1, args.users, first_guild_id = guild_id)
+    guild = client.guilds[0]
+    server_id = str(guild.id)
+    await bot.populate_data_folder()
+    for member in guild.members:
+        await send(guild, member, "!wallet")
+    for index in range(args.items):
+        await send(guild, guild.moderator, f"!create_shop_item (Item {index}) {PRICE} {STOCK}")
+    for index in range(args.predictions):
+        await send(guild, guild.moderator, f"!create_prediction (Prediction {index}) 2 (A) (B)")
+    await send(guild, guild.moderator, f"!reward {REWARD} everyone")
+    users = await bot.read_json_file(bot.USERS_FILE)
+    spent = sum(user["wallet"] for user in users[server_id].values())
+
+    rng = random.Random(args.seed)
+    for _ in range(args.commands):
+        member = rng.choice(guild.members[1:])
+        if rng.random() < 0.5:
+            content = f"!buy (Item {rng.randrange(args.items)}) 1"
+        else:
+            content = f"!bet {rng.randrange(args.predictions) + 1} 1 {rng.randint(1, 2)}"
+        await bot.handle_message(fake_discord.FakeMessage(guild, member, guild.channel, content))
+    fake_discord.LATENCY = args.discord_ms / 1000
+    bot.COMMAND_WORKERS = workers
+    conflicts_before = conflicts()
+    errors_before = sum(value for key, value in bot.METRICS.counters.items() if key[0] == "commerce_command_errors_total")
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(workers)))
+    seconds = time.perf_counter() - start
+    fake_discord.LATENCY = 0
+    failed = sum(value for key, value in bot.METRICS.counters.items() if key[0] == "commerce_command_errors_total") - errors_before
+    problems = await check(server_id, args, spent)
+    bot.get_ledger().file.close()
+    bot.LEDGER = None #The next run opens its own data folder's
+    row = {
+        "workers": workers,
+        "commands": args.commands,
+        "seconds": seconds,
+        "commands_per_second": args.commands / seconds,
+        "conflicts": conflicts() - conflicts_before,
+        "failed": failed,
+        "lost_updates": problems,
+    }
+    print(f"  {workers:>3} workers  {row['commands_per_second']:>8,.0f} cmds/s  {row['conflicts']:>7,} conflicts retried  "
+          f"{failed:>5,} failed  {'no lost updates' if not problems else f'{len(problems)} LOST UPDATES'}")
+    for problem in problems:
+        print(f"    {problem}")
+    return row
+
+
+async def bench(args, directory):
+    rows = []
+    for index, workers in enumerate(int(workers) for workers in args.workers.split(",")):
+        rows.append(await run(args, workers, os.path.join(directory, str(workers)), 1_000_000 + index)) #A fresh guild and data folder every run
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Times bot.py's command queue with several workers on conflicting commands, and checks no update is lost.")
+    parser.add_argument("--workers", default = "1,8,64", help = "comma separated worker counts to run")
+    parser.add_argument("--users", type = int, default = 200)
+    parser.add_argument("--commands", type = int, default = 2000, help = "!buy and !bet commands per run")
+    parser.add_argument("--items", type = int, default = 16, help = "shop items the !buy commands share")
+    parser.add_argument("--predictions", type = int, default = 4, help = "open predictions the !bet commands share")
+    parser.add_argument("--discord-ms", type = float, default = 20, help = "milliseconds every Discord call takes")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--output", help = "also write the results as JSON to this file")
+    args = parser.parse_args()
+    fake_discord.disable_rate_limits(bot)
+
+    directory = tempfile.mkdtemp(prefix = "commerce-contention-")
+    try:
+        rows = asyncio.run(bench(args, directory))
+    finally:
+        shutil.rmtree(directory, ignore_errors = True)
+    if args.output:
+        with open(args.output, "w", encoding = "utf-8") as f:
+            json.dump(rows, f, indent = 4)
+    if any(row["lost_updates"] for row in rows):
+        raise SystemExit("lost updates found")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+Export/import benchmark.
+
+Fills one guild with synthetic users, then times !export users (CSV and JSONL) and an !import users of every row
+with a changed wallet, going through bot.handle_message and the command queue like real commands. The import file is
+served from a local web server so the download is streamed the same way a Discord attachment is.
+Memory is the peak traced by tracemalloc during each command. It's compared to loading users.json on its own, which
+every command reading users pays, to show whether export and import hold whole files in memory or work a row at a time.
+Tracing slows Python down several times over, --no-memory gives the real speeds.
+
+    python tools/bench_export.py --users 1000000
+"""
+import argparse
+import asyncio
+import csv
+import json
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from aiohttp import web
+
+import fake_discord
+import bot
+
+IMPORT_PORT = 18_044
+
+
+class BenchAttachment:
+    def __init__(self, path):
+        self.filename = os.path.basename(path)
+        self.size = os.path.getsize(path)
+        self.url = f"http://127.0.0.1:{IMPORT_PORT}/{self.filename}"
+
+
+async def run_command(guild, content, attachments = ()):
+    """Returns the seconds the command took, its peak extra memory in MB and what it sent"""
+    sent_before = len(bot.bot.sent)
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    await bot.handle_message(fake_discord.FakeMessage(guild, guild.moderator, guild.channel, content, attachments = attachments))
+    while bot.COMMAND_QUEUE:
+        await bot.process_next_command()
+    seconds = time.perf_counter() - start
+    return seconds, (tracemalloc.get_traced_memory()[1] - baseline) / 1e6, bot.bot.sent[sent_before:]
+
+
+def keep_export(sent, directory):
+    """Copies the exported file out of the message, send_file removes the original once it's sent"""
+    attachment = sent[-1].file
+    if attachment is None:
+        raise SystemExit(f"export failed: {sent[-1].content}")
+    path = os.path.join(directory, attachment.filename)
+    with open(path, "wb") as f:
+        shutil.copyfileobj(attachment.fp, f)
+    attachment.close()
+    return path
+
+
+def write_import_file(export_path, import_path):
+    """The exported users with every wallet raised by one, so the import has a change to apply on every row"""
+    with open(export_path, encoding = "utf-8", newline = "") as source, open(import_path, "w", encoding = "utf-8", newline = "") as target:
+        reader = csv.DictReader(source)
+        writer = csv.DictWriter(target, reader.fieldnames)
+        writer.writeheader()
+        for row in reader:
+            row["wallet"] = int(row["wallet"]) + 1
+            writer.writerow(row)
+
+
+async def bench(args, directory):
+    fake_discord.use_data_dir(bot, os.path.join(directory, "data"))
+    bot.EXPORT_ATTACHMENT_BYTES = 1 << 40 #Timed uncompressed, the real limit gzips or refuses exports this big
+    bot.IMPORT_MAX_BYTES = 1 << 40
+    client = fake_discord.build_world(bot, 1, 0)
+    guild = client.guilds[0]
+    server_id = str(guild.id)
+    await bot.populate_data_folder()
+    await bot.add_server_to_jsons(server_id)
+    users = await bot.async_load_json(bot.USERS_FILE)
+    for index in range(args.users):
+        user = bot.new_user_record(f"user-{index}", f"user{index}")
+        user["wallet"] = 500 + index % 10_000
+        users[server_id][str(100_000_000 + index)] = user
+    await bot.async_save_json(bot.USERS_FILE, users)
+    bot.build_server_leaderboards(server_id, users[server_id])
+    del users
+    print(f"  {args.users:,} users, users.json is {os.path.getsize(bot.USERS_FILE) / 1e6:.1f} MB")
+
+    if args.memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    await bot.async_load_json(bot.USERS_FILE)
+    seconds = time.perf_counter() - start
+    rows = [{"command": "load users.json", "rows": args.users, "seconds": seconds, "rows_per_second": args.users / seconds,
+             "peak_extra_mb": tracemalloc.get_traced_memory()[1] / 1e6, "file_mb": os.path.getsize(bot.USERS_FILE) / 1e6}] #What every command that reads users pays
+    exports = {}
+    for file_format in bot.EXPORT_FORMATS:
+        seconds, memory, sent = await run_command(guild, f"!export users {file_format}")
+        exports[file_format] = keep_export(sent, directory)
+        rows.append({"command": f"!export users {file_format}", "rows": args.users, "seconds": seconds, "rows_per_second": args.users / seconds,
+                     "peak_extra_mb": memory, "file_mb": os.path.getsize(exports[file_format]) / 1e6})
+
+    import_path = os.path.join(directory, "import-users.csv")
+    write_import_file(exports["csv"], import_path)
+    app = web.Application()
+    app.router.add_get("/{name}", lambda request: web.FileResponse(os.path.join(directory, request.match_info["name"])))
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", IMPORT_PORT).start()
+    try:
+        seconds, memory, sent = await run_command(guild, "!import users", [BenchAttachment(import_path)])
+    finally:
+        await runner.cleanup()
+    if args.memory:
+        tracemalloc.stop()
+    print(f"  {sent[-1].content}")
+    rows.append({"command": "!import users", "rows": args.users, "seconds": seconds, "rows_per_second": args.users / seconds,
+                 "peak_extra_mb": memory, "file_mb": os.path.getsize(import_path) / 1e6})
+    bot.get_ledger().file.close()
+
+    users = await bot.async_load_json(bot.USERS_FILE)
+    changed = sum(1 for user_id, user in users[server_id].items() if int(user_id) >= 100_000_000 and user["wallet"] == 501 + (int(user_id) - 100_000_000) % 10_000)
+    if changed != args.users:
+        raise SystemExit(f"import applied {changed:,} of {args.users:,} wallet changes")
+    for row in rows:
+        print(f"  {row['command']:<20} {row['seconds']:8.2f}s  {row['rows_per_second']:>10,.0f} rows/s  peak +{row['peak_extra_mb']:8.1f} MB  file {row['file_mb']:8.1f} MB")
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Times bot.py's !export and !import on one large guild.")
+    parser.add_argument("--users", type = int, default = 1_000_000)
+    parser.add_argument("--no-memory", dest = "memory", action = "store_false", help = "don't trace memory, for undistorted timings")
+    parser.add_argument("--output", help = "also write the results as JSON to this file")
+    args = parser.parse_args()
+    fake_discord.disable_rate_limits(bot)
+
+    directory = tempfile.mkdtemp(prefix = "commerce-export-bench-")
+    try:
+        rows = asyncio.run(bench(args, directory))
+    finally:
+        shutil.rmtree(directory, ignore_errors = True)
+    if args.output:
+        with open(args.output, "w", encoding = "utf-8") as f:
+            json.dump(rows, f, indent = 4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Wallet ledger benchmark.
+
+Appends synthetic wallet changes for many users to a temporary ledger, stopping at each requested size to time
+!history lookups (first and a deep page) for random users, and how long reopening the ledger takes from its index.
+History lookups follow each user's own chain of entries, so their time should stay flat as the ledger grows.
+
+    python tools/bench_ledger.py --sizes 100000,1000000,10000000,30000000 --users 100000
+"""
+import argparse
+import json
+import random
+import shutil
+import statistics
+import tempfile
+import time
+
+import fake_discord
+import bot
+
+DEFAULT_SIZES = "100000,1000000,10000000"
+FIRST_GUILD = 1_000_000
+FIRST_USER = 200_000_000_000_000_000
+
+
+def time_lookups(ledger, args, rng, page):
+    timings = []
+    for _ in range(args.lookups):
+        user = rng.randrange(args.users)
+        start = time.perf_counter()
+        ledger.history(FIRST_GUILD + user % args.guilds, FIRST_USER + user, bot.LEDGER_PAGE_SIZE, (page - 1) * bot.LEDGER_PAGE_SIZE)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return statistics.median(timings) * 1000, timings[int(len(timings) * 0.99)] * 1000
+
+
+def run(args, directory):
+    rng = random.Random(args.seed)
+    ledger = bot.Ledger(directory).open()
+    kinds = list(bot.LEDGER_KINDS)
+    rows = []
+    written = previous = 0
+    for size in [int(size) for size in args.sizes.split(",")]:
+        start = time.perf_counter()
+        while written < size:
+            user = rng.randrange(args.users)
+            ledger.append(FIRST_GUILD + user % args.guilds, FIRST_USER + user, rng.randint(-500, 500), rng.randint(0, 100_000), rng.choice(kinds), rng.randint(0, 50))
+            written += 1
+        append_seconds = time.perf_counter() - start
+        ledger.write_index(ledger.checkpoint())
+        first_p50, first_p99 = time_lookups(ledger, args, rng, 1)
+        deep_p50, deep_p99 = time_lookups(ledger, args, rng, args.deep_page)
+        start = time.perf_counter()
+        bot.Ledger(directory).open().file.close()
+        reopen_seconds = time.perf_counter() - start
+        row = {
+            "entries": size,
+            "segments": ledger.segment + 1,
+            "appends_per_second": (size - previous) / append_seconds if append_seconds else 0.0,
+            "page_1_p50_ms": first_p50,
+            "page_1_p99_ms": first_p99,
+            f"page_{args.deep_page}_p50_ms": deep_p50,
+            f"page_{args.deep_page}_p99_ms": deep_p99,
+            "reopen_seconds": reopen_seconds,
+        }
+        rows.append(row)
+        previous = size
+        print(f"  {size:>12,} entries in {row['segments']:>3} segments  {row['appends_per_second']:>10,.0f} appends/s  "
+              f"page 1 p50 {first_p50:6.3f} ms p99 {first_p99:6.3f} ms  page {args.deep_page} p50 {deep_p50:6.3f} ms p99 {deep_p99:6.3f} ms  reopen {reopen_seconds:5.2f}s")
+    ledger.file.close()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Times bot.py's wallet ledger history lookups as the ledger grows.")
+    parser.add_argument("--sizes", default = DEFAULT_SIZES, help = f"comma separated entry counts, in increasing order (default {DEFAULT_SIZES})")
+    parser.add_argument("--users", type = int, default = 100_000, help = "users the entries are spread across")
+    parser.add_argument("--guilds", type = int, default = 4)
+    parser.add_argument("--lookups", type = int, default = 2000, help = "history lookups timed per size and page")
+    parser.add_argument("--deep-page", type = int, default = 10, help = "second page number to time")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--output", help = "also write the results as JSON to this file")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix = "commerce-ledger-")
+    try:
+        rows = run(args, directory)
+    finally:
+        shutil.rmtree(directory, ignore_errors = True)
+    if args.output:
+        with open(args.output, "w", encoding = "utf-8") as f:
+            json.dump(rows, f, indent = 4)
+
+
+if __name__ == "__main__":
+    main()
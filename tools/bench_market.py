@@ -0,0 +1,82 @@
+"""
+Stock market engine benchmark.
+
+Creates a StockMarket with thousands of tickers spread across guilds and times tick() and record_history() with the
+numpy engine (when numpy is installed) and the array.array fallback. The tick interval a size can sustain without
+holding up the command queue is the tick time, which runs on the event loop, compared to STOCK_TICK_SECONDS.
+
+    python tools/bench_market.py --tickers 100,1000,10000,50000 --ticks 200
+"""
+import argparse
+import json
+import statistics
+import time
+
+import fake_discord
+import bot
+
+DEFAULT_TICKERS = "100,1000,10000,50000"
+
+
+def build_market(ticker_count, guild_count, seed):
+    market = bot.StockMarket(seed = seed)
+    for index in range(ticker_count):
+        market.add(1_000_000 + index % guild_count, f"T{index}", 10 + index % 990, volatility = 1 + index % 40)
+    return market
+
+
+def time_calls(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def bench(ticker_count, engine, args):
+    market = build_market(ticker_count, args.guilds, args.seed)
+    ticks = time_calls(lambda: market.tick(bot.STOCK_TICK_SECONDS), args.ticks)
+    history = time_calls(market.record_history, max(1, args.ticks // 10))
+    return {
+        "tickers": ticker_count,
+        "engine": engine,
+        "tick_ms_median": statistics.median(ticks) * 1000,
+        "tick_ms_max": max(ticks) * 1000,
+        "history_ms_median": statistics.median(history) * 1000,
+        "tick_budget_used": statistics.median(ticks) / bot.STOCK_TICK_SECONDS,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Times bot.py's stock market tick engine.")
+    parser.add_argument("--tickers", default = DEFAULT_TICKERS, help = f"comma separated ticker counts (default {DEFAULT_TICKERS})")
+    parser.add_argument("--guilds", type = int, default = 100, help = "guilds the tickers are spread across")
+    parser.add_argument("--ticks", type = int, default = 200, help = "ticks timed per size")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--output", help = "also write the results as JSON to this file")
+    args = parser.parse_args()
+
+    engines = [("array", None)]
+    if bot.numpy is not None:
+        engines.insert(0, ("numpy", bot.numpy))
+    else:
+        print("numpy is not installed, only the array.array fallback is timed (pip install numpy)")
+    numpy_module = bot.numpy
+    rows = []
+    try:
+        for engine, module in engines:
+            bot.numpy = module
+            for ticker_count in [int(count) for count in args.tickers.split(",")]:
+                row = bench(ticker_count, engine, args)
+                rows.append(row)
+                print(f"  {engine:<6} {ticker_count:>8,} tickers  tick {row['tick_ms_median']:9.3f} ms (max {row['tick_ms_max']:8.3f})  chart point {row['history_ms_median']:9.3f} ms  {row['tick_budget_used'] * 100:6.2f}% of a {bot.STOCK_TICK_SECONDS:g}s tick")
+    finally:
+        bot.numpy = numpy_module
+    if args.output:
+        with open(args.output, "w", encoding = "utf-8") as f:
+            json.dump(rows, f, indent = 4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+"""
+Persistence micro-benchmarks for bot.py.
+
+Generates synthetic users.json, shop.json and predictions.json files at several user counts, then times
+async_load_json, async_save_json, ensure_file_exists and full command round trips through the real pipeline.
+Results are written as JSON so two runs can be compared:
+
+    python tools/bench_persistence.py --sizes 1000,10000,100000 --output before.json
+    python tools/bench_persistence.py --sizes 1000,10000,100000 --output after.json --compare before.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+import fake_discord
+import bot
+
+DEFAULT_SIZES = "1000,10000,100000,1000000"
+FIRST_USER_ID = 200_000_000_000_000_000
+ITEMS_PER_GUILD = 50
+AUCTIONS_PER_GUILD = 20
+PREDICTIONS_PER_GUILD = 10
+ROUND_TRIP_COMMANDS = ["!wallet", "!inventory", "!buy (Item 1) 1", "!bet 1 10 1", "!predictions", "!bid 1 {bid}"]
+
+
+def generate_data(user_count, guild_count, rng):
+    """Builds the three data files in memory the way the bot would have written them."""
+    settings, users, shop, predictions = {}, {}, {}, {}
+    now = datetime.now(timezone.utc)
+    for guild_index in range(guild_count):
+        server_id = str(fake_discord.FakeGuild(1_000_000 + guild_index).id)
+        settings[server_id] = {
+            "Default Commerce Channel ID": None,
+            "User Commands": dict(bot.DEFAULT_USER_COMMANDS),
+            "Privileged Commands": dict(bot.DEFAULT_PRIVILEGED_COMMANDS),
+        }
+        items = {
+            str(item_id): {
+                "name": f"Item {item_id}",
+                "price": rng.randint(10, 5000),
+                "quantity": rng.choice(["Unlimited", rng.randint(0, 100)]),
+                "refresh_time": rng.choice(["Never", rng.randint(1, 7)]),
+                "active": True,
+            }
+            for item_id in range(1, ITEMS_PER_GUILD + 1)
+        }
+        items["1"]["quantity"] = "Unlimited"
+        server_users = {}
+        guild_user_ids = [str(FIRST_USER_ID + guild_index * user_count + index) for index in range(user_count // guild_count)]
+        for user_id in guild_user_ids:
+            inventory = {}
+            for item_id in rng.sample(range(1, ITEMS_PER_GUILD + 1), rng.randint(0, 5)):
+                inventory[str(item_id)] = {"name": f"Item {item_id}", "quantity": rng.randint(1, 10), "value": rng.randint(1, 1250)}
+            bet = rng.randint(0, 50_000)
+            won = rng.randint(0, 60_000)
+            lost = rng.randint(0, 40_000)
+            server_users[user_id] = {
+                "display_name": f"User {user_id[-6:]}",
+                "user_name": f"user{user_id[-6:]}",
+                "inventory": inventory,
+                "total_currency_bet": bet,
+                "total_currency_won": won,
+                "total_currency_lost": lost,
+                "profit": won - lost,
+                "bets_won": rng.randint(0, 100),
+                "bets_lost": rng.randint(0, 100),
+                "wallet": rng.randint(0, 1_000_000),
+            }
+        users[server_id] = server_users
+        auctions = {}
+        for auction_id in range(1, AUCTIONS_PER_GUILD + 1):
+            bids = {}
+            for bid_number in range(1, rng.randint(0, 15) + 1):
+                bidder = rng.choice(guild_user_ids)
+                bids[str(bid_number)] = {"user_id": bidder, "user_name": server_users[bidder]["display_name"], "amount": 100 + bid_number * 10, "date/time": now.isoformat()}
+            auctions[str(auction_id)] = {
+                "item": f"Item {auction_id}",
+                "item_id": str(auction_id),
+                "quantity": rng.randint(1, 5),
+                "current_bid": 100 + len(bids) * 10,
+                "value": 25,
+                "bids": bids,
+                "auction_end": (now + timedelta(days = 30)).isoformat(),
+                "user_id": rng.choice(guild_user_ids),
+                "current_highest_bidder_id": bids[str(len(bids))]["user_id"] if bids else None,
+                "number_of_bids": len(bids),
+            }
+        shop[server_id] = {"Next Shop ID": ITEMS_PER_GUILD + 1, "Next Auction ID": AUCTIONS_PER_GUILD + 1, "Items": items, "Auctions": auctions}
+        server_predictions = {}
+        for prediction_id in range(1, PREDICTIONS_PER_GUILD + 1):
+            user_bets = {}
+            for user_id in rng.sample(guild_user_ids, max(1, len(guild_user_ids) // 10)):
+                user_bets[user_id] = {"name": server_users[user_id]["display_name"], "option": str(rng.randint(1, 3)), "amount": rng.randint(1, 500)}
+            server_predictions[str(prediction_id)] = {
+                "title": f"Prediction {prediction_id}",
+                "options": {"1": "Yes", "2": "No", "3": "Maybe"},
+                "open": True,
+                "user_bets": user_bets,
+                "total_bets": sum(bet["amount"] for bet in user_bets.values()),
+            }
+        predictions[server_id] = {"Predictions": server_predictions, "Data": {"next_bet_number": PREDICTIONS_PER_GUILD + 1}}
+    return {bot.SETTINGS_FILE: settings, bot.USERS_FILE: users, bot.SHOP_FILE: shop, bot.PREDICTIONS_FILE: predictions}
+
+
+async def time_async(coroutine_function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await coroutine_function()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def result_row(size, target, operation, timings, file_bytes = None):
+    return {
+        "size": size,
+        "target": target,
+        "operation": operation,
+        "runs": len(timings),
+        "seconds_min": min(timings),
+        "seconds_median": statistics.median(timings),
+        "bytes": file_bytes,
+    }
+
+
+async def bench_size(size, args, rng):
+    rows = []
+    guild_count = max(1, min(args.guilds, size))
+    data = generate_data(size, guild_count, rng)
+    for path, content in data.items(): #Written once with the bot's own writer so the files look like real ones
+        await bot.async_save_json(path, content)
+
+    for path in (bot.USERS_FILE, bot.SHOP_FILE, bot.PREDICTIONS_FILE):
+        name = os.path.basename(path)
+        file_bytes = os.path.getsize(path)
+        rows.append(result_row(size, name, "async_load_json", await time_async(lambda: bot.async_load_json(path), args.repeat), file_bytes))
+        rows.append(result_row(size, name, "async_save_json", await time_async(lambda: bot.async_save_json(path, data[path]), args.repeat), os.path.getsize(path)))
+        print(f"  {size:>9,} users  {name:<17} {file_bytes / 1e6:9.2f} MB  load {rows[-2]['seconds_median'] * 1000:10.2f} ms  save {rows[-1]['seconds_median'] * 1000:10.2f} ms")
+
+    calls = 1000
+    timings = await time_async(lambda: asyncio.gather(*(bot.ensure_file_exists(bot.USERS_FILE) for _ in range(calls))), args.repeat)
+    rows.append(result_row(size, "users.json", f"ensure_file_exists x{calls}", timings))
+
+    client = fake_discord.FakeBot() #Round trips use real users from the generated data so no one gets created
+    bot.bot = client
+    server_id = next(iter(data[bot.USERS_FILE]))
+    guild = client.add_guild(fake_discord.FakeGuild(int(server_id)))
+    guild.channel = client.add_channel(int(server_id) * 10, guild)
+    user_ids = list(data[bot.USERS_FILE][server_id])[:args.repeat]
+    authors = [guild.add_member(fake_discord.FakeMember(int(user_id), data[bot.USERS_FILE][server_id][user_id]["user_name"])) for user_id in user_ids]
+    for author in authors:
+        author.display_name = data[bot.USERS_FILE][server_id][str(author.id)]["display_name"]
+    next_bid = 1_000_000
+    for command in ROUND_TRIP_COMMANDS:
+        timings = []
+        for author in authors:
+            next_bid += 1
+            message = fake_discord.FakeMessage(guild, author, guild.channel, command.format(bid = next_bid))
+            start = time.perf_counter()
+            await bot.handle_message(message)
+            while bot.COMMAND_QUEUE:
+                await bot.process_next_command()
+            timings.append(time.perf_counter() - start)
+        rows.append(result_row(size, "round_trip", command.split()[0], timings))
+        print(f"  {size:>9,} users  round trip {command.split()[0]:<14} {rows[-1]['seconds_median'] * 1000:10.2f} ms")
+
+    for task in asyncio.all_tasks():
+        if task is not asyncio.current_task():
+            task.cancel()
+    return rows
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd = fake_discord.BASE_DIR, capture_output = True, text = True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(current, baseline_path, threshold):
+    with open(baseline_path, encoding = "utf-8") as f:
+        baseline = json.load(f)
+    previous = {(row["size"], row["target"], row["operation"]): row for row in baseline["results"]}
+    regressions = 0
+    print(f"\nCompared with {baseline_path} ({baseline['meta'].get('revision')}):")
+    for row in current["results"]:
+        old = previous.get((row["size"], row["target"], row["operation"]))
+        if not old:
+            continue
+        ratio = row["seconds_median"] / old["seconds_median"] if old["seconds_median"] else float("inf")
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  << REGRESSION"
+            regressions += 1
+        print(f"  {row['size']:>9,} {row['target']:<17} {row['operation']:<26} {old['seconds_median'] * 1000:10.2f} -> {row['seconds_median'] * 1000:10.2f} ms  x{ratio:5.2f}{flag}")
+    return regressions
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    await bot.populate_data_folder()
+    rows = []
+    for size in [int(size) for size in args.sizes.split(",")]:
+        rows.extend(await bench_size(size, args, rng))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Times bot.py's JSON persistence at several data sizes.")
+    parser.add_argument("--sizes", default = DEFAULT_SIZES, help = f"comma separated user counts (default {DEFAULT_SIZES})")
+    parser.add_argument("--guilds", type = int, default = 4, help = "guilds the users are spread across")
+    parser.add_argument("--repeat", type = int, default = 5, help = "runs per measurement")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--output", default = "bench_persistence.json", help = "where to write the results")
+    parser.add_argument("--compare", help = "results file from an earlier run to compare against")
+    parser.add_argument("--threshold", type = float, default = 0.10, help = "slowdown ratio reported as a regression (default 0.10)")
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp(prefix = "commerce-bench-")
+    fake_discord.use_data_dir(bot, data_dir)
+    fake_discord.disable_rate_limits(bot)
+    try:
+        rows = asyncio.run(run(args))
+    finally:
+        shutil.rmtree(data_dir, ignore_errors = True)
+
+    result = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": args.repeat,
+            "guilds": args.guilds,
+        },
+        "results": rows,
+    }
+    with open(args.output, "w", encoding = "utf-8") as f:
+        json.dump(result, f, indent = 4)
+    print(f"\nResults written to {args.output}")
+    if args.compare and compare(result, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
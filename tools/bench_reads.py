@@ -0,0 +1,200 @@
+"""
+Fast read benchmark.
+
+Runs one guild under mixed load: a writer keeps creating predictions, having every bettor bet on them and resolving
+them through the command queue, while reader tasks send !wallet as fast as their replies come back. Reader latency
+is timed with FAST_READS off (every !wallet waits in the queue behind the writes) and on.
+A checker reads the data the whole time and tests that no money is missing or counted twice: the wallets plus the
+bets held by open predictions, less the bonus pool every resolved prediction paid out, never changes. It checks
+fast read views, which should never break it, and the files read straight off disk one after another, which catch
+payouts halfway through (wallets paid but the prediction not yet removed).
+
+    python tools/bench_reads.py --bettors 40 --readers 16 --read-interval 20 --seconds 10
+"""
+import argparse
+import asyncio
+import json
+import shutil
+import tempfile
+import time
+
+import fake_discord
+import bot
+
+BET = 10
+
+
+class ReplyChannel(fake_discord.FakeChannel):
+    """One per reader, so the reader knows when the bot has answered it."""
+    def __init__(self, client, channel_id, guild):
+        super().__init__(client, channel_id, guild)
+        self.reply = None
+
+    async def send(self, content = None, embed = None, embeds = None, file = None):
+        sent = await super().send(content, embed, embeds, file)
+        if self.reply and not self.reply.done():
+            self.reply.set_result(sent)
+        return sent
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))]
+
+
+class Checker:
+    def __init__(self, server_id, bettors, start_total):
+        self.server_id = server_id
+        self.bonus = bettors * round(100 * 2 / bettors) #What payout() adds to a two option prediction everyone bet the same on
+        self.start_total = start_total
+        self.checks = {"view": 0, "disk": 0}
+        self.violations = {"view": 0, "disk": 0}
+
+    def total(self, users, predictions):
+        server = predictions[self.server_id]
+        open_bets = sum(prediction.get("total_bets", 0) for prediction in server["Predictions"].values())
+        resolved = server["Data"]["next_bet_number"] - 1 - len(server["Predictions"])
+        return sum(user["wallet"] for user in users[self.server_id].values()) + open_bets - resolved * self.bonus
+
+    def check(self, source, users, predictions):
+        self.checks[source] += 1
+        try:
+            consistent = self.total(users, predictions) == self.start_total
+        except KeyError: #A file read while it was being rewritten
+            consistent = False
+        if not consistent:
+            self.violations[source] += 1
+
+    async def run(self, stop):
+        while not stop.is_set():
+            view = bot.ReadView()
+            self.check("view", view.load(bot.USERS_FILE), view.load(bot.PREDICTIONS_FILE))
+            try:
+                users = await bot.read_json_file(bot.USERS_FILE)
+                predictions = await bot.read_json_file(bot.PREDICTIONS_FILE)
+            except ValueError: #Cut off halfway through a write
+                users = predictions = {}
+            self.check("disk", users, predictions)
+            await asyncio.sleep(0)
+
+
+async def worker(): #Runs until cancelled, like bot.command_loop
+    while True:
+        if bot.COMMAND_QUEUE:
+            try:
+                await bot.process_next_command()
+            except Exception as e:
+                print(f"  command failed: {e!r}")
+        else:
+            await asyncio.sleep(0)
+
+
+async def wait_for_queue():
+    while bot.COMMAND_QUEUE:
+        await asyncio.sleep(0)
+
+
+async def writer(guild, bettors, stop, rounds):
+    while not stop.is_set():
+        prediction_id = rounds["created"] + 1
+        await bot.handle_message(fake_discord.FakeMessage(guild, guild.moderator, guild.channel, f"!create_prediction (Round {prediction_id}) 2 (A) (B)"))
+        for member in bettors:
+            await bot.handle_message(fake_discord.FakeMessage(guild, member, guild.channel, f"!bet {prediction_id} {BET} 1"))
+        resolve = fake_discord.FakeMessage(guild, guild.moderator, guild.channel, f"!resolve_prediction {prediction_id} 1")
+        await bot.handle_message(resolve)
+        while any(message is resolve for message, _ in bot.COMMAND_QUEUE):
+            await asyncio.sleep(0)
+        rounds["created"] += 1
+        rounds["phase"] += 1
+
+
+async def reader(guild, member, channel, stop, latencies, interval):
+    while not stop.is_set():
+        channel.reply = asyncio.get_running_loop().create_future()
+        start = time.perf_counter()
+        await bot.handle_message(fake_discord.FakeMessage(guild, member, channel, "!wallet"))
+        await channel.reply
+        latencies.append(time.perf_counter() - start)
+        await asyncio.sleep(max(0, interval - latencies[-1])) #Also gives the other tasks a turn, a fast read never has to wait
+
+
+async def run_phase(args, guild, bettors, readers, checker, rounds, fast_reads):
+    bot.FAST_READS = fast_reads
+    stop = asyncio.Event()
+    latencies = []
+    rounds["phase"] = 0
+    tasks = [asyncio.create_task(worker()), asyncio.create_task(writer(guild, bettors, stop, rounds)), asyncio.create_task(checker.run(stop))]
+    tasks += [asyncio.create_task(reader(guild, member, channel, stop, latencies, args.read_interval / 1000)) for member, channel in readers]
+    await asyncio.sleep(args.seconds)
+    stop.set()
+    await asyncio.gather(*tasks[1:]) #The worker keeps draining until the writer and readers are answered
+    await wait_for_queue()
+    tasks[0].cancel()
+    latencies.sort()
+    return {
+        "fast_reads": fast_reads,
+        "reads": len(latencies),
+        "reads_per_second": len(latencies) / args.seconds,
+        "read_p50_ms": percentile(latencies, 0.50) * 1000,
+        "read_p99_ms": percentile(latencies, 0.99) * 1000,
+        "payout_rounds": rounds["phase"],
+    }
+
+
+async def bench(args, directory):
+    fake_discord.use_data_dir(bot, directory)
+    client = fake_discord.build_world(bot, 1, args.bettors + args.readers)
+    guild = client.guilds[0]
+    server_id = str(guild.id)
+    await bot.populate_data_folder()
+    for member in guild.members:
+        await bot.handle_message(fake_discord.FakeMessage(guild, member, guild.channel, "!wallet"))
+        while bot.COMMAND_QUEUE:
+            await bot.process_next_command()
+    bettors = guild.members[1:args.bettors + 1]
+    readers = []
+    for index, member in enumerate(guild.members[args.bettors + 1:]):
+        channel = ReplyChannel(client, guild.channel.id + 1 + index, guild)
+        client._channels[channel.id] = channel
+        readers.append((member, channel))
+
+    users = await bot.read_json_file(bot.USERS_FILE)
+    checker = Checker(server_id, args.bettors, 0)
+    checker.start_total = checker.total(users, await bot.read_json_file(bot.PREDICTIONS_FILE))
+    rows = []
+    rounds = {"created": 0, "phase": 0}
+    for fast_reads in (False, True):
+        row = await run_phase(args, guild, bettors, readers, checker, rounds, fast_reads)
+        rows.append(row)
+        print(f"  fast reads {'on ' if fast_reads else 'off'}  {row['reads']:>8,} reads  {row['reads_per_second']:>9,.0f} reads/s  "
+              f"p50 {row['read_p50_ms']:7.3f} ms  p99 {row['read_p99_ms']:7.3f} ms  {row['payout_rounds']:>5,} payout rounds")
+    for source in ("view", "disk"):
+        print(f"  {source:<4} reads checked {checker.checks[source]:>8,}  inconsistent {checker.violations[source]:>6,}")
+    rows.append({"checks": checker.checks, "violations": checker.violations})
+    bot.get_ledger().file.close()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Times bot.py's fast read path against the command queue under writes, and checks its reads are consistent.")
+    parser.add_argument("--bettors", type = int, default = 40, help = "users betting on every prediction")
+    parser.add_argument("--readers", type = int, default = 16, help = "users sending !wallet concurrently")
+    parser.add_argument("--read-interval", type = float, default = 20, help = "milliseconds between the start of one reader's !wallet and its next, 0 reads flat out")
+    parser.add_argument("--seconds", type = float, default = 10, help = "length of each run, with fast reads off and on")
+    parser.add_argument("--output", help = "also write the results as JSON to this file")
+    args = parser.parse_args()
+    fake_discord.disable_rate_limits(bot)
+
+    directory = tempfile.mkdtemp(prefix = "commerce-reads-")
+    try:
+        rows = asyncio.run(bench(args, directory))
+    finally:
+        shutil.rmtree(directory, ignore_errors = True)
+    if args.output:
+        with open(args.output, "w", encoding = "utf-8") as f:
+            json.dump(rows, f, indent = 4)
+
+
+if __name__ == "__main__":
+    main()
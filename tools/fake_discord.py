@@ -0,0 +1,283 @@
+"""
+Stand-ins for the discord.py objects bot.py touches, so the command pipeline can run without a Discord connection.
+Only the attributes and coroutines bot.py actually uses are implemented.
+"""
+import os
+import sys
+import asyncio
+import itertools
+from datetime import datetime, timezone
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BASE_DIR not in sys.path:
+    sys.path.insert(0, BASE_DIR)
+
+_ids = itertools.count(10_000_000)
+LATENCY = 0.0 #Seconds every fake Discord API call waits, like a round trip to Discord
+
+
+class FakePermissions:
+    def __init__(self, manage_channels = False):
+        self.manage_channels = manage_channels
+
+
+class FakeSentMessage:
+    def __init__(self, channel, content = None, embeds = None, file = None):
+        self.id = next(_ids)
+        self.channel = channel
+        self.content = content
+        self.embeds = embeds or []
+        self.file = file
+        self.pinned = False
+        self.created_at = datetime.now(timezone.utc)
+
+    async def pin(self):
+        self.pinned = True
+
+    async def unpin(self):
+        self.pinned = False
+
+    async def edit(self, content = None):
+        self.content = content
+
+
+class FakeChannel:
+    def __init__(self, client, channel_id, guild = None, name = None):
+        self.client = client
+        self.id = channel_id
+        self.guild = guild
+        self.name = name or f"channel-{channel_id}"
+
+    async def send(self, content = None, embed = None, embeds = None, file = None):
+        await asyncio.sleep(LATENCY)
+        sent = FakeSentMessage(self, content, [embed] if embed else embeds, file)
+        self.client.sent.append(sent)
+        return sent
+
+    async def pins(self):
+        return [sent for sent in self.client.sent if sent.channel is self and sent.pinned]
+
+    async def fetch_message(self, message_id):
+        for sent in self.client.sent:
+            if sent.id == message_id:
+                return sent
+        raise LookupError(message_id)
+
+
+class FakeMember:
+    def __init__(self, member_id, name, guild = None, moderator = False):
+        self.id = member_id
+        self.name = name
+        self.display_name = name
+        self.global_name = name
+        self.guild = guild
+        self.bot = False
+        self.roles = []
+        self.guild_permissions = FakePermissions(manage_channels = moderator)
+        self.mention = f"<@{member_id}>"
+
+
+class FakeRole:
+    def __init__(self, role_id, name, members = None):
+        self.id = role_id
+        self.name = name
+        self.members = list(members or [])
+        self.mention = f"<@&{role_id}>"
+
+
+class FakeGuild:
+    def __init__(self, guild_id, name = None):
+        self.id = guild_id
+        self.name = name or f"guild-{guild_id}"
+        self.members = []
+        self.roles = []
+        self.shard_id = 0
+        self._members = {}
+
+    def add_member(self, member):
+        member.guild = self
+        self.members.append(member)
+        self._members[member.id] = member
+        return member
+
+    def get_member(self, member_id):
+        return self._members.get(int(member_id))
+
+    async def fetch_member(self, member_id):
+        await asyncio.sleep(LATENCY)
+        member = self._members.get(int(member_id))
+        if member is None:
+            raise LookupError(member_id)
+        return member
+
+    async def fetch_members(self, limit = None, after = None):
+        after_id = int(after.id) if after is not None else 0
+        count = 0
+        for member in sorted(self.members, key = lambda m: m.id):
+            if member.id <= after_id:
+                continue
+            if limit is not None and count >= limit:
+                return
+            count += 1
+            yield member
+
+    def get_role(self, role_id):
+        for role in self.roles:
+            if role.id == int(role_id):
+                return role
+        return None
+
+    @property
+    def member_count(self):
+        return len(self.members)
+
+
+class FakeMessage:
+    def __init__(self, guild, author, channel, content, mentions = None, role_mentions = None, attachments = None):
+        self.id = next(_ids)
+        self.guild = guild
+        self.author = author
+        self.channel = channel
+        self.content = content
+        self.mentions = list(mentions or [])
+        self.role_mentions = list(role_mentions or [])
+        self.attachments = list(attachments or [])
+        self.created_at = datetime.now(timezone.utc)
+
+
+class FakeInteractionResponse:
+    def __init__(self, interaction):
+        self.interaction = interaction
+        self.deferred = False
+
+    async def defer(self, thinking = False, ephemeral = False):
+        self.deferred = True
+
+    async def send_message(self, content = None, ephemeral = False):
+        await self.interaction.followup.send(content, ephemeral = ephemeral)
+
+
+class FakeFollowup:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def send(self, content = None, embeds = None, ephemeral = False, file = None):
+        sent = FakeSentMessage(self.interaction.channel, content, embeds if isinstance(embeds, list) else None, file)
+        sent.ephemeral = ephemeral
+        self.interaction.replies.append(sent)
+        self.interaction.channel.client.sent.append(sent)
+        return sent
+
+
+class FakeNamespace:
+    def __init__(self, **options):
+        self.__dict__.update(options)
+
+
+class FakeInteraction:
+    """A slash command invocation, replies sent through followup are kept in replies."""
+    def __init__(self, guild, user, channel, **options):
+        self.id = next(_ids)
+        self.guild = guild
+        self.guild_id = guild.id
+        self.user = user
+        self.channel = channel
+        self.namespace = FakeNamespace(**options)
+        self.created_at = datetime.now(timezone.utc)
+        self.replies = []
+        self.response = FakeInteractionResponse(self)
+        self.followup = FakeFollowup(self)
+
+
+class FakeCommandTree:
+    """Keeps the real slash command definitions, syncs are only counted."""
+    def __init__(self, tree = None):
+        self.tree = tree
+        self.syncs = 0
+
+    def __getattr__(self, name): #Command.to_dict reads settings off the tree
+        return getattr(self.tree, name)
+
+    def get_commands(self):
+        return self.tree.get_commands() if self.tree else []
+
+    def get_command(self, name):
+        return self.tree.get_command(name) if self.tree else None
+
+    async def sync(self):
+        self.syncs += 1
+        return self.get_commands()
+
+
+class FakeBot:
+    """Replaces bot.bot: resolves guilds and channels from memory and records everything sent."""
+    def __init__(self, tree = None):
+        self.user = FakeMember(1, "Commerce Bot")
+        self.user.bot = True
+        self.tree = FakeCommandTree(tree)
+        self.guilds = []
+        self.sent = []
+        self.rest_calls = 0
+        self._guilds = {}
+        self._channels = {}
+
+    def add_guild(self, guild):
+        self.guilds.append(guild)
+        self._guilds[guild.id] = guild
+        return guild
+
+    def add_channel(self, channel_id, guild = None):
+        channel = FakeChannel(self, channel_id, guild)
+        self._channels[channel_id] = channel
+        return channel
+
+    def get_guild(self, guild_id):
+        return self._guilds.get(int(guild_id))
+
+    async def fetch_guild(self, guild_id):
+        await asyncio.sleep(LATENCY)
+        self.rest_calls += 1
+        return self._guilds[int(guild_id)]
+
+    def get_channel(self, channel_id):
+        return self._channels.get(channel_id)
+
+    async def fetch_channel(self, channel_id):
+        await asyncio.sleep(LATENCY)
+        self.rest_calls += 1
+        channel = self._channels.get(int(channel_id))
+        if channel is None:
+            raise LookupError(channel_id)
+        return channel
+
+
+def use_data_dir(bot_module, data_dir):
+    """Points every data file/folder constant of bot.py at data_dir instead of the real data folder."""
+    old_data_dir = bot_module.DATA_DIR
+    for name, value in list(vars(bot_module).items()):
+        if name.isupper() and isinstance(value, str) and value.startswith(old_data_dir):
+            setattr(bot_module, name, data_dir + value[len(old_data_dir):])
+    bot_module.FILEPATHS = [os.path.join(data_dir, os.path.basename(path)) for path in bot_module.FILEPATHS]
+    bot_module.FAST_READ_FILES = [os.path.join(data_dir, os.path.basename(path)) for path in bot_module.FAST_READ_FILES]
+
+
+def disable_rate_limits(bot_module):
+    """Turns off bot.py's per-user and per-guild command limits, synthetic traffic is far faster than any real user."""
+    for limits in bot_module.RATE_LIMITS.values():
+        for scope in limits:
+            limits[scope] = (0, 0)
+
+
+def build_world(bot_module, guild_count, users_per_guild, first_guild_id = 1_000_000, guild_ids = None):
+    """Installs a FakeBot with guild_count guilds (or one per guild_ids), each with a moderator and users_per_guild members, into bot_module."""
+    client = FakeBot(getattr(bot_module.bot, "tree", None))
+    guild_ids = list(guild_ids or range(first_guild_id, first_guild_id + guild_count))
+    for guild_index, guild_id in enumerate(guild_ids):
+        guild = client.add_guild(FakeGuild(guild_id))
+        guild.shard_id = (guild_id >> 22) % max(getattr(bot_module, "SHARD_COUNT", 0), 1)
+        guild.channel = client.add_channel(guild_id * 10 + guild_index, guild)
+        guild.moderator = guild.add_member(FakeMember(next(_ids), f"moderator-{guild_index}", moderator = True))
+        for user_index in range(users_per_guild):
+            guild.add_member(FakeMember(next(_ids), f"user-{guild_index}-{user_index}"))
+    bot_module.bot = client
+    return client
@@ -0,0 +1,231 @@
+"""
+Offline load test for the command pipeline.
+
+Pushes a configurable mix of commands from synthetic users across synthetic guilds through
+bot.handle_message and the command queue, using the fakes in fake_discord.py instead of Discord.
+
+    python tools/loadtest.py --guilds 4 --users 200 --commands 2000 --mix bet=30,buy=20,bid=10,wallet=30,predictions=10
+"""
+import argparse
+import asyncio
+import json
+import random
+import shutil
+import tempfile
+import time
+
+import fake_discord
+import bot
+
+DEFAULT_MIX = "bet=30,buy=20,bid=10,wallet=30,predictions=10"
+SHOP_ITEM = "Load Test Item"
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip().lstrip("!")
+        if name not in COMMAND_BUILDERS:
+            raise SystemExit(f"Unknown command in mix: {name}. Choose from {', '.join(COMMAND_BUILDERS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def bytes_written():
+    """Bytes this process has passed to write(), None where /proc/self/io isn't available."""
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class GuildState:
+    """What the generator needs to know about a seeded guild to build valid commands."""
+    def __init__(self, guild):
+        self.guild = guild
+        self.prediction_id = "1"
+        self.auction_id = "1"
+        self.next_bid = 10
+
+
+def build_bet(state, rng):
+    return f"!bet {state.prediction_id} {rng.randint(1, 20)} {rng.randint(1, 2)}"
+
+
+def build_buy(state, rng):
+    return f"!buy ({SHOP_ITEM}) 1"
+
+
+def build_bid(state, rng):
+    state.next_bid += rng.randint(1, 5)
+    return f"!bid {state.auction_id} {state.next_bid}"
+
+
+def build_wallet(state, rng):
+    return "!wallet"
+
+
+def build_predictions(state, rng):
+    return "!predictions"
+
+
+COMMAND_BUILDERS = {
+    "bet": build_bet,
+    "buy": build_buy,
+    "bid": build_bid,
+    "wallet": build_wallet,
+    "predictions": build_predictions,
+}
+
+
+async def run_command(guild, author, content):
+    await bot.handle_message(fake_discord.FakeMessage(guild, author, guild.channel, content))
+    while bot.COMMAND_QUEUE:
+        await bot.process_next_command()
+
+
+async def seed(client, states):
+    """Creates the shop item, prediction and auction every guild's traffic targets, and a funded wallet for everyone."""
+    for state in states:
+        guild = state.guild
+        moderator = guild.moderator
+        await run_command(guild, moderator, f"!create_shop_item ({SHOP_ITEM}) 1")
+        await run_command(guild, moderator, "!create_prediction (Load Test) 2 (Yes) (No)")
+        await run_command(guild, moderator, "!create_auction (Load Test Lot) 1 1 600")
+        for member in guild.members:
+            if member is not moderator:
+                await run_command(guild, member, "!wallet")
+        await run_command(guild, moderator, "!reward 100000000 everyone")
+
+
+async def run_load(args):
+    rng = random.Random(args.seed)
+    mix = parse_mix(args.mix)
+    names = list(mix)
+    weights = [mix[name] for name in names]
+
+    client = fake_discord.build_world(bot, args.guilds, args.users)
+    states = [GuildState(guild) for guild in client.guilds]
+    await bot.populate_data_folder()
+    seed_start = time.perf_counter()
+    await seed(client, states)
+    seed_seconds = time.perf_counter() - seed_start
+
+    latencies = {name: [] for name in names}
+    enqueued = {}
+    sent_before = len(client.sent)
+    rest_before = client.rest_calls
+    written_before = bytes_written()
+    start = time.perf_counter()
+    remaining = args.commands
+    while remaining > 0:
+        burst = min(args.concurrency, remaining)
+        remaining -= burst
+        for _ in range(burst):
+            state = rng.choice(states)
+            author = rng.choice(state.guild.members[1:])
+            name = rng.choices(names, weights)[0]
+            message = fake_discord.FakeMessage(state.guild, author, state.guild.channel, COMMAND_BUILDERS[name](state, rng))
+            enqueued[message.id] = (name, time.perf_counter())
+            await bot.handle_message(message)
+            if not bot.COMMAND_QUEUE or bot.COMMAND_QUEUE[-1][0] is not message: #Answered on the fast read path, or throttled
+                name, enqueued_at = enqueued.pop(message.id)
+                latencies[name].append(time.perf_counter() - enqueued_at)
+        while bot.COMMAND_QUEUE:
+            message, _ = bot.COMMAND_QUEUE[0]
+            await bot.process_next_command()
+            name, enqueued_at = enqueued.pop(message.id)
+            latencies[name].append(time.perf_counter() - enqueued_at)
+    elapsed = time.perf_counter() - start
+    written_after = bytes_written()
+
+    for task in asyncio.all_tasks():
+        if task is not asyncio.current_task():
+            task.cancel() #Auction timers
+
+    all_latencies = sorted(latency for values in latencies.values() for latency in values)
+    completed = len(all_latencies)
+    return {
+        "guilds": args.guilds,
+        "users_per_guild": args.users,
+        "commands": completed,
+        "concurrency": args.concurrency,
+        "mix": mix,
+        "seed_seconds": seed_seconds,
+        "elapsed_seconds": elapsed,
+        "commands_per_second": completed / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(all_latencies, 0.50) * 1000,
+        "p99_ms": percentile(all_latencies, 0.99) * 1000,
+        "bytes_written": None if written_before is None else written_after - written_before,
+        "messages_sent": len(client.sent) - sent_before,
+        "rest_calls": client.rest_calls - rest_before,
+        "throttled": bot.METRICS.total("commerce_commands_throttled_total"),
+        "per_command": {
+            name: {
+                "count": len(values),
+                "p50_ms": percentile(sorted(values), 0.50) * 1000,
+                "p99_ms": percentile(sorted(values), 0.99) * 1000,
+            }
+            for name, values in latencies.items()
+        },
+    }
+
+
+def print_report(result):
+    print(f"{result['commands']:,} commands from {result['users_per_guild']:,} users x {result['guilds']} guilds in {result['elapsed_seconds']:.2f}s (seeding took {result['seed_seconds']:.2f}s)")
+    print(f"  throughput : {result['commands_per_second']:,.1f} commands/sec")
+    print(f"  latency    : p50 {result['p50_ms']:.2f} ms, p99 {result['p99_ms']:.2f} ms")
+    written = result["bytes_written"]
+    print(f"  disk       : {'n/a' if written is None else f'{written:,} bytes written ({written / max(result['commands'], 1):,.0f} per command)'}")
+    print(f"  discord    : {result['messages_sent']:,} messages sent, {result['rest_calls']:,} REST lookups")
+    if result["throttled"]:
+        print(f"  throttled  : {result['throttled']:,} commands dropped by the rate limiter")
+    for name, stats in result["per_command"].items():
+        print(f"  !{name:<12} {stats['count']:>7,}  p50 {stats['p50_ms']:8.2f} ms  p99 {stats['p99_ms']:8.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Offline load test for bot.py's command pipeline.")
+    parser.add_argument("--guilds", type = int, default = 2, help = "number of synthetic guilds (M)")
+    parser.add_argument("--users", type = int, default = 50, help = "synthetic users per guild (N)")
+    parser.add_argument("--commands", type = int, default = 1000, help = "commands to send after seeding")
+    parser.add_argument("--mix", default = DEFAULT_MIX, help = f"command weights (default {DEFAULT_MIX})")
+    parser.add_argument("--concurrency", type = int, default = 1, help = "messages enqueued before the queue is drained")
+    parser.add_argument("--seed", type = int, default = 0, help = "random seed")
+    parser.add_argument("--data-dir", help = "where to keep the generated data files (default: a temporary folder)")
+    parser.add_argument("--output", help = "also write the results as JSON to this file")
+    parser.add_argument("--metrics", action = "store_true", help = "print the bot's Prometheus metrics after the run")
+    parser.add_argument("--rate-limits", action = "store_true", help = "keep the bot's command rate limits on (off by default)")
+    args = parser.parse_args()
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix = "commerce-loadtest-")
+    fake_discord.use_data_dir(bot, data_dir)
+    if not args.rate_limits:
+        fake_discord.disable_rate_limits(bot)
+    try:
+        result = asyncio.run(run_load(args))
+    finally:
+        if not args.data_dir:
+            shutil.rmtree(data_dir, ignore_errors = True)
+    print_report(result)
+    if args.metrics:
+        print(bot.METRICS.render())
+    if args.output:
+        with open(args.output, "w", encoding = "utf-8") as f:
+            json.dump(result, f, indent = 4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""
+Runs two shard processes against one SQLite store and checks they don't step on each other.
+
+Each worker is started with STORAGE_BACKEND=sqlite, SHARD_COUNT=2 and its own SHARD_IDS, leases the fake guilds on its
+shard and pushes commands through bot.handle_message and the command queue at the same time as the other worker.
+Afterwards the parent checks that every guild's data is there, that each worker only leased its own guilds, and that
+neither a third process nor a second one misconfigured with the same SHARD_IDS can write a guild a live process owns.
+
+    python tools/shard_check.py --guilds 4 --users 30 --commands 300
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+
+SHARD_COUNT = 2
+FIRST_GUILD = 1_000
+
+
+def guild_ids_for(shard_id, count):
+    """Guild ids that Discord would route to shard_id, (id >> 22) % shard_count"""
+    return [(FIRST_GUILD + index * SHARD_COUNT + shard_id) << 22 for index in range(count)]
+
+
+def worker_env(db_path, shard_ids = None, owner = None):
+    env = dict(os.environ, STORAGE_BACKEND = "sqlite", STORAGE_DB = db_path, SNAPSHOT_INTERVAL_MINUTES = "0")
+    if shard_ids is not None:
+        env.update(SHARD_COUNT = str(SHARD_COUNT), SHARD_IDS = str(shard_ids))
+    if owner:
+        env["SHARD_OWNER"] = owner
+    return env
+
+
+async def run_worker(args):
+    import fake_discord
+    import bot
+    fake_discord.use_data_dir(bot, args.data_dir)
+    fake_discord.disable_rate_limits(bot)
+    client = fake_discord.build_world(bot, args.guilds, args.users, guild_ids = guild_ids_for(args.shard, args.guilds))
+    await bot.populate_data_folder()
+    refused = await asyncio.to_thread(bot.get_store().claim, [str(guild.id) for guild in client.guilds])
+
+    async def run_command(guild, author, content):
+        await bot.handle_message(fake_discord.FakeMessage(guild, author, guild.channel, content))
+        while bot.COMMAND_QUEUE:
+            await bot.process_next_command()
+
+    for guild in client.guilds:
+        await run_command(guild, guild.moderator, "!create_shop_item (Shard Item) 1")
+        for member in guild.members[1:]:
+            await run_command(guild, member, "!wallet")
+        await run_command(guild, guild.moderator, "!reward 1000 everyone")
+    for index in range(args.commands):
+        guild = client.guilds[index % len(client.guilds)]
+        member = guild.members[1 + index % (len(guild.members) - 1)]
+        await run_command(guild, member, "!buy (Shard Item) 1")
+    for task in asyncio.all_tasks():
+        if task is not asyncio.current_task():
+            task.cancel()
+    print(json.dumps({"shard": args.shard, "guilds": [str(guild.id) for guild in client.guilds], "refused": refused}))
+
+
+def try_foreign_write(db_path, data_dir, server_id, shard_ids = None, owner = None):
+    """Runs in another process: writing a guild leased by a live shard process has to fail"""
+    code = (
+        "import sys, fake_discord, bot\n"
+        f"fake_discord.use_data_dir(bot, {data_dir!r})\n"
+        "try:\n"
+        f"    bot.get_store().save('users.json', {{{server_id!r}: {{}}}})\n"
+        "except bot.GuildOwnershipError as e:\n"
+        "    print(e); sys.exit(0)\n"
+        "sys.exit(1)\n"
+    )
+    result = subprocess.run([sys.executable, "-c", code], env = dict(worker_env(db_path, shard_ids, owner), PYTHONPATH = os.path.dirname(os.path.abspath(__file__))), capture_output = True, text = True)
+    return result.returncode == 0, (result.stdout + result.stderr).strip()
+
+
+def check_store(db_path, reports, args):
+    problems = []
+    connection = sqlite3.connect(db_path)
+    owners = dict(connection.execute("SELECT server_id, owner FROM guild_owners"))
+    rows = connection.execute("SELECT file, server_id, data FROM state").fetchall()
+    connection.close()
+    stored = {(file_name, server_id): json.loads(data) if data[:1] == b"{" else None for file_name, server_id, data in rows}
+    for report in reports:
+        if report["refused"]:
+            problems.append(f"shard {report['shard']} was refused {report['refused']}")
+        for server_id in report["guilds"]:
+            if not (owners.get(server_id) or "").startswith(f"shards {report['shard']} of {SHARD_COUNT} @ "):
+                problems.append(f"guild {server_id} is leased to {owners.get(server_id)}, not shard {report['shard']}")
+            for file_name in ("settings.json", "users.json", "shop.json", "predictions.json"):
+                if (file_name, server_id) not in stored:
+                    problems.append(f"{file_name} has no row for guild {server_id}")
+            users = stored.get(("users.json", server_id)) or {}
+            bought = sum(user.get("inventory", {}).get("1", {}).get("quantity", 0) for user in users.values())
+            expected = args.commands // args.guilds + (1 if args.commands % args.guilds > report["guilds"].index(server_id) else 0)
+            if len(users) != args.users + 1 or bought != expected: #The moderator has a record too
+                problems.append(f"guild {server_id} has {len(users)} users and {bought} purchases, expected {args.users + 1} and {expected}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Runs two shard processes against one SQLite store.")
+    parser.add_argument("--guilds", type = int, default = 3, help = "guilds per shard")
+    parser.add_argument("--users", type = int, default = 20, help = "users per guild")
+    parser.add_argument("--commands", type = int, default = 200, help = "!buy commands per shard")
+    parser.add_argument("--worker", action = "store_true", help = argparse.SUPPRESS)
+    parser.add_argument("--shard", type = int, default = 0, help = argparse.SUPPRESS)
+    parser.add_argument("--data-dir", help = argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        asyncio.run(run_worker(args))
+        return
+
+    data_dir = tempfile.mkdtemp(prefix = "commerce-shards-")
+    db_path = os.path.join(data_dir, "commerce.db")
+    try:
+        workers = [
+            subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), "--worker", "--shard", str(shard), "--data-dir", os.path.join(data_dir, f"shard-{shard}"),
+                 "--guilds", str(args.guilds), "--users", str(args.users), "--commands", str(args.commands)],
+                env = worker_env(db_path, shard), stdout = subprocess.PIPE, stderr = subprocess.PIPE, text = True,
+            )
+            for shard in range(SHARD_COUNT)
+        ]
+        reports = []
+        for worker in workers:
+            out, err = worker.communicate()
+            if worker.returncode != 0:
+                print(err)
+                raise SystemExit(f"worker exited with {worker.returncode}")
+            reports.append(json.loads(out.strip().splitlines()[-1]))
+        problems = check_store(db_path, reports, args)
+        refused, output = try_foreign_write(db_path, data_dir, reports[0]["guilds"][0], owner = "intruder")
+        if not refused:
+            problems.append(f"a third process could write a leased guild: {output}")
+        refused, output = try_foreign_write(db_path, data_dir, reports[0]["guilds"][0], shard_ids = reports[0]["shard"])
+        if not refused:
+            problems.append(f"a second process on shard {reports[0]['shard']} could write its leased guild: {output}")
+    finally:
+        shutil.rmtree(data_dir, ignore_errors = True)
+
+    for problem in problems:
+        print(f"FAIL {problem}")
+    if problems:
+        sys.exit(1)
+    print(f"OK: {SHARD_COUNT} shard processes, {args.guilds * SHARD_COUNT} guilds, {args.commands * SHARD_COUNT} purchases, leases enforced")
+
+
+if __name__ == "__main__":
+    main()